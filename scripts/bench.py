@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import atexit
+import time
+import random
+import argparse
+import platform
+import tempfile
+import collections
+from vmstate import *
+import corpus
+import seedspec
+import vmdiff
+from example_hypercall import HYPERSEED_CORPUS
+try:
+    import numpy as np
+    import regarray
+except ImportError:
+    # regarray requires NumPy
+    regarray = None
+
+# minimum duration of one timed repeat, in seconds
+MIN_TIME = 0.05
+
+# regressions below this fraction of the baseline are ignored as noise
+THRESHOLD = 0.1
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name):
+    '''
+    Register a benchmark. The decorated function does the setup and returns
+    the callable to time, which may return the number of items it produced.
+    '''
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def temp_file(suffix = '.bin'):
+    (fd, path) = tempfile.mkstemp(suffix = suffix)
+    os.close(fd)
+    atexit.register(os.remove, path)
+    return path
+
+def make_hyperseed(path, count = 256, seed = 0):
+    '''
+    Write a synthetic hyperseed input with count random hypercall payloads.
+    '''
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        for i in range(count):
+            record = HYPERSEED_CORPUS()
+            record.CallCode = rng.randrange(0x100)
+            record.CountOfElements = rng.randrange(16)
+            record.InputSize = rng.randrange(0x1000)
+            f.write(buffer(record))
+            f.write(''.join(chr(rng.randrange(256)) for _ in range(record.InputSize)))
+
+@benchmark('construct.x86')
+def bench_construct_x86():
+    return lambda: VMState(0x86)
+
+@benchmark('construct.x64')
+def bench_construct_x64():
+    return lambda: VMState(0x64)
+
+@benchmark('setup_gdt.x86')
+def bench_setup_gdt_x86():
+    return lambda: VMState(0x86).setup_gdt()
+
+@benchmark('setup_gdt.x64')
+def bench_setup_gdt_x64():
+    return lambda: VMState(0x64).setup_gdt()
+
+@benchmark('setup_paging.32')
+def bench_setup_paging_32():
+    return lambda: VMState(0x86).setup_paging()
+
+@benchmark('setup_paging.pae')
+def bench_setup_paging_pae():
+    return lambda: VMState(0x86).setup_paging(pae = True)
+
+@benchmark('setup_paging.4l_1g')
+def bench_setup_paging_4l_1g():
+    return lambda: VMState(0x64).setup_paging()
+
+@benchmark('setup_paging.4l_2m')
+def bench_setup_paging_4l_2m():
+    return lambda: VMState(0x64).setup_paging(huge = False)
+
+@benchmark('setup_idt.256')
+def bench_setup_idt():
+    descs = [IntGateDesc64(0x1000 + i * 16, 0x8, 1, 0, 1) for i in range(256)]
+    return lambda: VMState(0x64).setup_idt(descs)
+
+@benchmark('load_seg')
+def bench_load_seg():
+    state = VMState(0x64)
+    state.setup_gdt()
+    return lambda: state.load_seg(state.regs.ds, 0x18)
+
+@benchmark('regs.new')
+def bench_regs_new():
+    return RegFile
+
+@benchmark('regs.decode')
+def bench_regs_decode():
+    raw = str(bytearray(VMState(0x64).regs))
+    return lambda: RegFile.from_buffer_copy(raw)
+
+@benchmark('regs.bitfield')
+def bench_regs_bitfield():
+    regs = RegFile()
+    def run():
+        regs.cr4.SMEP = 1
+    return run
+
+# number of register files scanned by the bulk benchmarks
+BULK_REGS = 4096
+
+@benchmark('regs.scan.ctypes')
+def bench_regs_scan_ctypes():
+    raw = str(bytearray(VMState(0x64).regs)) * BULK_REGS
+    def run():
+        for i in xrange(BULK_REGS):
+            RegFile.from_buffer_copy(raw, i * sizeof(RegFile)).cr4.SMEP
+        return BULK_REGS
+    return run
+
+if regarray is not None:
+    @benchmark('regs.scan.numpy')
+    def bench_regs_scan_numpy():
+        raw = str(bytearray(VMState(0x64).regs)) * BULK_REGS
+        def run():
+            regarray.get(np.frombuffer(raw, regarray.REG_DTYPE), 'cr4.SMEP')
+            return BULK_REGS
+        return run
+
+@benchmark('memory.allocate_write')
+def bench_allocate_write():
+    data = '\xcc' * 64
+    def run():
+        memory = Memory()
+        for i in range(64):
+            memory.write(memory.allocate(len(data), 8), data)
+    return run
+
+@benchmark('raw.x64')
+def bench_raw():
+    state = VMState(0x64)
+    state.setup_gdt()
+    state.setup_paging()
+    return state.raw
+
+@benchmark('write_to.x64')
+def bench_write_to():
+    state = VMState(0x64)
+    state.setup_gdt()
+    state.setup_paging()
+    f = open(temp_file(), 'wb')
+    def run():
+        f.seek(0)
+        state.write_to(f)
+    return run
+
+@benchmark('load.file')
+def bench_load_file():
+    state = VMState(0x64)
+    state.setup_gdt()
+    state.setup_paging()
+    path = temp_file()
+    with open(path, 'wb') as f:
+        f.write(state.raw())
+    return lambda: VMState.load(path)
+
+@benchmark('load.buffer')
+def bench_load_buffer():
+    state = VMState(0x64)
+    state.setup_gdt()
+    state.setup_paging()
+    raw = state.raw()
+    return lambda: VMState.from_buffer(raw)
+
+def bench_compress(codec, level):
+    state = VMState(0x64)
+    state.setup_gdt()
+    state.setup_paging()
+    raw = state.raw()
+    return lambda: compress_seed(raw, codec, level)
+
+@benchmark('compress.zlib.1')
+def bench_compress_zlib_fast():
+    return bench_compress('zlib', 1)
+
+@benchmark('compress.zlib.9')
+def bench_compress_zlib_small():
+    return bench_compress('zlib', 9)
+
+if lzma is not None:
+    @benchmark('compress.lzma.6')
+    def bench_compress_lzma():
+        return bench_compress('lzma', 6)
+
+@benchmark('load.compressed')
+def bench_load_compressed():
+    state = VMState(0x64)
+    state.setup_gdt()
+    state.setup_paging()
+    path = temp_file()
+    state.save(path, 'zlib')
+    return lambda: VMState.load(path)
+
+@benchmark('vmdiff.dense.16m')
+def bench_vmdiff_dense():
+    old = VMState(0x64)
+    old.memory.allocate(16 << 20)
+    new = old.fork()
+    new.memory.write(0x5000, '\xcc')
+    return lambda: vmdiff.diff(old, new)
+
+@benchmark('vmdiff.sparse.apic')
+def bench_vmdiff_sparse():
+    old = VMState(0x64, True)
+    old.setup_gdt()
+    old.memory.allocate_at(0xFEE00000, PGSIZE, 'apic')
+    new = old.fork()
+    new.memory.write(0xFEE00080, '\xcc')
+    return lambda: vmdiff.diff(old, new)
+
+def family(name, hyperseed = None, specs = ()):
+    '''
+    Time one full run of a seed family (or of seed specs) through the corpus
+    jobs.
+    '''
+    jobs = list(corpus.build_jobs([name] if name else [], hyperseed, specs))
+    def run():
+        count = 0
+        for (index, job) in enumerate(jobs):
+            for raw in corpus.iter_job((index, 0, job)):
+                count += 1
+        return count
+    return run
+
+@benchmark('generate.lapic')
+def bench_generate_lapic():
+    return family('lapic')
+
+@benchmark('generate.hypercall')
+def bench_generate_hypercall():
+    path = temp_file()
+    make_hyperseed(path)
+    return family('hypercall', path)
+
+@benchmark('generate.rum')
+def bench_generate_rum():
+    return family('rum')
+
+@benchmark('generate.taskswitch')
+def bench_generate_taskswitch():
+    return family('taskswitch')
+
+@benchmark('generate.spec.rum')
+def bench_generate_spec_rum():
+    return family(None, specs = seedspec.spec_paths(['rum']))
+
+@benchmark('generate.spec.vmxon')
+def bench_generate_spec_vmxon():
+    return family(None, specs = seedspec.spec_paths(['vmxon']))
+
+@benchmark('generate.vmxon')
+def bench_generate_vmxon():
+    return family('vmxon')
+
+def measure(func, repeat):
+    '''
+    Time func over repeat rounds, each long enough to be measurable. Returns
+    the best and median seconds per call and the items per call.
+    '''
+    # calibrate the number of calls per round
+    (number, items) = (1, None)
+    while True:
+        start = time.time()
+        for _ in range(number):
+            items = func()
+        elapsed = time.time() - start
+        if elapsed >= MIN_TIME:
+            break
+        number *= 10 if elapsed < MIN_TIME / 10 else 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in range(number):
+            func()
+        times.append((time.time() - start) / number)
+    times.sort()
+    ans = {'best': times[0], 'median': times[len(times) / 2], 'number': number, 'repeat': repeat}
+    if isinstance(items, int):
+        ans['items'] = items
+    return ans
+
+def run(names, repeat):
+    results = collections.OrderedDict()
+    for name in names:
+        results[name] = measure(BENCHMARKS[name](), repeat)
+    return results
+
+def compare(results, baseline, threshold = THRESHOLD):
+    '''
+    Compare the best times against a baseline. Returns (name, old, new,
+    ratio, regressed) tuples for the benchmarks present in both.
+    '''
+    ans = []
+    for (name, result) in results.items():
+        if name not in baseline:
+            continue
+        (old, new) = (baseline[name]['best'], result['best'])
+        ratio = new / old if old else float('inf')
+        ans.append((name, old, new, ratio, ratio > 1 + threshold))
+    return ans
+
+def format_time(seconds):
+    for (unit, scale) in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.3f%s' % (seconds / scale, unit)
+    return '%.1fns' % (seconds / 1e-9)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', nargs = '+', dest = 'patterns', metavar = 'pattern', help = 'only run benchmarks whose name contains a pattern')
+    parser.add_argument('-r', type = int, dest = 'repeat', default = 5, help = 'number of timed rounds per benchmark')
+    parser.add_argument('-o', type = str, dest = 'output', metavar = '/path/to/results.json', help = 'save the results as JSON')
+    parser.add_argument('-b', type = str, dest = 'baseline', metavar = '/path/to/baseline.json', help = 'compare against saved results')
+    parser.add_argument('-t', type = float, dest = 'threshold', default = THRESHOLD, help = 'slowdown ratio over the baseline flagged as a regression')
+    parser.add_argument('-j', action = 'store_true', default = False, help = 'print the results as JSON')
+    args = parser.parse_args()
+    names = [name for name in BENCHMARKS if not args.patterns or any(p in name for p in args.patterns)]
+    results = run(names, args.repeat)
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+    if args.j:
+        print json.dumps(report, indent = 2)
+    elif not args.baseline:
+        for (name, result) in results.items():
+            rate = ' (%d items/s)' % (result['items'] / result['best']) if 'items' in result else ''
+            print '%-24s %10s %10s%s' % (name, format_time(result['best']), format_time(result['median']), rate)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        for (name, old, new, ratio, regressed) in compare(results, baseline, args.threshold):
+            regressions += regressed
+            if not args.j:
+                print '%-24s %10s -> %10s  %5.2fx%s' % (name, format_time(old), format_time(new), ratio, '  REGRESSION' if regressed else '')
+        sys.exit(1 if regressions else 0)
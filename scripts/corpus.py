@@ -0,0 +1,552 @@
+import os
+import re
+import sys
+import json
+import types
+import random
+import hashlib
+import itertools
+import argparse
+import collections
+import multiprocessing
+from vmstate import *
+import example_lapic
+import example_rum
+import example_msr
+import example_taskswitch
+import example_vmxon
+import example_realmode
+import example_hypercall
+import seedspec
+from validate import ValidatingWriter
+
+# first index used by numbered output names (others start from 0)
+NUMBERING = {'apic%04d.bin': 1}
+
+# number of hyperseed payloads handled by one job
+HYPERCALL_CHUNK = 256
+
+# maximum number of finished or in-flight jobs held by the writer
+WINDOW = 4
+
+FAMILIES = ('lapic', 'rum', 'msr', 'taskswitch', 'vmxon', 'realmode', 'hypercall')
+
+# generator modules of the families
+FAMILY_MODULES = {'example_lapic': 'lapic', 'example_rum': 'rum', 'example_msr': 'msr',
+                  'example_taskswitch': 'taskswitch', 'example_vmxon': 'vmxon', 'example_realmode': 'realmode'}
+
+MANIFEST_VERSION = 3
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# this script: it decides how jobs are seeded, named and written
+CORPUS = os.path.join(SCRIPTS, 'corpus.py')
+
+def hypercall_seeds(path, offset, count):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for state in example_hypercall.generate_seeds(f, count):
+            yield state
+
+def hypercall_jobs(path):
+    '''
+    Enumerate one job per HYPERCALL_CHUNK payloads of a hyperseed file,
+    indexing the file only as far as the jobs are consumed.
+    '''
+    with open(path, 'rb') as f:
+        (first, count) = (None, 0)
+        for offset in example_hypercall.index_seeds(f):
+            if count == 0:
+                first = offset
+            count += 1
+            if count == HYPERCALL_CHUNK:
+                yield ('hc%06d.bin', hypercall_seeds, (path, first, count))
+                count = 0
+        if count:
+            yield ('hc%06d.bin', hypercall_seeds, (path, first, count))
+
+def build_jobs(families, hyperseed = None, specs = ()):
+    '''
+    Enumerate the generator invocations as (name, func, args) tuples in a
+    fixed order, followed by one job per seed of the given spec files. A
+    name containing '%' is numbered across all the states emitted by the
+    jobs sharing it. The output names are checked right away, but the
+    hypercall jobs are only enumerated as the returned iterator is consumed.
+    '''
+    jobs = []
+    if 'lapic' in families:
+        jobs += [('apic%04d.bin', func, (opcode,)) for (opcode, func) in example_lapic.OPCODES]
+    if 'rum' in families:
+        jobs += [('%s.bin' % func.__name__, func, ()) for func in (example_rum.sysenter,
+                                                                  example_rum.syscall,
+                                                                  example_rum.callgate,
+                                                                  example_rum.popfs,
+                                                                  example_rum.popss,
+                                                                  example_rum.iret,
+                                                                  example_rum.retf)]
+    if 'msr' in families:
+        jobs += [('%s.bin' % func.__name__, func, ()) for func in (example_msr.rdmsr, example_msr.wrmsr)]
+    if 'taskswitch' in families:
+        for trigger in ('iret', 'jmp', 'call', 'vector'):
+            jobs.append(('taskswitch_%s.bin' % trigger, example_taskswitch.main, (trigger, False)))
+        jobs.append(('taskswitch_iret_s.bin', example_taskswitch.main, ('iret', True)))
+    if 'vmxon' in families:
+        jobs.append(('vmxon.bin', example_vmxon.create_state, ()))
+    if 'realmode' in families:
+        jobs.append(('realmode.bin', example_realmode.create_state, ()))
+    hypercall = []
+    if 'hypercall' in families and hyperseed:
+        hypercall = hypercall_jobs(hyperseed)
+    spec_jobs = []
+    for path in specs:
+        spec_jobs += [('%s.bin' % name, seedspec.build_seed, (path, name)) for name in seedspec.builder(path).seeds]
+    # the hypercall jobs all share one numbered name
+    check_outputs(jobs + spec_jobs + ([('hc%06d.bin', hypercall_seeds, (hyperseed,))] if hypercall else []))
+    return itertools.chain(jobs, hypercall, spec_jobs)
+
+def check_outputs(jobs):
+    '''
+    Stop if two jobs would write the same seed (e.g., a spec reproducing
+    a family that is built too), as the last one written would silently
+    win. Fixed names must be unique and must not match a numbered name.
+    '''
+    owners = {}
+    numbered = {}
+    for (name, func, args) in jobs:
+        owner = '%s%r' % (func.__name__, args)
+        if '%' in name:
+            # e.g., 'apic%04d.bin' matches 'apic0001.bin' (and longer numbers)
+            (prefix, spec) = name.split('%', 1)
+            (width, suffix) = re.match(r'0?(\d*)d(.*)$', spec).groups()
+            numbered.setdefault(r'%s\d{%s,}%s$' % (re.escape(prefix), width or 1, re.escape(suffix)), owner)
+            continue
+        assert name not in owners, 'Duplicate output %s: written by %s and %s' % (name, owners[name], owner)
+        owners[name] = owner
+    for (pattern, owner) in numbered.items():
+        for name in owners:
+            assert not re.match(pattern, name), 'Duplicate output %s: written by %s and %s' % (name, owners[name], owner)
+
+class DirectoryWriter(object):
+    '''
+    Save every state as its own file under path (same interface as
+    SeedPackWriter), compressed with codec if given.
+    '''
+    def __init__(self, path, codec = None, level = COMPRESS_LEVEL, update = False):
+        self.path = path
+        self.codec = codec
+        self.level = level
+        # with update set, files that already hold the same bytes are not rewritten
+        self.update = update
+        self.written = 0
+        self.unchanged = 0
+
+    def add(self, name, raw):
+        if self.codec:
+            raw = compress_seed(raw, self.codec, self.level)
+        path = os.path.join(self.path, name)
+        if self.update and os.path.exists(path) and os.path.getsize(path) == len(raw):
+            with open(path, 'rb') as f:
+                if f.read() == raw:
+                    self.unchanged += 1
+                    return True
+        with open(path, 'wb') as f:
+            f.write(raw)
+        self.written += 1
+        return True
+
+    def link(self, name, target):
+        if name != target:
+            path = os.path.join(self.path, name)
+            if os.path.exists(path):
+                os.unlink(path)
+            os.link(os.path.join(self.path, target), path)
+        return True
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def seed_digest(raw, ignore = ()):
+    '''
+    Hash the raw state, treating the registers in ignore as zero.
+    '''
+    if ignore:
+        offset = len(SPARSE_MAGIC) if raw[:len(SPARSE_MAGIC)] == SPARSE_MAGIC else 0
+        raw = bytearray(raw)
+        for field in ignore:
+            desc = getattr(RegFile, field)
+            raw[offset + desc.offset:offset + desc.offset + desc.size] = '\x00' * desc.size
+    return hashlib.sha1(raw).hexdigest()
+
+class DedupWriter(object):
+    '''
+    Wrap a writer to skip seeds whose content hash was already seen, or to
+    link them to the first seed with the same hash. Hashes are kept in a
+    text index ("<sha1> <name>" per line) so they persist across builds.
+    A seed only counts as a duplicate if the seed it matches is in the
+    output of the wrapped writer; otherwise it is written and its index
+    entry is refreshed. add() returns whether the seed reached the wrapped
+    writer (or was linked).
+    '''
+    def __init__(self, writer, index = None, ignore = (), link = False):
+        self.writer = writer
+        self.ignore = ignore
+        self.link = link
+        self.hashes = {}
+        self.duplicates = 0
+        self.index = None
+        if index:
+            if os.path.exists(index):
+                with open(index) as f:
+                    for line in f:
+                        # later entries refresh the earlier ones
+                        (digest, name) = line.split()
+                        self.hashes[digest] = name
+            self.index = open(index, 'a')
+
+    def add(self, name, raw):
+        digest = seed_digest(raw, self.ignore)
+        target = self.hashes.get(digest)
+        if target is None or target == name or target not in self.writer:
+            if target != name:
+                self.hashes[digest] = name
+                if self.index:
+                    self.index.write('%s %s\n' % (digest, name))
+            return self.writer.add(name, raw)
+        self.duplicates += 1
+        return self.link and self.writer.link(name, target)
+
+    def close(self):
+        if self.index:
+            self.index.close()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def module_file(module):
+    '''
+    Return the source file of a module from the scripts folder (None for
+    other modules).
+    '''
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    path = os.path.splitext(os.path.abspath(path))[0] + '.py'
+    return path if os.path.dirname(path) == SCRIPTS else None
+
+def job_group(func, args):
+    '''
+    Return the family (or the path of the spec file) a job belongs to, or
+    None for other generators.
+    '''
+    if func is seedspec.build_seed:
+        return os.path.abspath(args[0])
+    if func is hypercall_seeds:
+        return 'hypercall'
+    return FAMILY_MODULES.get(func.__module__)
+
+def job_sources(func):
+    '''
+    Collect the script sources a generator depends on: its module (or, for
+    the adapters in this file, the modules the adapter refers to) and the
+    script modules their globals come from, recursively.
+    '''
+    module = sys.modules[func.__module__]
+    if module_file(module) == CORPUS:
+        pending = [func.__globals__[name] for name in func.__code__.co_names if isinstance(func.__globals__.get(name), types.ModuleType)]
+    else:
+        pending = [module]
+    sources = set()
+    while pending:
+        module = pending.pop()
+        path = module_file(module)
+        if path is None or path in sources:
+            continue
+        sources.add(path)
+        for value in vars(module).values():
+            # names imported with 'from module import *' lead back to their module
+            owner = value if isinstance(value, types.ModuleType) else sys.modules.get(getattr(value, '__module__', None))
+            if owner is not None:
+                pending.append(owner)
+    return sorted(sources)
+
+class BuildManifest(object):
+    '''
+    Record how every job of a folder build was run: the generator, its
+    arguments, the RNG seed, the digests of the script sources (this one
+    included) and input files it depends on, the names of the seeds it
+    generated, and the seeds that were written (dedup or validation may
+    drop some). A job whose record is unchanged and whose written seeds
+    are all present is up to date. Records are only reused under the same
+    build configuration (e.g., APIC base or codec). When only some groups
+    (families and spec files) are built, the records of the other groups
+    are kept as they are, and their seeds are left in place.
+    '''
+    def __init__(self, path, config, groups = None):
+        self.path = path
+        self.config = config
+        self.groups = groups # the groups built this time (None for all of them)
+        self.old = {}
+        self.jobs = collections.OrderedDict()
+        self.digests = {}
+        self.reused = 0 # seeds of the up-to-date jobs
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and manifest.get('config') == config:
+                self.old = manifest['jobs']
+
+    def digest(self, path):
+        if path not in self.digests:
+            with open(path, 'rb') as f:
+                self.digests[path] = hashlib.sha1(f.read()).hexdigest()
+        return self.digests[path]
+
+    def describe(self, task):
+        '''
+        Return the (key, record) of a job task, without its outputs.
+        '''
+        (index, seed, (name, func, args)) = task
+        module = os.path.splitext(os.path.basename(module_file(sys.modules[func.__module__])))[0]
+        key = '%s %s.%s%r' % (name, module, func.__name__, args)
+        record = {'func': '%s.%s' % (module, func.__name__),
+                  'args': repr(args),
+                  'rng': '%d:%d' % (seed, index),
+                  'group': job_group(func, args),
+                  'sources': dict((os.path.basename(path), self.digest(path)) for path in set(job_sources(func)) | set([CORPUS])),
+                  # file arguments (e.g., the hyperseed input or a spec) are tracked by content
+                  'inputs': dict((arg, self.digest(arg)) for arg in args if isinstance(arg, str) and os.path.isfile(arg))}
+        return (key, record)
+
+    def outputs(self, key, record, folder):
+        '''
+        Return the (generated, written) seed names of a job if it is up to
+        date, or None if it is stale.
+        '''
+        old = self.old.get(key)
+        if old is None or dict((k, v) for (k, v) in old.items() if k not in ('names', 'outputs')) != record:
+            return None
+        if not all(os.path.exists(os.path.join(folder, name)) for name in old['outputs']):
+            return None
+        return ([str(name) for name in old['names']], [str(name) for name in old['outputs']])
+
+    def add(self, key, record, names, outputs, reused = False):
+        self.jobs[key] = dict(record, names = names, outputs = outputs)
+        if reused:
+            self.reused += len(outputs)
+
+    def current(self):
+        return set(name for record in self.jobs.values() for name in record['outputs'])
+
+    def carried(self):
+        '''
+        Return the old records of the groups not built this time, except
+        those whose seeds have been overwritten by this build.
+        '''
+        if self.groups is None:
+            return {}
+        current = self.current()
+        return dict((key, record) for (key, record) in self.old.items()
+                    if key not in self.jobs and record.get('group') not in self.groups and not current.intersection(record['outputs']))
+
+    def removed(self):
+        '''
+        Enumerate the seeds written by earlier builds of the groups built
+        this time that are no longer produced by any job.
+        '''
+        kept = self.current() | set(name for record in self.carried().values() for name in record['outputs'])
+        return sorted(set(name for record in self.old.values() for name in record['outputs']) - kept)
+
+    def save(self):
+        jobs = collections.OrderedDict(self.jobs)
+        jobs.update(self.carried())
+        # write a new file and rename it, so an interrupted build keeps the old manifest
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'config': self.config, 'jobs': jobs}, f, sort_keys = True)
+        os.rename(self.path + '.tmp', self.path)
+
+def configure(apicbase, profile = False):
+    '''
+    Apply the command line overrides to the generator modules (per worker).
+    '''
+    example_lapic.APICBASE = apicbase
+    if profile:
+        profiler.enable()
+
+def iter_job(job):
+    '''
+    Lazily run one job, yielding the raw bytes of each state it emits.
+    '''
+    (index, seed, (name, func, args)) = job
+    def states():
+        # derive the RNG state from the job index so results do not depend on scheduling
+        random.seed('%d:%d' % (seed, index))
+        result = func(*args)
+        for state in ([result] if isinstance(result, VMState) else result):
+            yield str(state.raw())
+    return profiler.iterate(func.__name__, states())
+
+def run_job(job):
+    # the worker's profile (if enabled) travels back with the results
+    return (list(iter_job(job)), profiler.collect())
+
+def imap_bounded(pool, func, tasks, window):
+    '''
+    Like pool.imap, but never keeps more than window results pending, so
+    memory stays bounded when the consumer is slower than the workers.
+    '''
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) == window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+def merge_profile(raws, stats):
+    profiler.merge(stats)
+    return raws
+
+def next_name(name, counters):
+    if '%' not in name:
+        return name
+    counters.setdefault(name, NUMBERING.get(name, 0))
+    counters[name] += 1
+    return name % (counters[name] - 1)
+
+def build(writer, jobs, workers, seed = 0, apicbase = example_lapic.APICBASE, profile = False, manifest = None, folder = None):
+    '''
+    Run the jobs across a process pool and hand their states to writer.
+    Returns the names of the seeds handed to writer, followed by the seeds
+    of the up-to-date jobs. With profile set, the workers' profiles are
+    merged into profiler. With a manifest, only the stale jobs are run:
+    the seeds of up-to-date jobs are left untouched in folder, and every
+    job is recorded in the manifest.
+    '''
+    def plan_task(task):
+        if not manifest:
+            return None
+        (key, record) = manifest.describe(task)
+        return (key, record, manifest.outputs(key, record, folder))
+    # jobs are consumed lazily: the stale ones are fed to the workers while
+    # the loop below is still writing the results of earlier ones
+    tasks = ((index, seed, job) for (index, job) in enumerate(jobs))
+    (planned, pending) = itertools.tee((task, plan_task(task)) for task in tasks)
+    stale = (task for (task, plan) in pending if plan is None or plan[2] is None)
+    if profile:
+        profiler.enable()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, configure, (apicbase, profile))
+        results = (merge_profile(raws, stats) for (raws, stats) in imap_bounded(pool, run_job, stale, workers * WINDOW))
+    else:
+        # stream states straight from the generators to disk
+        configure(apicbase, profile)
+        pool = None
+        results = (iter_job(task) for task in stale)
+    counters = {}
+    names = []
+    # results come back in submission order, so numbering is deterministic
+    for (task, plan) in planned:
+        name = task[2][0]
+        if plan is not None and plan[2] is not None:
+            (generated, outputs) = plan[2]
+            expected = dict(counters)
+            if [next_name(name, expected) for _ in generated] == generated:
+                counters = expected
+                names += outputs
+                manifest.add(plan[0], plan[1], generated, outputs, True)
+                continue
+            # the seeds of an earlier job changed in number, so this one is renumbered
+            configure(apicbase, profile)
+            raws = iter_job(task)
+        else:
+            raws = next(results)
+        (generated, outputs) = ([], [])
+        for raw in raws:
+            filename = next_name(name, counters)
+            with profiler.measure('writer.add'):
+                if writer.add(filename, raw):
+                    outputs.append(filename)
+            generated.append(filename)
+        names += generated
+        if manifest:
+            manifest.add(plan[0], plan[1], generated, outputs)
+    if pool:
+        pool.close()
+        pool.join()
+    return names
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', type = str, dest = 'path', required = True, metavar = '/path/to/seed/folder', help = 'Where to save the seeds')
+    parser.add_argument('-p', action = 'store_true', default = False, help = 'save the seeds into a single seed pack at the -o path')
+    parser.add_argument('-d', action = 'store_true', default = False, help = 'delta-encode similar seeds in the seed pack')
+    parser.add_argument('-z', choices = sorted(CODECS), dest = 'codec', help = 'compress every seed with this codec')
+    parser.add_argument('-l', type = int, dest = 'level', choices = range(10), default = COMPRESS_LEVEL, help = 'compression level, from 1 (fastest) to 9 (smallest)')
+    parser.add_argument('-j', type = int, dest = 'jobs', default = multiprocessing.cpu_count(), help = 'number of worker processes')
+    parser.add_argument('-f', nargs = '+', dest = 'families', choices = FAMILIES, default = FAMILIES, help = 'seed families to build')
+    parser.add_argument('-S', nargs = '+', dest = 'specs', default = (), metavar = 'spec', help = 'also build the seeds of these spec files (or names of specs in specs/)')
+    parser.add_argument('-i', type = str, dest = 'hyperseed', metavar = '/path/to/seed.bin', help = 'Input generated by hyperseed.exe (for hypercall seeds)')
+    parser.add_argument('-b', type = lambda b: int(b, 0), dest = 'base', default = 0xFEE00000, help = 'APIC base address')
+    parser.add_argument('-s', type = int, dest = 'seed', default = 0, help = 'RNG seed')
+    parser.add_argument('--dedup', choices = ('skip', 'link'), help = 'skip duplicate seeds or link them to the first copy')
+    parser.add_argument('--hash-index', type = str, dest = 'index', metavar = '/path/to/hashes.txt', help = 'persistent content hash index used by --dedup')
+    parser.add_argument('--validate', action = 'store_true', default = False, help = 'drop seeds that fail the consistency checks')
+    parser.add_argument('--manifest', type = str, metavar = '/path/to/manifest.json', help = 'build manifest of an incremental folder build: only stale seeds are regenerated, and unchanged files are left untouched')
+    parser.add_argument('--profile', type = str, metavar = '/path/to/profile.json', help = 'count and time the state operations per generator and save them as JSON (or CSV for a .csv path)')
+    parser.add_argument('--ignore', nargs = '+', default = (), choices = [field_info[0] for field_info in RegFile._fields_], help = 'registers ignored when comparing seeds')
+    args = parser.parse_args()
+    # ensure an output directory is provided
+    if not args.p and not os.path.isdir(args.path):
+        print '%s must be a directory' % args.path
+        sys.exit(0)
+    if args.p and args.manifest:
+        print 'incremental builds (--manifest) require a folder'
+        sys.exit(0)
+    # enumerate (and check) the jobs before any output is created
+    jobs = build_jobs(args.families, args.hyperseed, seedspec.spec_paths(args.specs))
+    manifest = None
+    if args.manifest:
+        # the settings that change the content or the set of the written seeds
+        config = {'apicbase': args.base, 'codec': args.codec, 'level': args.level, 'dedup': args.dedup,
+                  'ignore': sorted(args.ignore), 'validate': args.validate}
+        # a build of some families or specs leaves the seeds of the others alone
+        groups = set(family for family in args.families if family != 'hypercall' or args.hyperseed)
+        groups.update(os.path.abspath(path) for path in seedspec.spec_paths(args.specs))
+        manifest = BuildManifest(args.manifest, config, groups)
+    folder = None if args.p else DirectoryWriter(args.path, args.codec, args.level, update = bool(manifest))
+    writer = SeedPackWriter(args.path, args.d, args.codec, args.level) if args.p else folder
+    if args.dedup:
+        writer = DedupWriter(writer, args.index, args.ignore, args.dedup == 'link')
+    dedup = writer
+    if args.validate:
+        writer = ValidatingWriter(writer)
+    with writer:
+        names = build(writer, jobs, args.jobs, args.seed, args.base, bool(args.profile), manifest, args.path)
+    if args.profile:
+        profiler.export(args.profile)
+    if manifest:
+        removed = manifest.removed()
+        for name in removed:
+            if os.path.exists(os.path.join(args.path, name)):
+                os.unlink(os.path.join(args.path, name))
+        manifest.save()
+        print '%d seeds regenerated (%d unchanged), %d up to date, %d removed' % (folder.written + folder.unchanged, folder.unchanged,
+                                                                               manifest.reused, len(removed))
+    rejected = writer.rejected if args.validate else 0
+    if args.dedup:
+        print '%d seeds written to %s (%d duplicates, %d invalid)' % (len(names) - dedup.duplicates - rejected, args.path, dedup.duplicates, rejected)
+    else:
+        print '%d seeds written to %s (%d invalid)' % (len(names) - rejected, args.path, rejected)
@@ -31,9 +31,33 @@ class HYPERSEED_CORPUS(Structure):
 
 assert sizeof(HYPERSEED_CORPUS) == 26
 
-def generate_seeds(seedfile):
-    states = []
+@cached_state
+def init_state():
+    state = VMState(0x86)
+    state.setup_gdt()
+    return state
+
+def index_seeds(seedfile):
+    '''
+    Yield the file offset of every hypercall payload without decoding it.
+    '''
     while True:
+        offset = seedfile.tell()
+        buf = seedfile.read(sizeof(HYPERSEED_CORPUS))
+        if len(buf) != sizeof(HYPERSEED_CORPUS):
+            assert not buf
+            break
+        corpus = HYPERSEED_CORPUS.from_buffer(bytearray(buf))
+        seedfile.seek(corpus.InputSize, os.SEEK_CUR)
+        yield offset
+
+def generate_seeds(seedfile, count = None):
+    '''
+    Lazily generate one VM state per hypercall payload (at most count).
+    '''
+    while count is None or count > 0:
+        if count is not None:
+            count -= 1
         # get one hypercall payload from the seedfile
         buf = seedfile.read(sizeof(HYPERSEED_CORPUS))
         if len(buf) != sizeof(HYPERSEED_CORPUS):
@@ -48,27 +72,24 @@ def generate_seeds(seedfile):
         assert len(rawinput) == corpus.InputSize
         assert len(rawinput) <= 0x1000
         # initialize the VM state
-        state = VMState(0x86)
-        state.setup_gdt()
+        state = init_state()
         # inject vmcall + int3
         code = '\x0f\x01\xc1' + '\xcc'
-        state.regs.rip.value = state.memory.allocate(len(code))
+        state.regs.rip.value = state.memory.allocate(len(code), 1, 'code')
         state.memory.write(state.regs.rip.value, code)
         # setup vmcall parameters
         state.regs.rax.value, state.regs.rdx.value = struct.unpack('<II', buffer(control))
         addr = state.memory.allocate(0, 8)
         if len(rawinput) + (addr & 0xfff) > 0x1000:
-            addr = state.memory.allocate(len(rawinput), 0x1000)
+            addr = state.memory.allocate(len(rawinput), 0x1000, 'hc_input')
         else:
-            addr = state.memory.allocate(len(rawinput), 8)
+            addr = state.memory.allocate(len(rawinput), 8, 'hc_input')
         assert addr < 0xffffffff
         state.memory.write(addr, rawinput)
         # make input/output GPA point to the same address
         state.regs.rcx.value = addr
         state.regs.rsi.value = addr
-        # save the state
-        states.append(state)
-    return states
+        yield state
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -80,8 +101,6 @@ if __name__ == '__main__':
         print '%s must be a directory' % args.path
         sys.exit(0)
     # generate the VM states
-    states = generate_seeds(args.i)
-    for i in range(len(states)):
-        state = states[i]
+    for (i, state) in enumerate(generate_seeds(args.i)):
         with open('%s/hc%06d.bin' % (args.path, i), 'wb') as f:
-            f.write(state.raw())
+            state.write_to(f)
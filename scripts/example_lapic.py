@@ -20,112 +20,92 @@ WRITEOFF = (0x20, 0x80, 0xb0, 0xd0, 0xd3, 0xe0, 0xe3, 0xf0, 0x280, 0x300,
 
 rand32 = lambda: random.randint(0, 0xffffffff)
 
+@cached_state
 def init_state():
     state = VMState(0x86)
     state.setup_gdt()
-    addr = state.memory.allocate(64)
+    addr = state.memory.allocate(64, 1, 'stack')
     state.regs.rsp.value = addr + 64
     state.regs.rcx.value = 1 # loop once for string instructions
     return state
 
 def load(state, code):
     code += '\xcc' * 16 # append an INT3 ladder to stop
-    addr = state.memory.allocate(len(code))
+    addr = state.memory.allocate(len(code), 1, 'code')
     state.memory.write(addr, code)
     state.regs.rip.value = addr
     return state
 
 def alu_write(opcode):
-    states = []
     for off in WRITEOFF:
         state = init_state()
         state.regs.rax.value = APICBASE + off
         state.regs.rbx.value = rand32()
-        states.append(load(state, struct.pack('<BB', opcode, 0x18)))
-    return states
+        yield load(state, struct.pack('<BB', opcode, 0x18))
 
 def alu_read(opcode):
-    states = []
     for off in READOFF:
         state = init_state()
         state.regs.rax.value = APICBASE + off
-        states.append(load(state, struct.pack('<BB', opcode, 0)))
-    return states
+        yield load(state, struct.pack('<BB', opcode, 0))
 
 def pushf(opcode):
-    states = []
     for off in WRITEOFF:
         state = init_state()
         state.regs.rsp.value = APICBASE + off
-        states.append(load(state, struct.pack('<B', opcode)))
-    return states
+        yield load(state, struct.pack('<B', opcode))
 
 def popf(opcode):
-    states = []
     for off in READOFF:
         state = init_state()
         state.regs.rsp.value = APICBASE + off
-        states.append(load(state, struct.pack('<B', opcode)))
-    return states
+        yield load(state, struct.pack('<B', opcode))
 
 def mov_read(opcode):
-    states = []
     for off in READOFF:
         state = init_state()
-        states.append(load(state, struct.pack('<BI', opcode, APICBASE + off)))
-    return states
+        yield load(state, struct.pack('<BI', opcode, APICBASE + off))
 
 def mov_write(opcode):
-    states = []
     for off in WRITEOFF:
         state = init_state()
         state.regs.rax.value = rand32()
-        states.append(load(state, struct.pack('<BI', opcode, APICBASE + off)))
-    return states
+        yield load(state, struct.pack('<BI', opcode, APICBASE + off))
 
 def movs(opcode):
-    states = []
     for roff in READOFF:
         for woff in WRITEOFF:
             state = init_state()
             state.regs.rsi.value = APICBASE + roff
             state.regs.rdi.value = APICBASE + woff
-            states.append(load(state, struct.pack('<B', opcode)))
-    return states
+            yield load(state, struct.pack('<B', opcode))
 
 def cmps(opcode):
-    states = []
     for off1 in READOFF:
         for off2 in READOFF:
             state = init_state()
             state.regs.rsi.value = APICBASE + off1
             state.regs.rdi.value = APICBASE + off2
-            states.append(load(state, struct.pack('<B', opcode)))
-    return states
+            yield load(state, struct.pack('<B', opcode))
 
 def stos(opcode):
-    states = []
     for off in WRITEOFF:
         state = init_state()
         state.regs.rax.value = rand32()
         state.regs.rdi.value = APICBASE + off
-        states.append(load(state, struct.pack('<B', opcode)))
-    return states
+        yield load(state, struct.pack('<B', opcode))
 
 def loads(opcode):
-    states = []
     for off in READOFF:
+        state = init_state()
         state.regs.rsi.value = APICBASE + off
-        states.append(load(state, struct.pack('<B', opcode)))
-    return states
+        yield load(state, struct.pack('<B', opcode))
 
 def scas(opcode):
-    states = []
     for off in WRITEOFF:
         state = init_state()
         state.regs.rdi.value = APICBASE + off
-        states.append(load(state, struct.pack('<B', opcode)))
-    return states
+        yield load(state, struct.pack('<B', opcode))
 
 OPCODES = [(0x00, alu_write), # MOV EAX, TARGET; MOV EBX, VALUE; ADD  [EAX], BL
            (0x01, alu_write), # MOV EAX, TARGET; MOV EBX, VALUE; ADD  [EAX], EBX
@@ -202,4 +182,4 @@ if __name__ == '__main__':
         for state in func(opcode):
             index += 1
             with open('%s/apic%04d.bin' % (args.path, index), 'wb') as f:
-                f.write(state.raw())
+                state.write_to(f)
@@ -7,7 +7,7 @@ def create_state(is_write):
     state = VMState(0x86)
     state.setup_gdt()
     code = '\x0F\x30\xCC' if is_write else '\x0F\x32\xCC'
-    addr = state.memory.allocate(len(code))
+    addr = state.memory.allocate(len(code), 1, 'code')
     state.memory.write(addr, code)
     state.regs.rip.value = addr
     return state
@@ -27,5 +27,5 @@ if __name__ == '__main__':
     if not args.o:
         state.dump(True, False)
     else:
-        args.o.write(state.raw())
+        state.write_to(args.o)
 
@@ -2,18 +2,23 @@ from vmstate import *
 
 CODE = '\x9d\xcc' # POPF; INT3
 
-# init real-mode machine
-state = VMState(0x86)
-state.setup_real()
-# allocate stack
-stack = state.memory.allocate(8)
-state.regs.rsp.value = stack + 4
-# inject POPF
-addr = state.memory.allocate(len(CODE))
-state.memory.write(addr, CODE) # POPF
-state.regs.rip.value = addr
-# write the state out
-if len(sys.argv) < 2:
-    state.dump(True, False)
-else:
-    open(sys.argv[1], 'wb').write(state.raw())
+def create_state():
+    # init real-mode machine
+    state = VMState(0x86)
+    state.setup_real()
+    # allocate stack
+    stack = state.memory.allocate(8, 1, 'stack')
+    state.regs.rsp.value = stack + 4
+    # inject POPF
+    addr = state.memory.allocate(len(CODE), 1, 'code')
+    state.memory.write(addr, CODE) # POPF
+    state.regs.rip.value = addr
+    return state
+
+if __name__ == '__main__':
+    state = create_state()
+    # write the state out
+    if len(sys.argv) < 2:
+        state.dump(True, False)
+    else:
+        state.write_to(open(sys.argv[1], 'wb'))
@@ -3,6 +3,7 @@ import struct
 from vmstate import *
 import argparse
 
+@cached_state
 def init_state():
     state = VMState(0x64)
     state.setup_paging() # IA-32e requires paging on
@@ -22,33 +23,33 @@ def init_state():
 
 def setup_stack(state):
     # allocate memory for the stack
-    addr = state.memory.allocate(0x100, 8)
+    addr = state.memory.allocate(0x100, 8, 'stack')
     # init user-mode stack pointer
     state.regs.rsp.value = addr + 0x80
     # init kernel-mode stack pointer
-    TSS64.from_buffer(state.memory, state.regs.tr.base).rsp0 = addr + 0x80
+    state.tss.rsp0 = addr + 0x80
 
 def callgate():
     state = init_state()
     # append an empty call gate
-    callgate_addr = state.memory.allocate(sizeof(CallGateDesc64))
+    callgate_addr = state.memory.allocate(sizeof(CallGateDesc64), 1, 'gdt', CallGateDesc64)
     callgate_selector = callgate_addr - state.regs.gdtr.base
     state.regs.gdtr.limit += sizeof(CallGateDesc64)
     # setup the stack for both user and kernel mode
     setup_stack(state)
     # make user code segment 32-bit (0x10)
-    desc = SegDesc32.from_buffer(state.memory, state.regs.gdtr.base + 0x10)
+    desc = state.gdt[0x10]
     desc.l = 0 # disable long mode
     desc.db = 1 # enable 32-bit
     state.load_seg(state.regs.cs, 0x10 | 3)
     # inject user-mode far call
     farcall = '\x9a\x00\x00\x00\x00%s' % struct.pack('<H', callgate_selector)
-    addr = state.memory.allocate(len(farcall))
+    addr = state.memory.allocate(len(farcall), 1, 'code')
     state.memory.write(addr, farcall)
     state.regs.rip.value = addr
     # inject kernel-mode int3 ladder to triple fault
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     # update call gate descriptor
     state.memory.write(callgate_addr, bytearray(CallGateDesc64(addr, 0x8, 0, 3, 1)))
@@ -57,18 +58,18 @@ def callgate():
 def sysenter():
     state = init_state()
     # make user code segment 16-bit (0x10)
-    desc = SegDesc32.from_buffer(state.memory, state.regs.gdtr.base + 0x10)
+    desc = state.gdt[0x10]
     desc.l = 0 # disable long mode
     desc.db = 0 # disable 32-bit
     state.load_seg(state.regs.cs, 0x10 | 3)
     # inject sysenter
     sysenter = '\x0f\x34'
-    addr = state.memory.allocate(len(sysenter))
+    addr = state.memory.allocate(len(sysenter), 1, 'code')
     state.memory.write(addr, sysenter)
     state.regs.rip.value = addr
     # inject int3 ladder to triple fault
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     # update sysenter MSRs
     state.regs.sysentercs.value = 0x8 # kernel CS descriptor
@@ -78,10 +79,10 @@ def sysenter():
 def syscall():
     state = init_state()
     # append a new pair of KT/KD to the GDT
-    kt_addr = state.memory.allocate(sizeof(SegDesc32))
+    kt_addr = state.memory.allocate(sizeof(SegDesc32), 1, 'gdt', SegDesc32)
     kt_sel = kt_addr - state.regs.gdtr.base
     state.memory.write(kt_addr, bytearray(SegDesc32(0, 0xfffff, 0b1011, 1, 0, 1, 0, 1, 0, 1)))
-    kd_addr = state.memory.allocate(sizeof(SegDesc32))
+    kd_addr = state.memory.allocate(sizeof(SegDesc32), 1, 'gdt', SegDesc32)
     kd_sel = kd_addr - state.regs.gdtr.base
     state.memory.write(kd_addr, bytearray(SegDesc32(0, 0xfffff, 0b0011, 1, 0, 1, 0, 0, 1, 1)))
     state.regs.gdtr.limit += 2 * sizeof(SegDesc32)
@@ -89,12 +90,12 @@ def syscall():
     state.regs.star.value = (kt_sel << 32)
     # inject syscall
     syscall = '\x0F\x05'
-    addr = state.memory.allocate(len(syscall))
+    addr = state.memory.allocate(len(syscall), 1, 'code')
     state.memory.write(addr, syscall)
     state.regs.rip.value = addr
     # inject int3 ladder in kernel
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     # setup IA32_LSTAR
     state.regs.lstar.value = addr
@@ -107,19 +108,19 @@ def popfs():
     state.memory.write(state.regs.rsp.value, '\x23\x00\x00\x00')
     # inject "pop fs"
     pop_fs = '\x0F\xA1'
-    addr = state.memory.allocate(len(pop_fs))
+    addr = state.memory.allocate(len(pop_fs), 1, 'code')
     state.memory.write(addr, pop_fs)
     state.regs.rip.value = addr
     # inject int3 ladder
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     return state
 
 def popss():
     state = init_state()
     # pop ss can only be executed in 32-bit environment
-    desc = SegDesc32.from_buffer(state.memory, state.regs.gdtr.base + 0x10)
+    desc = state.gdt[0x10]
     desc.l = 0 # disable long mode
     desc.db = 1 # enable 32-bit
     state.load_seg(state.regs.cs, 0x10 | 3)
@@ -128,30 +129,30 @@ def popss():
     state.memory.write(state.regs.rsp.value, '\x23\x00\x00\x00')
     # inject "pop ss"
     pop_ss = '\x17'
-    addr = state.memory.allocate(len(pop_ss))
+    addr = state.memory.allocate(len(pop_ss), 1, 'code')
     state.memory.write(addr, pop_ss)
     state.regs.rip.value = addr
     # inject int3 ladder
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     return state
 
 def iret():
     state = init_state()
     # make the user code segment 32-bit
-    desc = SegDesc32.from_buffer(state.memory, state.regs.gdtr.base + 0x10)
+    desc = state.gdt[0x10]
     desc.l = 0 # disable long mode
     desc.db = 1 # enable 32-bit
     state.load_seg(state.regs.cs, 0x10 | 3)
     # inject iret
     iret = '\xCF'
-    addr = state.memory.allocate(len(iret))
+    addr = state.memory.allocate(len(iret), 1, 'code')
     state.memory.write(addr, iret)
     state.regs.rip.value = addr
     # inject int3 as the target of iret
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     # setup the stack for iret
     setup_stack(state)
@@ -161,18 +162,18 @@ def iret():
 def retf():
     state = init_state()
     # make the user code segment 32-bit
-    desc = SegDesc32.from_buffer(state.memory, state.regs.gdtr.base + 0x10)
+    desc = state.gdt[0x10]
     desc.l = 0 # disable long mode
     desc.db = 1 # enable 32-bit
     state.load_seg(state.regs.cs, 0x10 | 3)
     # inject iret
     retf = '\xCB'
-    addr = state.memory.allocate(len(retf))
+    addr = state.memory.allocate(len(retf), 1, 'code')
     state.memory.write(addr, retf)
     state.regs.rip.value = addr
     # inject int3 as the target of iret
     int3 = '\xcc' * 16
-    addr = state.memory.allocate(len(int3))
+    addr = state.memory.allocate(len(int3), 1, 'code')
     state.memory.write(addr, int3)
     # setup the stack for iret
     setup_stack(state)
@@ -188,4 +189,4 @@ if __name__ == '__main__':
     if not args.o:
         state.dump(True, False)
     else:
-        args.o.write(state.raw())
+        state.write_to(args.o)
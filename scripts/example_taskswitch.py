@@ -3,6 +3,7 @@ import struct
 import argparse
 from vmstate import *
 
+@cached_state
 def create_vm():
     state = VMState(0x86)
     state.setup_gdt()
@@ -12,7 +13,7 @@ def setup_idt(state, dst_tss_sel):
     idt = [TaskGateDesc32(dst_tss_sel, 0, 0) if _ != 0x20 else TaskGateDesc32(dst_tss_sel, 0, 1) for _ in range(0x30)]
     raw = ''.join([str(bytearray(gate)) for gate in idt])
     idt_size = len(raw)
-    idt_addr = state.memory.allocate(idt_size, 8)
+    idt_addr = state.memory.allocate(idt_size, 8, 'idt')
     state.memory.write(idt_addr, raw)
     state.regs.idtr.base = idt_addr
     state.regs.idtr.limit = idt_size - 1
@@ -21,18 +22,15 @@ def main(trigger, same_task = False):
     state = create_vm()
     # obtain the source TSS
     src_tss_sel = 0x28
-    src_tss_desc = lambda: TssDesc32.from_buffer(state.memory, state.regs.gdtr.base + src_tss_sel)
-    src_tss_addr = src_tss_desc().base()
-    src_tss = lambda: TSS32.from_buffer(state.memory, src_tss_addr)
+    src_tss_addr = state.gdt[src_tss_sel].base()
     if same_task:
         dst_tss_sel = src_tss_sel
         dst_tss_addr = src_tss_addr
     else:
         # repurpose UT (0x10) for the destination TSS desc
         dst_tss_sel = 0x10
-        dst_tss_addr = state.memory.allocate(sizeof(TSS32))
-        pointer(TssDesc32.from_buffer(state.memory, state.regs.gdtr.base + 0x10))[0] = TssDesc32(dst_tss_addr, sizeof(TSS32) - 1, 0, 0, 1, 0, 0)
-    dst_tss_desc = lambda: TssDesc32.from_buffer(state.memory, state.regs.gdtr.base + dst_tss_sel)
+        dst_tss_addr = state.memory.allocate(sizeof(TSS32), 1, 'tss', TSS32)
+        state.gdt[0x10] = TssDesc32(dst_tss_addr, sizeof(TSS32) - 1, 0, 0, 1, 0, 0)
     dst_tss = lambda: TSS32.from_buffer(state.memory, dst_tss_addr)
     # setup the minimal destination TSS
     dst_tss().cs = state.regs.cs.selector
@@ -41,8 +39,8 @@ def main(trigger, same_task = False):
     # prepare the rest of the state accordingly
     if trigger == 'iret':
         state.regs.eflags.NT = 1
-        src_tss().prev_task_link = dst_tss_sel
-        dst_tss_desc().type = 0b1011
+        state.tss.prev_task_link = dst_tss_sel
+        state.gdt[dst_tss_sel].type = 0b1011
         code = '\xcf' # IRET
     elif trigger == 'jmp':
         code ='\xea\x00\x00\x00\x00' + struct.pack('<H', dst_tss_sel)
@@ -52,11 +50,11 @@ def main(trigger, same_task = False):
         setup_idt(state, dst_tss_sel)
         code = '\xcd\x20'
     # write the code bytes and set the EIP
-    eip = state.memory.allocate(len(code))
+    eip = state.memory.allocate(len(code), 1, 'code')
     state.memory.write(eip, code)
     state.regs.rip.value = eip
     # allocate halt instruction
-    halt = state.memory.allocate(1)
+    halt = state.memory.allocate(1, 1, 'code')
     state.memory.write(halt, '\xcc')
     dst_tss().eip = halt
     return state
@@ -73,4 +71,4 @@ if __name__ == '__main__':
     if not args.o:
         state.dump(True, False)
     else:
-        args.o.write(state.raw())
+        state.write_to(args.o)
@@ -4,15 +4,15 @@ from vmstate import *
 def create_state():
     state = VMState(0x86)
     state.setup_paging()
-    vmxon_region = state.memory.allocate(PGSIZE, PGSIZE)
+    vmxon_region = state.memory.allocate(PGSIZE, PGSIZE, 'vmxon')
     state.memory.write(vmxon_region, '\x01')
     state.setup_gdt()
-    addr = state.memory.allocate(8)
+    addr = state.memory.allocate(8, 1, 'vmxon_ptr')
     state.memory.write(addr, struct.pack('<Q', vmxon_region))
     code = "\xF3\x0F\xC7\x35" + struct.pack('<I', addr)
     state.regs.cr4.VMXE = 1
     state.regs.cr0.NE = 1
-    state.regs.rip.value = state.memory.allocate(len(code))
+    state.regs.rip.value = state.memory.allocate(len(code), 1, 'code')
     state.memory.write(state.regs.rip.value, code)
     return state
 
@@ -24,4 +24,4 @@ if __name__ == '__main__':
     if not args.o:
         state.dump(True, False)
     else:
-        args.o.write(state.raw())
\ No newline at end of file
+        state.write_to(args.o)
\ No newline at end of file
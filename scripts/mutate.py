@@ -0,0 +1,166 @@
+import sys
+import argparse
+import numpy as np
+from vmstate import *
+from regarray import REG_DTYPE, is_bitfield, scalar_struct
+
+REG_STRATEGIES = ('random', 'bitflip', 'interesting')
+MEM_STRATEGIES = ('bitflip', 'havoc')
+
+INTERESTING = (0, 1, 0x7f, 0x80, 0xff, 0x7fff, 0x8000, 0xffff, 0x7fffffff, 0x80000000, 0xffffffff,
+               0x7fffffffffffffff, 0x8000000000000000, 0xffffffffffffffff)
+
+def field_bits(cls, names):
+    '''
+    Collect the bit mask covered by the given bit fields of cls.
+    '''
+    mask = 0
+    for name in names:
+        desc = getattr(cls, name)
+        mask |= ((1 << (desc.size >> 16)) - 1) << (desc.size & 0xffff)
+    return mask
+
+def leaves(fields = None):
+    '''
+    Enumerate the mutable integers of the register file as (path, mask,
+    fixed) tuples. Bits of 'rsvd*' fields are excluded from mask, and bits
+    of fields that must be one (RegEflags.one) are set in fixed.
+    '''
+    ans = []
+    for (name, cls) in RegFile._fields_:
+        if fields is not None and name not in fields:
+            continue
+        if scalar_struct(cls):
+            subs = [field_info[0] for field_info in cls._fields_]
+            if is_bitfield(getattr(cls, subs[0])):
+                mask = field_bits(cls, [sub for sub in subs if not sub.startswith('rsvd') and sub != 'one'])
+                fixed = field_bits(cls, [sub for sub in subs if sub == 'one'])
+            else:
+                (mask, fixed) = ((1 << (8 * sizeof(cls))) - 1, 0)
+            ans.append(((name,), mask, fixed))
+            continue
+        bitfields = [field_info[0] for field_info in cls._fields_ if is_bitfield(getattr(cls, field_info[0]))]
+        for field_info in cls._fields_:
+            if field_info[0] not in bitfields:
+                ans.append(((name, field_info[0]), (1 << (8 * sizeof(field_info[1]))) - 1, 0))
+        if bitfields:
+            mask = field_bits(cls, [sub for sub in bitfields if not sub.startswith('rsvd')])
+            ans.append(((name, 'attributes'), mask, 0))
+    return ans
+
+class BatchMutator(object):
+    '''
+    Produce variants of a base VM state in vectorized batches. Every variant
+    gets one register integer mutated with one of the register strategies
+    and, if memory ranges are given, a few bits or bytes in those ranges
+    mutated with one of the memory strategies.
+    '''
+    def __init__(self, base, fields = None, ranges = (), reg_strategies = REG_STRATEGIES,
+                 mem_strategies = MEM_STRATEGIES, flips = 4, seed = None):
+        memory = base.memory.flatten() if isinstance(base.memory, SparseMemory) else base.memory
+        self.regs = np.frombuffer(str(bytearray(base.regs)), REG_DTYPE)
+        self.memory = np.frombuffer(str(memory.read(0, len(memory))), np.uint8)
+        self.leaves = leaves(fields)
+        self.ranges = [(addr, size) for (addr, size) in ranges if size > 0]
+        for (addr, size) in self.ranges:
+            assert addr + size <= len(self.memory), 'Memory range %x+%x is out of bounds' % (addr, size)
+        self.reg_strategies = reg_strategies
+        self.mem_strategies = mem_strategies
+        self.flips = flips
+        self.rng = np.random.RandomState(seed)
+
+    def mutate_leaf(self, values, mask, fixed):
+        '''
+        Mutate an array of integers in place, keeping the bits outside mask
+        and forcing the fixed bits.
+        '''
+        dtype = values.dtype.type
+        bits = 8 * values.dtype.itemsize
+        strategy = self.rng.randint(len(self.reg_strategies), size = len(values))
+        mutated = values.copy()
+        for (i, name) in enumerate(self.reg_strategies):
+            sel = strategy == i
+            count = sel.sum()
+            if not count:
+                continue
+            if name == 'random':
+                mutated[sel] = self.rng.randint(0, 1 << 32, size = (count, 2)).astype(np.uint64).dot(np.array([1 << 32, 1], np.uint64)).astype(dtype)
+            elif name == 'bitflip':
+                positions = np.array([b for b in range(bits) if (mask >> b) & 1], np.uint64)
+                if len(positions):
+                    mutated[sel] ^= np.left_shift(np.uint64(1), self.rng.choice(positions, size = count)).astype(dtype)
+            else:
+                choices = np.array([v & ((1 << bits) - 1) for v in INTERESTING], np.uint64)
+                mutated[sel] = self.rng.choice(choices, size = count).astype(dtype)
+        keep = dtype(((1 << bits) - 1) ^ mask)
+        values[:] = (values & keep) | (mutated & dtype(mask)) | dtype(fixed)
+
+    def mutate_memory(self, memory):
+        '''
+        Mutate each row of a (variants x memory size) array in place.
+        '''
+        (count, size) = memory.shape
+        # pick a range per variant, then the byte offsets inside it
+        ranges = np.array(self.ranges, np.int64)
+        picked = ranges[self.rng.randint(len(ranges), size = count)]
+        offsets = picked[:, :1] + (self.rng.random_sample((count, self.flips)) * picked[:, 1:]).astype(np.int64)
+        rows = np.arange(count)[:, None]
+        strategy = self.rng.randint(len(self.mem_strategies), size = count)
+        for (i, name) in enumerate(self.mem_strategies):
+            sel = strategy == i
+            if not sel.any():
+                continue
+            if name == 'bitflip':
+                memory[rows[sel], offsets[sel]] ^= np.left_shift(np.uint8(1), self.rng.randint(8, size = offsets[sel].shape).astype(np.uint8))
+            else:
+                memory[rows[sel], offsets[sel]] = self.rng.randint(256, size = offsets[sel].shape).astype(np.uint8)
+
+    def mutate(self, count):
+        '''
+        Return (regs, memory) arrays holding count new variants.
+        '''
+        regs = np.repeat(self.regs, count)
+        leaf = self.rng.randint(len(self.leaves), size = count)
+        for (i, (path, mask, fixed)) in enumerate(self.leaves):
+            sel = np.nonzero(leaf == i)[0]
+            if not len(sel):
+                continue
+            container = regs
+            for member in path[:-1]:
+                container = container[member]
+            values = container[path[-1]][sel]
+            self.mutate_leaf(values, mask, fixed)
+            container[path[-1]][sel] = values
+        memory = np.tile(self.memory, (count, 1))
+        if self.ranges and self.mem_strategies:
+            self.mutate_memory(memory)
+        return (regs, memory)
+
+    def generate(self, writer, count, batch = 4096, prefix = 'mut'):
+        '''
+        Stream count variants into a SeedPackWriter, one batch at a time.
+        '''
+        for start in range(0, count, batch):
+            n = min(batch, count - start)
+            (regs, memory) = self.mutate(n)
+            block = np.concatenate([regs.view(np.uint8).reshape(n, -1), memory], axis = 1)
+            names = ['%s%08d.bin' % (prefix, start + i) for i in range(n)]
+            writer.add_batch(names, block.tobytes(), block.shape[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('seed', metavar = '/path/to/seed.bin', help = 'the base VM state')
+    parser.add_argument('-o', type = str, dest = 'path', required = True, metavar = '/path/to/variants.pack', help = 'the seed pack to create')
+    parser.add_argument('-n', type = int, dest = 'count', default = 1000, help = 'number of variants')
+    parser.add_argument('-f', nargs = '+', dest = 'fields', choices = [field_info[0] for field_info in RegFile._fields_], help = 'registers to mutate (default: all)')
+    parser.add_argument('-r', nargs = '+', dest = 'ranges', type = parse_range, default = (), metavar = 'addr:size', help = 'memory ranges to mutate')
+    parser.add_argument('--regions', nargs = '+', default = (), metavar = 'name', help = 'memory regions to mutate by name (e.g., code stack), from the region map saved with the seed')
+    parser.add_argument('-m', nargs = '+', dest = 'strategies', choices = MEM_STRATEGIES, default = MEM_STRATEGIES, help = 'memory mutation strategies')
+    parser.add_argument('-s', type = int, dest = 'rngseed', help = 'RNG seed')
+    args = parser.parse_args()
+    base = VMState.load(args.seed)
+    ranges = list(args.ranges) + [(start, end - start) for (start, end, name, cls) in base.memory.regions.named(*args.regions)]
+    mutator = BatchMutator(base, args.fields, ranges, mem_strategies = args.strategies, seed = args.rngseed)
+    with SeedPackWriter(args.path) as writer:
+        mutator.generate(writer, args.count)
+    print '%d variants written to %s' % (args.count, args.path)
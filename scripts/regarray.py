@@ -0,0 +1,144 @@
+import os
+import sys
+import argparse
+import numpy as np
+from vmstate import *
+
+NP_TYPES = {1: 'u1', 2: '<u2', 4: '<u4', 8: '<u8'}
+
+def is_bitfield(desc):
+    # ctypes encodes bit fields as (width << 16) | bit offset
+    return (desc.size >> 16) != 0
+
+def scalar_struct(cls):
+    '''
+    Check whether a register structure is a single integer (e.g. Reg64 or
+    a pure bit-field register like RegCr4).
+    '''
+    descs = [getattr(cls, field_info[0]) for field_info in cls._fields_]
+    return len(descs) == 1 or all(is_bitfield(desc) and desc.offset == 0 for desc in descs)
+
+def make_dtype(cls):
+    '''
+    Mirror the packed layout of a ctypes structure as a NumPy dtype. Single
+    integer registers become scalars, and the bit fields sharing a storage
+    unit (e.g. the segment attributes) become one 'attributes' member.
+    '''
+    if scalar_struct(cls):
+        return np.dtype(NP_TYPES[sizeof(cls)])
+    (names, formats, offsets) = ([], [], [])
+    for field_info in cls._fields_:
+        desc = getattr(cls, field_info[0])
+        if is_bitfield(desc):
+            if desc.offset in offsets:
+                continue
+            names.append('attributes')
+            formats.append(NP_TYPES[sizeof(field_info[1])])
+        else:
+            names.append(field_info[0])
+            formats.append(make_dtype(field_info[1]) if issubclass(field_info[1], Structure) else NP_TYPES[sizeof(field_info[1])])
+        offsets.append(desc.offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': sizeof(cls)})
+
+REG_DTYPE = make_dtype(RegFile)
+
+assert REG_DTYPE.itemsize == sizeof(RegFile)
+
+def resolve(name):
+    '''
+    Resolve 'reg' or 'reg.field' (e.g. 'rax', 'cs.base', 'cr4.SMEP') to the
+    dtype member path plus the bit shift and mask (None for whole fields).
+    '''
+    parts = name.split('.')
+    cls = dict(RegFile._fields_)[parts[0]]
+    if len(parts) == 1:
+        return ((parts[0],), None, None)
+    desc = getattr(cls, parts[1])
+    if not is_bitfield(desc):
+        return ((parts[0], parts[1]), None, None)
+    path = (parts[0],) if scalar_struct(cls) else (parts[0], 'attributes')
+    return (path, desc.size & 0xffff, (1 << (desc.size >> 16)) - 1)
+
+def get(regs, name):
+    '''
+    Return the values of a register or register field across the array.
+    '''
+    (path, shift, mask) = resolve(name)
+    values = regs
+    for member in path:
+        values = values[member]
+    if shift is None:
+        return values
+    return (values >> shift) & mask
+
+def put(regs, name, values):
+    '''
+    Store values into a register or register field across the array.
+    '''
+    (path, shift, mask) = resolve(name)
+    container = regs
+    for member in path[:-1]:
+        container = container[member]
+    if shift is None:
+        container[path[-1]] = values
+    else:
+        old = container[path[-1]]
+        dtype = old.dtype.type
+        clear = dtype(((1 << (8 * old.dtype.itemsize)) - 1) ^ (mask << shift))
+        container[path[-1]] = (old & clear) | ((np.asarray(values).astype(dtype) & dtype(mask)) << dtype(shift))
+
+def regs_of(raw):
+    '''
+    Extract the register file bytes from a raw (dense or sparse) state.
+    '''
+    offset = len(SPARSE_MAGIC) if raw[:len(SPARSE_MAGIC)] == SPARSE_MAGIC else 0
+    return str(raw[offset:offset + sizeof(RegFile)])
+
+def load_regs(paths):
+    '''
+    Read the register files of many seed files into one array.
+    '''
+    chunks = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            head = f.read(len(SPARSE_MAGIC) + sizeof(RegFile))
+            if head[:len(COMPRESSED_MAGIC)] == COMPRESSED_MAGIC:
+                head = decompress_seed(head + f.read())
+            chunks.append(regs_of(head))
+    return np.frombuffer(''.join(chunks), REG_DTYPE).copy()
+
+def load_pack_regs(seeds):
+    '''
+    Read the register files of every seed in a SeedPack into one array.
+    '''
+    chunks = []
+    for (name, offset, size) in seeds.entries:
+        head = seeds.buf[offset:offset + len(DELTA_MAGIC)]
+        if head in (DELTA_MAGIC, COMPRESSED_MAGIC):
+            chunks.append(regs_of(seeds.raw(name)))
+        else:
+            chunks.append(regs_of(seeds.buf[offset:offset + len(SPARSE_MAGIC) + sizeof(RegFile)]))
+    return np.frombuffer(''.join(chunks), REG_DTYPE).copy()
+
+def load(path):
+    '''
+    Load the register files of a seed folder or a seed pack.
+    '''
+    if os.path.isdir(path):
+        return load_regs(seed_files(path))
+    with open(path, 'rb') as f:
+        if f.read(len(PACK_MAGIC)) == PACK_MAGIC:
+            return load_pack_regs(SeedPack.open(path))
+    return load_regs([path])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', metavar = '/path/to/seeds', help = 'seed folder, seed pack or seed file')
+    parser.add_argument('conditions', nargs = '*', metavar = 'reg[.field]=value', help = 'e.g., cr4.SMEP=1 cs.l=1')
+    args = parser.parse_args()
+    regs = load(args.path)
+    selected = np.ones(len(regs), bool)
+    for condition in args.conditions:
+        (name, value) = condition.split('=')
+        selected &= get(regs, name) == int(value, 0)
+    print '%d of %d seeds match' % (selected.sum(), len(regs))
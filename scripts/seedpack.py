@@ -0,0 +1,64 @@
+import os
+import sys
+import argparse
+from vmstate import *
+
+def pack(output, inputs, delta = False, codec = None, level = COMPRESS_LEVEL):
+    '''
+    Pack seed files (or every seed file in the given directories, region
+    maps excluded) in name order. Compressed seed files are decompressed
+    first, so that delta encoding and the codec of the pack apply to the
+    raw states.
+    '''
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths += seed_files(path)
+        else:
+            paths.append(path)
+    with SeedPackWriter(output, delta, codec, level) as writer:
+        for path in paths:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            if raw[:len(COMPRESSED_MAGIC)] == COMPRESSED_MAGIC:
+                raw = decompress_seed(raw)
+            writer.add(os.path.basename(path), raw)
+    return len(paths)
+
+def unpack(path, output, codec = None, level = COMPRESS_LEVEL):
+    seeds = SeedPack.open(path)
+    for (name, offset, size) in seeds.entries:
+        raw = seeds.raw(name)
+        if codec:
+            raw = compress_seed(raw, codec, level)
+        with open(os.path.join(output, name), 'wb') as f:
+            f.write(raw)
+    return len(seeds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest = 'command')
+    parser_pack = subparsers.add_parser('pack', help = 'pack seed files into a seed pack')
+    parser_pack.add_argument('-o', type = str, dest = 'output', required = True, metavar = '/path/to/seeds.pack', help = 'the seed pack to create')
+    parser_pack.add_argument('-d', action = 'store_true', default = False, help = 'delta-encode similar seeds')
+    parser_pack.add_argument('-z', choices = sorted(CODECS), dest = 'codec', help = 'compress every seed with this codec')
+    parser_pack.add_argument('-l', type = int, dest = 'level', choices = range(10), default = COMPRESS_LEVEL, help = 'compression level, from 1 (fastest) to 9 (smallest)')
+    parser_pack.add_argument('inputs', nargs = '+', metavar = 'seed', help = 'seed files or folders')
+    parser_unpack = subparsers.add_parser('unpack', help = 'extract a seed pack into a folder')
+    parser_unpack.add_argument('-o', type = str, dest = 'output', required = True, metavar = '/path/to/seed/folder', help = 'where to save the seeds')
+    parser_unpack.add_argument('-z', choices = sorted(CODECS), dest = 'codec', help = 'compress every seed file with this codec')
+    parser_unpack.add_argument('-l', type = int, dest = 'level', choices = range(10), default = COMPRESS_LEVEL, help = 'compression level, from 1 (fastest) to 9 (smallest)')
+    parser_unpack.add_argument('pack', metavar = '/path/to/seeds.pack')
+    parser_list = subparsers.add_parser('list', help = 'list the seeds in a seed pack')
+    parser_list.add_argument('pack', metavar = '/path/to/seeds.pack')
+    args = parser.parse_args()
+    if args.command == 'pack':
+        print '%d seeds packed into %s' % (pack(args.output, args.inputs, args.d, args.codec, args.level), args.output)
+    elif args.command == 'unpack':
+        if not os.path.isdir(args.output):
+            print '%s must be a directory' % args.output
+            sys.exit(0)
+        print '%d seeds extracted to %s' % (unpack(args.pack, args.output, args.codec, args.level), args.output)
+    else:
+        for (name, offset, size) in SeedPack.open(args.pack).entries:
+            print '%s %d' % (name, size)
@@ -0,0 +1,298 @@
+import os
+import ast
+import sys
+import json
+import struct
+import argparse
+import operator
+import collections
+from vmstate import *
+
+# directory of the specs shipped with the scripts
+SPEC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'specs')
+
+ARCHS = {'x86': 0x86, 'x64': 0x64}
+
+# descriptor classes usable in specs
+DESC_TYPES = dict((cls.__name__, cls) for cls in (SegDesc32, TssDesc32, TssDesc64, CallGateDesc32, CallGateDesc64,
+                                                  IntGateDesc32, IntGateDesc64, TrapGateDesc32, TrapGateDesc64,
+                                                  TaskGateDesc32))
+
+# structures that can be given as the class of an allocated region
+REGION_TYPES = dict(DESC_TYPES, TSS32 = TSS32, TSS64 = TSS64)
+
+# integers that can be packed into data
+PACK_FORMATS = {'u8': '<B', 'u16': '<H', 'u32': '<I', 'u64': '<Q'}
+
+# names available to every expression besides the labels
+CONSTANTS = {'PGSIZE': PGSIZE}
+
+BINARY_OPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.FloorDiv: operator.floordiv,
+              ast.Mod: operator.mod, ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+              ast.BitOr: operator.or_, ast.BitAnd: operator.and_, ast.BitXor: operator.xor}
+UNARY_OPS = {ast.USub: operator.neg, ast.Invert: operator.invert}
+
+def constant(value):
+    func = lambda labels: value
+    func.constant = True
+    return func
+
+def is_constant(*funcs):
+    return all(getattr(func, 'constant', False) for func in funcs)
+
+def compile_expr(expr):
+    '''
+    Compile an integer or an arithmetic expression over labels (e.g.,
+    'stack + 0x80', 'kt << 32') into a function of the label dictionary.
+    Expressions without labels are evaluated once, at compile time.
+    '''
+    if isinstance(expr, (int, long)):
+        return constant(expr)
+    def visit(node):
+        if isinstance(node, ast.Num):
+            return lambda labels: node.n
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name in CONSTANTS:
+                value = CONSTANTS[name]
+                return lambda labels: value
+            def lookup(labels):
+                assert name in labels, 'Undefined label: %s' % name
+                return labels[name]
+            return lookup
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+            (op, left, right) = (BINARY_OPS[type(node.op)], visit(node.left), visit(node.right))
+            return lambda labels: op(left(labels), right(labels))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPS:
+            (op, operand) = (UNARY_OPS[type(node.op)], visit(node.operand))
+            return lambda labels: op(operand(labels))
+        raise ValueError('Unsupported expression: %s' % expr)
+    tree = ast.parse(str(expr).strip(), mode = 'eval')
+    func = visit(tree.body)
+    if all(node.id in CONSTANTS for node in ast.walk(tree) if isinstance(node, ast.Name)):
+        return constant(func({}))
+    return func
+
+def compile_desc(spec):
+    '''
+    Compile {"class": "CallGateDesc64", "offset": "int3", ...} into a
+    function returning the descriptor (fields default as in the class).
+    '''
+    assert spec['class'] in DESC_TYPES, 'Unknown descriptor class: %s' % spec['class']
+    cls = DESC_TYPES[spec['class']]
+    kwargs = [(name, compile_expr(value)) for (name, value) in spec.items() if name != 'class']
+    func = lambda labels: cls(**dict((name, value(labels)) for (name, value) in kwargs))
+    if is_constant(*[value for (name, value) in kwargs]):
+        return constant(func({}))
+    return func
+
+def compile_data(items):
+    '''
+    Compile a data list into a function returning its bytes. Items are hex
+    strings (spaces allowed), {"u8"/"u16"/"u32"/"u64": expr} integers or
+    {"desc": descriptor} descriptors. A single hex string may be given
+    instead of a list.
+    '''
+    if not isinstance(items, list):
+        items = [items]
+    parts = []
+    for item in items:
+        if isinstance(item, basestring):
+            part = constant(''.join(item.split()).decode('hex'))
+        elif 'desc' in item:
+            desc = compile_desc(item['desc'])
+            part = lambda labels, desc = desc: str(bytearray(desc(labels)))
+            if is_constant(desc):
+                part = constant(part({}))
+        else:
+            (kind, expr) = item.items()[0]
+            assert kind in PACK_FORMATS, 'Unknown data item: %s' % kind
+            (fmt, value) = (PACK_FORMATS[kind], compile_expr(expr))
+            part = lambda labels, fmt = fmt, value = value: struct.pack(fmt, value(labels))
+            if is_constant(value):
+                part = constant(part({}))
+        parts.append(part)
+    func = lambda labels: ''.join([part(labels) for part in parts])
+    if is_constant(*parts):
+        return constant(func({}))
+    return func
+
+def compile_target(path):
+    '''
+    Compile a register path ('rip', 'cr4.SMEP', 'cs.base', 'tss.rsp0') into
+    a function storing a value into a state.
+    '''
+    parts = path.split('.')
+    assert len(parts) <= 2, 'Unsupported register path: %s' % path
+    if parts[0] == 'tss':
+        assert len(parts) == 2, 'A TSS field is required: %s' % path
+        field = parts[1]
+        return lambda state, value: setattr(state.tss, field, value)
+    fields = dict(RegFile._fields_)
+    assert parts[0] in fields, 'Unknown register: %s' % parts[0]
+    cls = fields[parts[0]]
+    if len(parts) == 1:
+        assert 'value' in dict(cls._fields_), 'A field of %s is required' % parts[0]
+        parts.append('value')
+    assert hasattr(cls, parts[1]), 'Unknown field: %s' % path
+    (reg, field) = parts
+    return lambda state, value: setattr(getattr(state.regs, reg), field, value)
+
+def compile_step(step, common):
+    '''
+    Compile one step into a function of (state, labels) that applies it.
+    '''
+    op = step['op']
+    if op == 'include':
+        assert step['name'] in common, 'Unknown common steps: %s' % step['name']
+        steps = compile_steps(common[step['name']], common)
+        def run(state, labels):
+            for func in steps:
+                func(state, labels)
+    elif op == 'real':
+        run = lambda state, labels: state.setup_real()
+    elif op == 'paging':
+        (pae, huge) = (step.get('pae', False), step.get('huge', True))
+        run = lambda state, labels: state.setup_paging(pae, huge)
+    elif op == 'gdt':
+        run = lambda state, labels: state.setup_gdt()
+    elif op == 'idt':
+        gates = [compile_desc(gate) for gate in step['gates']]
+        run = lambda state, labels: state.setup_idt([gate(labels) for gate in gates])
+    elif op == 'append':
+        (table, desc, label) = (step.get('table', 'gdt'), compile_desc(step['desc']), step.get('label'))
+        def run(state, labels):
+            index = getattr(state, table).append(desc(labels))
+            if label:
+                labels[label] = index
+    elif op == 'descriptor':
+        (table, index) = (step.get('table', 'gdt'), compile_expr(step['selector']))
+        if 'desc' in step:
+            desc = compile_desc(step['desc'])
+            def run(state, labels):
+                getattr(state, table)[index(labels)] = desc(labels)
+        else:
+            fields = [(name, compile_expr(value)) for (name, value) in step['fields'].items()]
+            # changing the type of an entry may change its descriptor class
+            retype = 'type' in step['fields'] or 's' in step['fields']
+            def run(state, labels):
+                entry = getattr(state, table)[index(labels)]
+                for (name, value) in fields:
+                    setattr(entry, name, value(labels))
+                if retype:
+                    getattr(state, table).invalidate()
+    elif op == 'load':
+        segments = [(name, compile_expr(selector)) for (name, selector) in step['segments'].items()]
+        def run(state, labels):
+            for (name, selector) in segments:
+                state.load_seg(getattr(state.regs, name), selector(labels))
+    elif op == 'alloc':
+        data = compile_data(step['data']) if 'data' in step else None
+        size = compile_expr(step['size']) if 'size' in step else None
+        align = compile_expr(step.get('align', 1))
+        (name, cls, label) = (step.get('name'), REGION_TYPES.get(step.get('class')), step.get('label'))
+        def run(state, labels):
+            raw = data(labels) if data else ''
+            addr = state.memory.allocate(size(labels) if size else len(raw), align(labels), name, cls)
+            if raw:
+                state.memory.write(addr, raw)
+            if label:
+                labels[label] = addr
+    elif op == 'write':
+        (addr, data) = (compile_expr(step['at']), compile_data(step['data']))
+        run = lambda state, labels: state.memory.write(addr(labels), data(labels))
+    elif op == 'set':
+        values = [(compile_target(path), compile_expr(value)) for (path, value) in step['values'].items()]
+        def run(state, labels):
+            for (target, value) in values:
+                target(state, value(labels))
+    else:
+        raise ValueError('Unknown op: %s' % op)
+    return run
+
+def compile_steps(steps, common):
+    return [compile_step(step, common) for step in steps]
+
+class SeedBuilder(object):
+    '''
+    A compiled seed spec. The base steps are run once, on first use, and
+    every seed forks the resulting state and applies its own steps. The
+    labels bound by the base steps are shared by all the seeds.
+    '''
+    def __init__(self, spec):
+        assert spec.get('arch', 'x86') in ARCHS, 'Unknown arch: %s' % spec['arch']
+        self.family = spec.get('family')
+        self.arch = ARCHS[spec.get('arch', 'x86')]
+        self.sparse = spec.get('sparse', False)
+        common = spec.get('common', {})
+        self.base_steps = compile_steps(spec.get('base', []), common)
+        # json gives unicode names, while file and pack entry names are byte strings
+        self.seeds = collections.OrderedDict((str(name), compile_steps(steps, common)) for (name, steps) in spec['seeds'].items())
+        self.cache = None
+
+    def base(self):
+        '''
+        Return the base state and its labels, building them on first use.
+        '''
+        if self.cache is None:
+            (state, labels) = (VMState(self.arch, self.sparse), {})
+            for func in self.base_steps:
+                func(state, labels)
+            self.cache = (state, labels)
+        return self.cache
+
+    def build(self, name):
+        (base, labels) = self.base()
+        (state, labels) = (base.fork(), dict(labels))
+        for func in self.seeds[name]:
+            func(state, labels)
+        return state
+
+    def __iter__(self):
+        '''
+        Enumerate the (name, state) of every seed in spec order.
+        '''
+        for name in self.seeds:
+            yield (name, self.build(name))
+
+def load_spec(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook = collections.OrderedDict)
+
+# compiled builders, per spec path (and per worker process)
+_builders = {}
+
+def builder(path):
+    '''
+    Return the compiled builder of a spec file, compiling it only once.
+    '''
+    if path not in _builders:
+        _builders[path] = SeedBuilder(load_spec(path))
+    return _builders[path]
+
+def build_seed(path, name):
+    return builder(path).build(name)
+
+def spec_paths(names):
+    '''
+    Resolve spec names (e.g., 'rum') to the shipped specs; paths are kept.
+    '''
+    return [name if os.path.exists(name) else os.path.join(SPEC_DIR, name + '.json') for name in names]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('spec', metavar = '/path/to/spec.json', help = 'seed spec file (or the name of a spec in specs/)')
+    parser.add_argument('-n', nargs = '+', dest = 'names', metavar = 'name', help = 'only build these seeds (default: all)')
+    parser.add_argument('-o', type = str, dest = 'path', metavar = '/path/to/seed/folder', help = 'where to save the seeds')
+    args = parser.parse_args()
+    seeds = builder(spec_paths([args.spec])[0])
+    for name in args.names or seeds.seeds:
+        assert name in seeds.seeds, 'Unknown seed: %s' % name
+        state = seeds.build(name)
+        if not args.path:
+            print '%s:' % name
+            state.dump(True, False)
+        else:
+            state.save(os.path.join(args.path, '%s.bin' % name))
+    if args.path:
+        print '%d seeds written to %s' % (len(args.names or seeds.seeds), args.path)
@@ -0,0 +1,291 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from vmstate import *
+import corpus
+import seedspec
+import example_msr
+import example_realmode
+import example_hypercall
+from validate import ValidatingWriter
+
+def broken_state():
+    state = example_msr.rdmsr()
+    state.regs.ds.base = 0x1000
+    return state
+
+class BuildJobsTest(unittest.TestCase):
+    def test_families(self):
+        names = [name for (name, func, args) in corpus.build_jobs(['rum', 'msr'])]
+        self.assertEqual(names, ['sysenter.bin', 'syscall.bin', 'callgate.bin', 'popfs.bin', 'popss.bin', 'iret.bin', 'retf.bin',
+                                 'rdmsr.bin', 'wrmsr.bin'])
+
+    def test_duplicate_spec(self):
+        # the rum spec reproduces the rum family under the same names
+        self.assertRaises(AssertionError, corpus.build_jobs, ['rum'], None, seedspec.spec_paths(['rum']))
+        self.assertRaises(AssertionError, corpus.build_jobs, [], None, seedspec.spec_paths(['msr', 'msr']))
+        self.assertEqual(len(list(corpus.build_jobs(['rum'], None, seedspec.spec_paths(['msr'])))), 9)
+
+    def test_spec_pack(self):
+        # spec seed names come from json, but pack entry names are byte strings
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'seeds.pack')
+            with SeedPackWriter(path) as writer:
+                names = corpus.build(writer, corpus.build_jobs([], None, seedspec.spec_paths(['rum'])), 1)
+            seeds = SeedPack.open(path)
+            self.assertEqual([name for (name, offset, size) in seeds.entries], names)
+            self.assertEqual(names[0], 'sysenter.bin')
+            self.assertEqual(seeds[u'sysenter.bin'].raw(), seedspec.build_seed(seedspec.spec_paths(['rum'])[0], 'sysenter').raw())
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_duplicate_numbered(self):
+        func = example_realmode.create_state
+        self.assertRaises(AssertionError, corpus.check_outputs, [('apic%04d.bin', func, ()), ('apic0012.bin', func, ())])
+        self.assertRaises(AssertionError, corpus.check_outputs, [('hc0.bin', func, ()), ('hc%d.bin', func, ())])
+        corpus.check_outputs([('apic%04d.bin', func, ()), ('apic%04d.bin', func, ()), ('apic12.bin', func, ()), ('apic0012.txt', func, ())])
+
+class HypercallJobsTest(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(corpus.HYPERCALL_CHUNK * 2 + 10):
+                record = example_hypercall.HYPERSEED_CORPUS()
+                record.CallCode = i & 0xff
+                record.InputSize = i % 3
+                f.write(buffer(record))
+                f.write('\xcc' * record.InputSize)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_chunks(self):
+        jobs = corpus.build_jobs(['msr', 'hypercall'], self.path)
+        self.assertNotIsInstance(jobs, list)
+        jobs = list(jobs)
+        self.assertEqual([name for (name, func, args) in jobs[:2]], ['rdmsr.bin', 'wrmsr.bin'])
+        self.assertEqual([args[2] for (name, func, args) in jobs[2:]], [corpus.HYPERCALL_CHUNK, corpus.HYPERCALL_CHUNK, 10])
+        with open(self.path, 'rb') as f:
+            offsets = list(example_hypercall.index_seeds(f))
+        self.assertEqual([args[1] for (name, func, args) in jobs[2:]], offsets[::corpus.HYPERCALL_CHUNK])
+
+    def test_streamed_build(self):
+        # the jobs reach the pool straight from the iterator
+        seeds = []
+        for workers in (1, 2):
+            path = '%s.%d.pack' % (self.path, workers)
+            with SeedPackWriter(path) as pack:
+                names = corpus.build(pack, corpus.build_jobs(['hypercall'], self.path), workers)
+            self.assertEqual(names, ['hc%06d.bin' % i for i in range(corpus.HYPERCALL_CHUNK * 2 + 10)])
+            with open(path, 'rb') as f:
+                seeds.append(f.read())
+            os.unlink(path)
+        self.assertEqual(seeds[0], seeds[1])
+
+def moved_state():
+    state = example_realmode.create_state()
+    state.regs.rip.value += 1
+    return state
+
+class DedupWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index = os.path.join(self.tmp, 'hashes.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def folder(self, name = 'seeds'):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return corpus.DirectoryWriter(path)
+
+    def add(self, writer, seeds):
+        with writer:
+            return [writer.add(name, func().raw()) for (name, func) in seeds]
+
+    def test_skip(self):
+        folder = self.folder()
+        writer = corpus.DedupWriter(folder)
+        seeds = [('a.bin', example_realmode.create_state), ('b.bin', example_realmode.create_state), ('c.bin', example_msr.wrmsr)]
+        self.assertEqual(self.add(writer, seeds), [True, False, True])
+        self.assertEqual((writer.duplicates, folder.written), (1, 2))
+        self.assertEqual(sorted(os.listdir(folder.path)), ['a.bin', 'c.bin'])
+
+    def test_link(self):
+        folder = self.folder()
+        writer = corpus.DedupWriter(folder, link = True)
+        seeds = [('a.bin', example_realmode.create_state), ('b.bin', example_realmode.create_state)]
+        self.assertEqual(self.add(writer, seeds), [True, True])
+        self.assertEqual((writer.duplicates, folder.written), (1, 1))
+        self.assertTrue(os.path.samefile(os.path.join(folder.path, 'a.bin'), os.path.join(folder.path, 'b.bin')))
+
+    def test_ignore(self):
+        seeds = [('a.bin', example_realmode.create_state), ('b.bin', moved_state)]
+        writer = corpus.DedupWriter(self.folder('all'))
+        self.assertEqual(self.add(writer, seeds), [True, True])
+        # seeds that only differ in the ignored registers are duplicates
+        writer = corpus.DedupWriter(self.folder('rip'), ignore = ('rip',))
+        self.assertEqual(self.add(writer, seeds), [True, False])
+        writer = corpus.DedupWriter(self.folder('rax'), ignore = ('rax',))
+        self.assertEqual(self.add(writer, seeds), [True, True])
+
+    def test_index_reuse(self):
+        seeds = [('a.bin', example_realmode.create_state), ('b.bin', example_realmode.create_state)]
+        self.add(corpus.DedupWriter(self.folder(), self.index), seeds)
+        # a rebuild into an empty folder writes the seeds the index points to
+        folder = self.folder('empty')
+        writer = corpus.DedupWriter(folder, self.index, link = True)
+        self.assertEqual(self.add(writer, seeds), [True, True])
+        self.assertEqual((writer.duplicates, folder.written), (1, 1))
+        self.assertEqual(sorted(os.listdir(folder.path)), ['a.bin', 'b.bin'])
+        # while a seed matching one already in the output is a duplicate
+        writer = corpus.DedupWriter(folder, self.index)
+        self.assertEqual(self.add(writer, [('c.bin', example_realmode.create_state)]), [False])
+        self.assertEqual(writer.duplicates, 1)
+        # a stale entry is refreshed with the seed written in its place
+        os.unlink(os.path.join(folder.path, 'a.bin'))
+        os.unlink(os.path.join(folder.path, 'b.bin'))
+        self.add(corpus.DedupWriter(folder, self.index), [('d.bin', example_realmode.create_state)])
+        with corpus.DedupWriter(folder, self.index) as writer:
+            self.assertEqual(writer.hashes.values(), ['d.bin'])
+        with open(self.index) as f:
+            self.assertEqual([line.split()[1] for line in f], ['a.bin', 'd.bin'])
+        # the entries of a pack build only match the seeds of that pack
+        path = os.path.join(self.tmp, 'seeds.pack')
+        writer = corpus.DedupWriter(SeedPackWriter(path), self.index)
+        self.assertEqual(self.add(writer, seeds), [True, False])
+        self.assertEqual([name for (name, offset, size) in SeedPack.open(path).entries], ['a.bin'])
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, 'seeds')
+        os.mkdir(self.folder)
+        self.path = os.path.join(self.tmp, 'manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, jobs, dedup = False, validate = False, groups = None):
+        '''
+        Run an incremental build the way corpus.py --manifest does.
+        '''
+        manifest = corpus.BuildManifest(self.path, {'dedup': dedup, 'validate': validate}, groups)
+        folder = corpus.DirectoryWriter(self.folder, update = True)
+        writer = folder
+        if dedup:
+            writer = corpus.DedupWriter(writer)
+        if validate:
+            writer = ValidatingWriter(writer, False)
+        with writer:
+            names = corpus.build(writer, jobs, 1, manifest = manifest, folder = self.folder)
+        for name in manifest.removed():
+            os.unlink(os.path.join(self.folder, name))
+        manifest.save()
+        return (folder, manifest, names)
+
+    def test_up_to_date(self):
+        jobs = list(corpus.build_jobs(['msr', 'realmode']))
+        (folder, manifest, names) = self.build(jobs)
+        self.assertEqual((folder.written, manifest.reused), (3, 0))
+        self.assertEqual(sorted(os.listdir(self.folder)), ['rdmsr.bin', 'realmode.bin', 'wrmsr.bin'])
+        (folder, manifest, names) = self.build(jobs)
+        self.assertEqual((folder.written, folder.unchanged, manifest.reused), (0, 0, 3))
+        self.assertEqual(names, ['rdmsr.bin', 'wrmsr.bin', 'realmode.bin'])
+
+    def test_missing_output(self):
+        jobs = list(corpus.build_jobs(['msr']))
+        self.build(jobs)
+        os.unlink(os.path.join(self.folder, 'wrmsr.bin'))
+        (folder, manifest, names) = self.build(jobs)
+        self.assertEqual((folder.written, manifest.reused), (1, 1))
+
+    def test_removed_job(self):
+        self.build(list(corpus.build_jobs(['msr', 'realmode'])))
+        self.build(list(corpus.build_jobs(['msr'])))
+        self.assertEqual(sorted(os.listdir(self.folder)), ['rdmsr.bin', 'wrmsr.bin'])
+
+    def test_selected_families(self):
+        self.build(list(corpus.build_jobs(['msr', 'realmode', 'vmxon'])))
+        # a build of msr alone leaves the other families untouched
+        (folder, manifest, names) = self.build(list(corpus.build_jobs(['msr'])), groups = set(['msr']))
+        self.assertEqual((folder.written, manifest.reused, manifest.removed()), (0, 2, []))
+        self.assertEqual(sorted(os.listdir(self.folder)), ['rdmsr.bin', 'realmode.bin', 'vmxon.bin', 'wrmsr.bin'])
+        # but the seeds of the selected families that are gone are removed
+        jobs = [job for job in corpus.build_jobs(['msr', 'realmode']) if job[0] != 'wrmsr.bin']
+        (folder, manifest, names) = self.build(jobs, groups = set(['msr', 'realmode']))
+        self.assertEqual(sorted(os.listdir(self.folder)), ['rdmsr.bin', 'realmode.bin', 'vmxon.bin'])
+        # and the records of the others are still there for the next full build (realmode
+        # moved in the job list, so its RNG seed changed)
+        (folder, manifest, names) = self.build(list(corpus.build_jobs(['msr', 'realmode', 'vmxon'])))
+        self.assertEqual((folder.written, folder.unchanged, manifest.reused, manifest.removed()), (1, 1, 2, []))
+
+    def test_selected_specs(self):
+        spec = seedspec.spec_paths(['realmode'])[0]
+        self.build(list(corpus.build_jobs(['msr'], specs = [spec])))
+        (folder, manifest, names) = self.build(list(corpus.build_jobs(['msr'])), groups = set(['msr']))
+        self.assertEqual(manifest.removed(), [])
+        (folder, manifest, names) = self.build(list(corpus.build_jobs([], specs = [spec])), groups = set([spec]))
+        self.assertEqual((folder.written, manifest.removed()), (0, []))
+        self.assertEqual(len(manifest.carried()), 2)
+        self.assertEqual(sorted(os.listdir(self.folder)), sorted(['rdmsr.bin', 'wrmsr.bin'] + names))
+
+    def test_corpus_source(self):
+        jobs = list(corpus.build_jobs(['msr']))
+        (folder, manifest, names) = self.build(jobs)
+        for record in manifest.jobs.values():
+            self.assertIn('corpus.py', record['sources'])
+            self.assertIn('example_msr.py', record['sources'])
+        # an edit of corpus.py makes every job stale
+        with open(self.path) as f:
+            saved = json.load(f)
+        for record in saved['jobs'].values():
+            record['sources']['corpus.py'] = '0' * 40
+        with open(self.path, 'w') as f:
+            json.dump(saved, f)
+        (folder, manifest, names) = self.build(jobs)
+        self.assertEqual((folder.unchanged, manifest.reused), (2, 0))
+
+    def test_spec_input(self):
+        spec = os.path.join(self.tmp, 'realmode.json')
+        shutil.copy(os.path.join(seedspec.SPEC_DIR, 'realmode.json'), spec)
+        self.build(list(corpus.build_jobs([], specs = [spec])))
+        with open(spec) as f:
+            text = f.read()
+        with open(spec, 'w') as f:
+            f.write(text.replace('"9d cc"', '"90 cc"'))
+        seedspec._builders.clear()
+        (folder, manifest, names) = self.build(list(corpus.build_jobs([], specs = [spec])))
+        self.assertEqual((folder.written, manifest.reused), (1, 0))
+        self.assertEqual(VMState.load(os.path.join(self.folder, 'realmode.bin')).memory.read(8, 2), '\x90\xcc')
+
+    def test_dropped_seeds(self):
+        # seeds dropped by dedup or validation are not expected on disk
+        jobs = [('a.bin', example_realmode.create_state, ()),
+                ('b.bin', example_realmode.create_state, ()),
+                ('c.bin', broken_state, ()),
+                ('d.bin', example_msr.wrmsr, ())]
+        (folder, manifest, names) = self.build(jobs, True, True)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['a.bin', 'd.bin'])
+        self.assertEqual(folder.written, 2)
+        (folder, manifest, names) = self.build(jobs, True, True)
+        self.assertEqual((folder.written, manifest.reused), (0, 2))
+        self.assertEqual(names, ['a.bin', 'd.bin'])
+
+    def test_numbering(self):
+        jobs = [('n%d.bin', example_realmode.create_state, ()),
+                ('n%d.bin', example_msr.wrmsr, ())]
+        self.build(jobs)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['n0.bin', 'n1.bin'])
+        (folder, manifest, names) = self.build(jobs[1:])
+        # the remaining job is renumbered and its old name is removed
+        self.assertEqual(sorted(os.listdir(self.folder)), ['n0.bin'])
+        self.assertEqual(VMState.load(os.path.join(self.folder, 'n0.bin')).raw(), example_msr.wrmsr().raw())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from vmstate import *
+import example_msr
+import mutate
+
+RANGES = [(0x10, 8), (0x40, 0x10)]
+
+def fixed_fields(obj, path = ()):
+    '''
+    Collect the values of the reserved and must-be-one bit fields of a
+    register structure as {path: value}.
+    '''
+    ans = {}
+    for field_info in obj._fields_:
+        value = getattr(obj, field_info[0])
+        if isinstance(value, Structure):
+            ans.update(fixed_fields(value, path + (field_info[0],)))
+        elif len(field_info) == 3 and (field_info[0].startswith('rsvd') or field_info[0] == 'one'):
+            ans[path + (field_info[0],)] = value
+    return ans
+
+def base_state():
+    state = example_msr.wrmsr()
+    # reserved bits that are set in the base stay set
+    state.regs.cr0.rsvd0 = 0x155
+    state.regs.eflags.rsvd3 = 0x3ff
+    state.regs.cs.rsvd0 = 1
+    return state
+
+class BatchMutatorTest(unittest.TestCase):
+    def test_fixed_bits(self):
+        base = base_state()
+        expected = fixed_fields(base.regs)
+        self.assertEqual(expected[('eflags', 'one')], 1)
+        mutator = mutate.BatchMutator(base, seed = 1)
+        (regs, memory) = mutator.mutate(2000)
+        changed = set()
+        for row in regs:
+            variant = RegFile.from_buffer_copy(row.tobytes())
+            self.assertEqual(fixed_fields(variant), expected)
+            changed.update(name for (name, cls) in RegFile._fields_ if buffer(getattr(variant, name))[:] != buffer(getattr(base.regs, name))[:])
+        # every register got mutated at least once
+        self.assertEqual(changed, set(name for (name, cls) in RegFile._fields_))
+
+    def test_fields(self):
+        base = base_state()
+        (regs, memory) = mutate.BatchMutator(base, ['rip', 'cr4'], seed = 2).mutate(200)
+        size = sizeof(RegFile)
+        mask = bytearray(size)
+        for name in ('rip', 'cr4'):
+            desc = getattr(RegFile, name)
+            mask[desc.offset:desc.offset + desc.size] = '\xff' * desc.size
+        original = bytearray(base.regs)
+        for row in regs:
+            variant = bytearray(row.tobytes())
+            self.assertEqual([variant[i] for i in range(size) if not mask[i]], [original[i] for i in range(size) if not mask[i]])
+
+    def test_memory_ranges(self):
+        base = base_state()
+        original = np.frombuffer(str(base.memory), np.uint8)
+        mutator = mutate.BatchMutator(base, ranges = RANGES, seed = 3)
+        (regs, memory) = mutator.mutate(500)
+        inside = np.zeros(len(original), bool)
+        for (addr, size) in RANGES:
+            inside[addr:addr + size] = True
+        self.assertTrue((memory[:, ~inside] == original[~inside]).all())
+        self.assertTrue((memory[:, inside] != original[inside]).any(axis = 1).mean() > 0.9)
+        self.assertRaises(AssertionError, mutate.BatchMutator, base, None, [(len(original) - 4, 8)])
+
+    def test_sparse_base(self):
+        base = VMState(0x64, True)
+        base.setup_gdt()
+        addr = base.memory.allocate_at(0x10000, 0x20, 'code')
+        (regs, memory) = mutate.BatchMutator(base, ranges = [(addr, 0x20)], seed = 4).mutate(10)
+        flat = base.memory.flatten()
+        self.assertEqual(memory.shape, (10, len(flat)))
+        self.assertTrue((memory[:, :addr] == np.frombuffer(str(flat[:addr]), np.uint8)).all())
+
+class GenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'variants.pack')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_pack_loads(self):
+        base = base_state()
+        with SeedPackWriter(self.path) as writer:
+            mutate.BatchMutator(base, ranges = RANGES, seed = 5).generate(writer, 10, batch = 4)
+        # the same seed yields the same variants batch by batch
+        mutator = mutate.BatchMutator(base, ranges = RANGES, seed = 5)
+        batches = [mutator.mutate(n) for n in (4, 4, 2)]
+        regs = np.concatenate([batch[0] for batch in batches])
+        memory = np.concatenate([batch[1] for batch in batches])
+        seeds = SeedPack.open(self.path)
+        self.assertEqual([name for (name, offset, size) in seeds.entries], ['mut%08d.bin' % i for i in range(10)])
+        for (i, state) in enumerate(seeds):
+            self.assertIsInstance(state.memory, MappedMemory)
+            self.assertEqual(bytearray(state.regs), bytearray(regs[i].tobytes()))
+            self.assertEqual(state.memory.read(0, len(state.memory)), memory[i].tobytes())
+            self.assertEqual(state.regs.eflags.one, 1)
+            self.assertEqual(state.raw(), bytearray(regs[i].tobytes()) + bytearray(memory[i].tobytes()))
+
+if __name__ == '__main__':
+    unittest.main()
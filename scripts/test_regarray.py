@@ -0,0 +1,102 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from vmstate import *
+import regarray
+
+# register fields checked against their ctypes accessors
+NAMES = ['rax', 'rip', 'cr4', 'cr4.SMEP', 'cr4.PAE', 'cr0.PG', 'cr0.PE', 'efer', 'efer.LME', 'efer.NXE', 'eflags.IOPL',
+         'eflags.one', 'cs.base', 'cs.selector', 'cs.type', 'cs.dpl', 'cs.l', 'tr.g', 'gdtr.limit']
+
+def random_regs(count, seed = 0):
+    rng = random.Random(seed)
+    return [RegFile.from_buffer_copy(''.join(chr(rng.randrange(256)) for i in range(sizeof(RegFile)))) for i in range(count)]
+
+def ctypes_get(regs, name):
+    value = regs
+    for part in name.split('.'):
+        value = getattr(value, part)
+    # whole registers are structures holding a single integer or bit fields
+    if isinstance(value, Structure):
+        value = struct.unpack('<' + {4: 'I', 8: 'Q'}[sizeof(value)], buffer(value)[:])[0]
+    return value
+
+def ctypes_put(regs, name, value):
+    parts = name.split('.')
+    if len(parts) == 1:
+        desc = getattr(RegFile, name)
+        data = struct.pack('<' + {4: 'I', 8: 'Q'}[desc.size], value & ((1 << (8 * desc.size)) - 1))
+        memmove(addressof(regs) + desc.offset, data, desc.size)
+    else:
+        setattr(getattr(regs, parts[0]), parts[1], value)
+
+class LoadFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_region_maps_are_skipped(self):
+        for (i, arch) in enumerate((0x86, 0x64)):
+            state = VMState(arch)
+            state.setup_gdt()
+            state.save(os.path.join(self.folder, 'seed%d.bin' % i))
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'seed1.bin' + REGIONS_SUFFIX)))
+        regs = regarray.load(self.folder)
+        self.assertEqual(len(regs), 2)
+        self.assertEqual(list(regarray.get(regs, 'cs.l')), [0, 1])
+        self.assertEqual(list(regarray.get(regs, 'cs.selector')), [0x8, 0x8])
+
+class DtypeTest(unittest.TestCase):
+    def test_layout(self):
+        self.assertEqual(regarray.REG_DTYPE.itemsize, sizeof(RegFile))
+        for (name, cls) in RegFile._fields_:
+            self.assertEqual(regarray.REG_DTYPE.fields[name][1], getattr(RegFile, name).offset)
+            self.assertEqual(regarray.REG_DTYPE.fields[name][0].itemsize, sizeof(cls))
+
+    def test_round_trip(self):
+        files = random_regs(8)
+        raw = ''.join(buffer(regs)[:] for regs in files)
+        array = np.frombuffer(raw, regarray.REG_DTYPE)
+        self.assertEqual(array.tobytes(), raw)
+        # a copy through the structured dtype keeps every byte
+        copy = np.zeros(len(files), regarray.REG_DTYPE)
+        for name in regarray.REG_DTYPE.names:
+            copy[name] = array[name]
+        self.assertEqual(copy.tobytes(), raw)
+        for (i, regs) in enumerate(files):
+            self.assertEqual(bytearray(RegFile.from_buffer_copy(array[i].tobytes())), bytearray(regs))
+
+class FieldTest(unittest.TestCase):
+    def test_get(self):
+        files = random_regs(16, 1)
+        array = np.frombuffer(''.join(buffer(regs)[:] for regs in files), regarray.REG_DTYPE)
+        for name in NAMES:
+            self.assertEqual(list(regarray.get(array, name)), [ctypes_get(regs, name) for regs in files], name)
+
+    def test_put(self):
+        files = random_regs(4, 2)
+        for name in NAMES:
+            array = np.frombuffer(''.join(buffer(regs)[:] for regs in files), regarray.REG_DTYPE).copy()
+            # values wider than a bit field are truncated the way ctypes does
+            values = [0, 1, 0x2f, (1 << 64) - 1]
+            regarray.put(array, name, np.array(values, np.uint64))
+            for (i, regs) in enumerate(files):
+                expected = RegFile.from_buffer_copy(regs)
+                ctypes_put(expected, name, values[i])
+                self.assertEqual(bytearray(array[i].tobytes()), bytearray(expected), name)
+
+    def test_put_scalar(self):
+        array = np.zeros(3, regarray.REG_DTYPE)
+        regarray.put(array, 'cr4.SMEP', 1)
+        regarray.put(array, 'efer.LME', 1)
+        regs = RegFile.from_buffer_copy(array[1].tobytes())
+        self.assertEqual((regs.cr4.SMEP, regs.cr4.SMAP, regs.efer.LME, regs.efer.LMA), (1, 0, 1, 0))
+        self.assertEqual(list(regarray.get(array, 'cr4')), [1 << 20] * 3)
+
+if __name__ == '__main__':
+    unittest.main()
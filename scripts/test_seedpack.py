@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import unittest
+from vmstate import *
+import seedpack
+
+def flat_state(arch = 0x86):
+    state = VMState(arch)
+    state.setup_gdt()
+    return state
+
+def states():
+    sparse = VMState(0x64, True)
+    sparse.setup_gdt()
+    sparse.memory.allocate_at(0xFEE00000, PGSIZE, 'apic')
+    return [('x86.bin', flat_state(0x86)), ('x64.bin', flat_state(0x64)), ('sparse.bin', sparse)]
+
+class SeedPackTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'seeds.pack')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_layout(self):
+        with SeedPackWriter(self.path) as writer:
+            for (name, state) in states():
+                self.assertTrue(writer.add(name, state.raw()))
+        with open(self.path, 'rb') as f:
+            buf = f.read()
+        (version, count, table) = struct.unpack_from('<IIQ', buf, len(PACK_MAGIC))
+        self.assertEqual((buf[:len(PACK_MAGIC)], version, count), (PACK_MAGIC, PACK_VERSION, 3))
+        # the blobs follow the header back to back, then comes the index
+        (offset, index) = (SeedPackWriter.HEADER, table)
+        for (name, state) in states():
+            (start, size, namelen) = struct.unpack_from('<QQH', buf, index)
+            self.assertEqual((start, size, buf[index + 18:index + 18 + namelen]), (offset, len(state.raw()), name))
+            self.assertEqual(buf[start:start + size], state.raw())
+            (offset, index) = (offset + size, index + 18 + namelen)
+        self.assertEqual((offset, index), (table, len(buf)))
+
+    def test_access(self):
+        with SeedPackWriter(self.path) as writer:
+            for (name, state) in states():
+                writer.add(name, state.raw())
+        seeds = SeedPack.open(self.path)
+        self.assertEqual(len(seeds), 3)
+        for (i, (name, state)) in enumerate(states()):
+            self.assertEqual(seeds.raw(i), state.raw())
+            self.assertEqual(seeds[name].raw(), state.raw())
+            self.assertEqual(VMState.load(self.path, name).raw(), state.raw())
+        self.assertEqual([state.raw() for state in seeds], [state.raw() for (name, state) in states()])
+        self.assertIsInstance(seeds['x64.bin'].memory, MappedMemory)
+        self.assertIsInstance(seeds['sparse.bin'].memory, SparseMemory)
+        self.assertRaises(AssertionError, VMState.load, self.path)
+
+    def test_link(self):
+        with SeedPackWriter(self.path) as writer:
+            writer.add('a.bin', flat_state().raw())
+            self.assertTrue(writer.link('b.bin', 'a.bin'))
+            self.assertFalse(writer.link('c.bin', 'missing.bin'))
+        seeds = SeedPack.open(self.path)
+        self.assertEqual([name for (name, offset, size) in seeds.entries], ['a.bin', 'b.bin'])
+        # aliases share the blob of their target
+        self.assertEqual(seeds.entries[0][1:], seeds.entries[1][1:])
+
+    def test_batch(self):
+        raws = [flat_state().raw() for i in range(3)]
+        raws[1][0] = 0xff
+        with SeedPackWriter(self.path) as writer:
+            writer.add('first.bin', flat_state(0x64).raw())
+            writer.add_batch(['b0.bin', 'b1.bin', 'b2.bin'], bytearray().join(raws), len(raws[0]))
+        seeds = SeedPack.open(self.path)
+        self.assertEqual([seeds.raw('b%d.bin' % i) for i in range(3)], raws)
+
+    def test_not_a_pack(self):
+        self.assertRaises(AssertionError, SeedPack, bytearray(flat_state().raw()))
+        buf = bytearray(PACK_MAGIC + struct.pack('<IIQ', PACK_VERSION + 1, 0, 0))
+        self.assertRaises(AssertionError, SeedPack, buf)
+
+    def test_unpack(self):
+        with SeedPackWriter(self.path) as writer:
+            for (name, state) in states():
+                writer.add(name, state.raw())
+        os.mkdir(os.path.join(self.folder, 'out'))
+        self.assertEqual(seedpack.unpack(self.path, os.path.join(self.folder, 'out')), 3)
+        for (name, state) in states():
+            with open(os.path.join(self.folder, 'out', name), 'rb') as f:
+                self.assertEqual(f.read(), state.raw())
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'seeds.pack')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        base = flat_state().raw()
+        for raw in (base, base[:100], base + bytearray('\x01' * 10), bytearray(len(base))):
+            changed = bytearray(raw)
+            if changed:
+                changed[len(changed) / 2] ^= 0xff
+            delta = delta_encode(base, changed, 7)
+            self.assertEqual(delta[:len(DELTA_MAGIC)], DELTA_MAGIC)
+            self.assertEqual(struct.unpack_from('<I', delta, len(DELTA_MAGIC)), (7,))
+            self.assertEqual(delta_decode(base, delta), changed)
+
+    def test_pack(self):
+        base = flat_state()
+        similar = base.fork()
+        similar.regs.rip.value = 0x1000
+        other = flat_state(0x64)
+        other.memory.allocate(PGSIZE)
+        other.memory.write(len(other.memory) - PGSIZE, '\xa5' * PGSIZE)
+        seeds = [('base.bin', base), ('similar.bin', similar), ('other.bin', other), ('again.bin', other.fork())]
+        with SeedPackWriter(self.path, delta = True) as writer:
+            for (name, state) in seeds:
+                writer.add(name, state.raw())
+        pack = SeedPack.open(self.path)
+        kinds = [pack.buf[offset:offset + len(DELTA_MAGIC)] == DELTA_MAGIC for (name, offset, size) in pack.entries]
+        # a seed too different from the current base becomes the next base
+        self.assertEqual(kinds, [False, True, False, True])
+        self.assertLess(pack.entries[1][2], len(similar.raw()) / 10)
+        for (name, state) in seeds:
+            self.assertEqual(pack.raw(name), state.raw())
+            self.assertEqual(pack[name].regs.rip.value, state.regs.rip.value)
+
+class PackFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_region_maps_are_skipped(self):
+        os.mkdir(os.path.join(self.folder, 'seeds'))
+        states = [flat_state(0x86), flat_state(0x64)]
+        for (i, state) in enumerate(states):
+            state.save(os.path.join(self.folder, 'seeds', 'seed%d.bin' % i))
+        self.assertEqual(len(os.listdir(os.path.join(self.folder, 'seeds'))), 4)
+        path = os.path.join(self.folder, 'seeds.pack')
+        self.assertEqual(seedpack.pack(path, [os.path.join(self.folder, 'seeds')]), 2)
+        seeds = SeedPack.open(path)
+        self.assertEqual([entry[0] for entry in seeds.entries], ['seed0.bin', 'seed1.bin'])
+        for (i, state) in enumerate(states):
+            self.assertEqual(seeds.raw(i), state.raw())
+
+if __name__ == '__main__':
+    unittest.main()
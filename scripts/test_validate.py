@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from vmstate import *
+from validate import validate, validate_corpus
+
+def flat_state(arch = 0x86):
+    state = VMState(arch)
+    state.setup_gdt()
+    return state
+
+class ValidateTest(unittest.TestCase):
+    def test_consistent(self):
+        for arch in (0x86, 0x64):
+            state = flat_state(arch)
+            state.setup_paging()
+            self.assertEqual(validate(state), [])
+
+    def test_real_mode(self):
+        state = VMState()
+        state.setup_real()
+        state.regs.cs.selector = 0x1234
+        self.assertEqual(validate(state), [])
+
+    def test_stale_segment_cache(self):
+        state = flat_state()
+        state.gdt[0x18].dpl = 3
+        state.regs.cs.selector = 0
+        self.assertEqual(validate(state), ['cs: null selector', 'ss.dpl: cache 0x0, descriptor 0x3',
+                                           'ds.dpl: cache 0x0, descriptor 0x3', 'es.dpl: cache 0x0, descriptor 0x3'])
+
+    def test_selectors(self):
+        state = flat_state()
+        state.regs.fs.selector = 0x7
+        state.regs.gs.selector = 0x1000
+        self.assertEqual(validate(state), ['fs: selector 0x7 refers to the LDT',
+                                           'gs: selector 0x1000 is beyond the GDT limit 0x%x' % state.regs.gdtr.limit])
+
+    def test_tables_outside_memory(self):
+        state = flat_state(0x64)
+        state.setup_paging()
+        state.regs.idtr.base = len(state.memory)
+        state.regs.idtr.limit = 0xf
+        state.regs.cr3.value = 0x100000
+        violations = validate(state)
+        self.assertIn('idtr: [0x%x, 0x%x] is outside memory' % (len(state.memory), len(state.memory) + 0xf), violations)
+        self.assertIn('pml4: table at 0x100000 is outside memory', violations)
+
+    def test_truncated_tss(self):
+        state = flat_state()
+        state.gdt[0x28].limit0_15 = 0x10
+        self.assertEqual(validate(state), ['tr.limit: cache 0x67, descriptor 0x10', 'gdt[0x28]: TSS limit 0x10 is below 0x67'])
+
+class ValidateFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_truncated(self):
+        flat_state().save(os.path.join(self.folder, 'a.bin'))
+        with open(os.path.join(self.folder, 'b.bin'), 'wb') as f:
+            f.write('\x00' * 100)
+        open(os.path.join(self.folder, 'c.bin'), 'wb').close()
+        flat_state(0x64).save(os.path.join(self.folder, 'd.bin'))
+        results = list(validate_corpus(self.folder, 1))
+        self.assertEqual(results, [('a.bin', []),
+                                   ('b.bin', ['truncated: 100 bytes < sizeof(REG_FILE)']),
+                                   ('c.bin', ['truncated: 0 bytes < sizeof(REG_FILE)']),
+                                   ('d.bin', [])])
+
+    def test_pack(self):
+        path = os.path.join(self.folder, 'seeds.pack')
+        broken = flat_state()
+        broken.regs.ds.base = 0x1000
+        with SeedPackWriter(path) as writer:
+            writer.add('good', flat_state().raw())
+            writer.add('broken', broken.raw())
+            writer.add('truncated', '\x00' * 100)
+        results = list(validate_corpus(path, 2))
+        self.assertEqual(results, [('good', []),
+                                   ('broken', ['ds.base: cache 0x1000, descriptor 0x0']),
+                                   ('truncated', ['truncated: 100 bytes < sizeof(REG_FILE)'])])
+
+    def test_region_maps_are_skipped(self):
+        for (i, arch) in enumerate((0x86, 0x64)):
+            flat_state(arch).save(os.path.join(self.folder, 'seed%d.bin' % i))
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'seed0.bin' + REGIONS_SUFFIX)))
+        results = list(validate_corpus(self.folder, 1))
+        self.assertEqual(results, [('seed0.bin', []), ('seed1.bin', [])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import random
+import unittest
+from vmstate import *
+import vmdiff
+
+def dense_ranges(old, new):
+    size = max(len(old), len(new))
+    return changed_ranges(vmdiff.read_span(old, 0, size), vmdiff.read_span(new, 0, size))
+
+class ChangedMemoryTest(unittest.TestCase):
+    def check(self, old, new):
+        self.assertEqual(vmdiff.changed_memory(old, new), dense_ranges(old, new))
+
+    def test_dense(self):
+        rng = random.Random(0)
+        old = Memory(5 * PGSIZE + 100)
+        for count in (0, 1, 2, 10):
+            new = old.copy()
+            for i in range(count):
+                addr = rng.randrange(len(new) - 8)
+                new.write(addr, '\xff' * rng.randrange(1, 8))
+            self.check(old, new)
+
+    def test_across_blocks(self):
+        old = Memory(3 * PGSIZE)
+        new = old.copy()
+        new.write(PGSIZE - 2, '\x01' * 4)
+        new.write(2 * PGSIZE + 3, '\x01')
+        self.assertEqual(vmdiff.changed_memory(old, new), [[PGSIZE - 2, PGSIZE + 2], [2 * PGSIZE + 3, 2 * PGSIZE + 4]])
+
+    def test_grown(self):
+        old = Memory(PGSIZE + 10)
+        new = old.copy()
+        new.allocate(3 * PGSIZE)
+        new.write(len(new) - 1, '\x01')
+        self.check(old, new)
+        self.check(new, old)
+
+    def test_mapped(self):
+        raw = VMState(0x64).raw() + bytearray(2 * PGSIZE + 5)
+        old = VMState.from_buffer(bytearray(raw)).memory
+        new = VMState.from_buffer(bytearray(raw)).memory
+        new.write(PGSIZE + 1, '\x02')
+        new.write(new.allocate(16), '\x03' * 16)
+        self.check(old, new)
+
+    def test_sparse_high(self):
+        # only the populated pages are compared, never the whole address space
+        old = SparseMemory()
+        old.allocate(PGSIZE)
+        old.allocate_at(0xFEE00000, PGSIZE, 'apic')
+        new = old.copy()
+        new.write(0xFEE00080, '\xcc')
+        self.assertEqual(vmdiff.changed_memory(old, new), [[0xFEE00080, 0xFEE00081]])
+        other = old.copy()
+        other.allocate_at(0x100000000, PGSIZE)
+        other.write(0x100000010, '\x01')
+        self.assertEqual(vmdiff.changed_memory(old, other), [[0x100000010, 0x100000011]])
+        self.assertEqual(vmdiff.changed_memory(other, old), [[0x100000010, 0x100000011]])
+
+class DiffTest(unittest.TestCase):
+    def test_gdt_change(self):
+        old = VMState(0x64, True)
+        old.setup_gdt()
+        old.memory.allocate_at(0xFEE00000, PGSIZE, 'apic')
+        new = old.fork()
+        new.gdt[0x18].dpl = 3
+        new.regs.rip.value = 0x1000
+        (regs, memory) = vmdiff.diff(old, new)
+        self.assertEqual(regs, [('rip', 0, 0x1000)])
+        self.assertEqual(len(memory), 1)
+        (start, end, owners) = memory[0]
+        self.assertEqual(start, old.regs.gdtr.base + 0x18 + 5)
+        self.assertIn(('gdt[0x18]', [('dpl', 0, 3)]), owners)
+
+if __name__ == '__main__':
+    unittest.main()
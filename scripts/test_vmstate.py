@@ -0,0 +1,366 @@
+import os
+import shutil
+import tempfile
+import StringIO
+import unittest
+from vmstate import *
+
+class HexdumpTest(unittest.TestCase):
+    def test_no_collapse(self):
+        lines = hexdump('\x00' * 48, 0x1000, False)
+        self.assertEqual(lines, ['%08x: %s' % (0x1000 + off, ' '.join(['00'] * 16)) for off in (0, 16, 32)])
+
+    def test_collapse_run(self):
+        lines = hexdump('\x00' * 64 + '\x11' * 16)
+        self.assertEqual(lines, ['00000000: ' + ' '.join(['00'] * 16), '*', '00000040: ' + ' '.join(['11'] * 16)])
+
+    def test_collapse_long_run(self):
+        # the line following a run longer than the 1KB skip must be shown
+        buf = '\x00' * (65 * 16) + '\x11' * 16 + '\x22' * 16
+        lines = hexdump(buf)
+        self.assertEqual(lines, ['00000000: ' + ' '.join(['00'] * 16), '*',
+                                 '00000410: ' + ' '.join(['11'] * 16),
+                                 '00000420: ' + ' '.join(['22'] * 16)])
+
+    def test_collapse_matches_plain(self):
+        # collapsing only hides lines equal to the line shown before them
+        for count in (2, 63, 64, 65, 66, 128, 129, 130, 200):
+            buf = '\xaa' * 16 + '\x00' * (count * 16) + '\x11' * 16 + '\x00' * 5
+            shown = dict((line.split(':')[0], line) for line in hexdump(buf) if line != '*')
+            plain = hexdump(buf, 0, False)
+            for (i, line) in enumerate(plain):
+                key = line.split(':')[0]
+                if key in shown:
+                    self.assertEqual(shown[key], line)
+                else:
+                    self.assertEqual(line.split(':')[1], plain[i - 1].split(':')[1])
+            self.assertIn('%08x' % ((count + 1) * 16), shown)
+
+    def test_collapse_at_end(self):
+        lines = hexdump('\x00' * 4096)
+        self.assertEqual(lines, ['00000000: ' + ' '.join(['00'] * 16), '*', '00000ff0: ' + ' '.join(['00'] * 16)])
+
+class RegFileTest(unittest.TestCase):
+    def test_defaults(self):
+        # only eflags has a non-zero default (its fixed bit)
+        expected = bytearray(sizeof(RegFile))
+        expected[RegFile.eflags.offset] = 0b10
+        self.assertEqual(bytearray(RegFile()), expected)
+        self.assertEqual(RegFile().eflags.one, 1)
+
+class SparseMemoryTest(unittest.TestCase):
+    def test_allocate_skips_placed(self):
+        memory = SparseMemory()
+        memory.allocate_at(0x3000, 0x10, 'placed')
+        memory.write(0x3000, '\x11' * 0x10)
+        addr = memory.allocate(0x5000, 1, 'block')
+        self.assertEqual(addr, 0x3010)
+        memory.write(addr, '\xff' * 0x5000)
+        self.assertEqual(memory.read(0x3000, 0x10), '\x11' * 0x10)
+        self.assertEqual(memory.allocate(0x10), 0x8010)
+
+    def test_allocate_below_placed(self):
+        memory = SparseMemory()
+        memory.allocate_at(0xFEE00000, PGSIZE)
+        self.assertEqual(memory.allocate(0x100), 0)
+        self.assertEqual(memory.allocate(PGSIZE, PGSIZE), PGSIZE)
+        self.assertEqual(memory.extents()[-1][0], 0xFEE00000)
+
+    def test_allocate_after_load(self):
+        memory = SparseMemory()
+        memory.allocate(0x10)
+        memory.allocate_at(0x2000, 0x10)
+        self.assertEqual(memory.copy().allocate(0x2000), 0x2010)
+        loaded = SparseMemory.from_raw(memory.raw())
+        self.assertEqual(loaded.allocate(0x2000), 0x2010)
+        self.assertEqual(loaded.allocate(0x10), 0x4010)
+
+    def test_placed_below_frontier(self):
+        # a range placed in the page of the bump pointer survives a round trip
+        memory = SparseMemory()
+        memory.allocate(0x100)
+        memory.allocate_at(0x800, 4)
+        memory.write(0x800, '\xaa' * 4)
+        loaded = SparseMemory.from_raw(memory.raw())
+        self.assertEqual(loaded.placed, [(0x800, 0x804)])
+        addr = loaded.allocate(0x1000)
+        self.assertEqual(addr, 0x804)
+        loaded.write(addr, '\xff' * 0x1000)
+        self.assertEqual(loaded.read(0x800, 4), '\xaa' * 4)
+
+    def test_raw_round_trip(self):
+        memory = SparseMemory()
+        memory.write(memory.allocate(0x20), '\x01' * 0x20)
+        memory.allocate_at(0x100000000, 0x10)
+        memory.write(0x100000008, '\x02')
+        raw = memory.raw()
+        # top, size, count and placed, then the extent and placed indexes
+        self.assertEqual(struct.unpack_from('<QQII', raw), (0x20, 0x100000010, 2, 1))
+        self.assertEqual(struct.unpack_from('<QQQQQQ', raw, 24), (0, PGSIZE, 0x100000000, PGSIZE, 0x100000000, 0x10))
+        self.assertEqual(raw[72:72 + 0x20], '\x01' * 0x20)
+        loaded = SparseMemory.from_raw(raw)
+        self.assertEqual((loaded.top, loaded.size, loaded.starts), (memory.top, memory.size, memory.starts))
+        self.assertEqual(loaded.placed, memory.placed)
+        self.assertEqual(loaded.buffers, memory.buffers)
+        self.assertEqual(loaded.raw(), memory.raw())
+
+class MappedMemoryTest(unittest.TestCase):
+    def mapped(self):
+        return VMState.from_buffer(VMState(0x64).raw() + bytearray(PGSIZE)).memory
+
+    def test_views_survive_growth(self):
+        memory = self.mapped()
+        addr = memory.allocate(sizeof(TSS64), 16, 'tss')
+        tss = memory.view(TSS64, addr)
+        # enough growth to move a resized bytearray
+        for i in range(64):
+            memory.allocate(16 * PGSIZE)
+        tss.rsp0 = 0x1234
+        self.assertEqual(memory.view(TSS64, addr).rsp0, 0x1234)
+        self.assertEqual(memory.read(addr + TSS64.rsp0.offset, 8), struct.pack('<Q', 0x1234))
+
+    def test_across_buffers(self):
+        memory = self.mapped()
+        first = memory.allocate(3)
+        memory.allocate(5, 8)
+        memory.write(PGSIZE - 2, '\x01' * 12)
+        self.assertEqual(memory.read(PGSIZE - 4, 16), bytearray('\x00\x00' + '\x01' * 12 + '\x00\x00'))
+        self.assertEqual(len(memory), PGSIZE + 13)
+        self.assertEqual(memory.copy(), memory.read(0, len(memory)))
+        self.assertEqual([addr for (addr, buf) in memory.extents()], [0, first, first + 3])
+        self.assertRaises(AssertionError, memory.view, c_uint64, first)
+
+def forked_state(sparse = False):
+    state = VMState(0x64, sparse)
+    state.setup_gdt()
+    state.memory.allocate(0x100, 1, 'code')
+    return state
+
+def snapshot(state):
+    return (state.raw(), list(state.memory.regions))
+
+class ForkTest(unittest.TestCase):
+    def change(self, state):
+        '''
+        Modify the registers, memory contents and region map of a state.
+        '''
+        state.regs.rip.value = 0x1234
+        state.regs.cr4.SMEP = 1
+        (start, end, name, cls) = state.memory.regions.named('code')[0]
+        state.memory.write(start, '\xcc' * 4)
+        state.memory.view(c_uint32, start + 4).value = 0xdeadbeef
+        state.memory.regions.add(0x10000, 0x10, 'extra')
+        state.memory.allocate(0x20, 1, 'more')
+
+    def check_isolated(self, parent):
+        before = snapshot(parent)
+        child = parent.fork()
+        self.assertEqual(snapshot(child), before)
+        self.change(child)
+        self.assertEqual(snapshot(parent), before)
+        # and the other way around
+        after = snapshot(child)
+        self.change(parent)
+        self.assertEqual(snapshot(child), after)
+
+    def test_dense(self):
+        self.check_isolated(forked_state())
+
+    def test_sparse(self):
+        parent = forked_state(True)
+        parent.memory.allocate_at(0xFEE00000, PGSIZE, 'apic')
+        self.check_isolated(parent)
+
+    def test_mapped(self):
+        raw = forked_state().raw()
+        buf = bytearray(raw)
+        parent = VMState.from_buffer(buf)
+        parent.memory.regions.add(0, 0x10, 'code')
+        # the buffer a mapped state views is not written through a fork
+        self.change(parent.fork())
+        self.assertEqual(buf, raw)
+        self.check_isolated(parent)
+
+    def test_cached_state(self):
+        calls = []
+        @cached_state
+        def build():
+            calls.append(None)
+            return forked_state()
+        pristine = snapshot(build())
+        self.change(build())
+        self.assertEqual(snapshot(build()), pristine)
+        self.assertEqual(len(calls), 1)
+
+def paged_state(arch, pae = False, huge = True):
+    state = VMState(arch)
+    state.setup_gdt()
+    state.setup_paging(pae, huge)
+    return state
+
+class PagingTest(unittest.TestCase):
+    def test_walk(self):
+        addr = 0x12345678
+        for (arch, pae, huge, size) in ((0x86, False, True, 1 << 22), (0x86, True, True, 1 << 21),
+                                        (0x64, False, True, 1 << 30), (0x64, False, False, 1 << 21)):
+            state = paged_state(arch, pae, huge)
+            (base, page, tables) = state.walk(addr)
+            self.assertEqual((base, page), (addr & ~(size - 1), size))
+            # one table page per level, as laid out by the template
+            expected = [start for (start, end, name, cls) in state.memory.regions if name in ('pml4', 'pdpt', 'pd')]
+            self.assertEqual(tables, expected[:len(tables)])
+            self.assertEqual(tables[0], state.regs.cr3.value & ~0xfff)
+            for virt in (0, addr, 0xfffff000, 0x80000001):
+                self.assertEqual(state.translate(virt), virt)
+
+    def test_unpaged(self):
+        state = VMState()
+        state.setup_gdt()
+        self.assertEqual(state.translate(0x12345678), 0x12345678)
+
+    def test_read_write_virt(self):
+        for arch in (0x86, 0x64):
+            state = paged_state(arch)
+            page = state.memory.allocate(2 * PGSIZE, PGSIZE) + PGSIZE
+            self.assertEqual(state.pages(page - 4, 8, 'ds'), [(page - 4, 4), (page, 4)])
+            state.write_virt(page - 4, '\x11' * 8)
+            self.assertEqual(state.memory.read(page - 4, 8), '\x11' * 8)
+            self.assertEqual(state.read_virt(page - 6, 12), bytearray('\x00\x00' + '\x11' * 8 + '\x00\x00'))
+
+    def test_remap(self):
+        state = paged_state(0x86)
+        pd = state.regs.cr3.value
+        self.assertEqual(state.translate(0x400010), 0x400010)
+        # writes to a cached page table through write_virt() flush the TLB
+        pde = PDE32.from_buffer_copy(str(state.memory.read(pd + 4, 4)))
+        pde.pfn = 0
+        state.write_virt(pd + 4, bytearray(pde))
+        self.assertEqual(state.translate(0x400010), 0x10)
+        self.assertEqual(state.read_virt(0x400000, 8), state.memory.read(0, 8))
+        # direct writes need an explicit flush
+        pde.p = 0
+        state.memory.write(pd + 4, bytearray(pde))
+        self.assertEqual(state.translate(0x400010), 0x10)
+        state.flush_tlb()
+        self.assertRaises(AssertionError, state.translate, 0x400010)
+        self.assertRaises(AssertionError, state.write_virt, 0x3ffffc, '\x00' * 8)
+
+    def test_tlb_key(self):
+        state = paged_state(0x64)
+        state.translate(0x1000)
+        self.assertEqual(len(state.tlb), 1)
+        state.regs.cr4.PSE = 0
+        self.assertEqual(state.translate(0x2000), 0x2000)
+        self.assertEqual(state.tlb.keys(), [2])
+        for page in range(VMState.TLB_ENTRIES + 1):
+            state.translate(page << 12)
+        self.assertLessEqual(len(state.tlb), VMState.TLB_ENTRIES)
+
+    def test_segment_limit(self):
+        state = paged_state(0x86)
+        state.regs.ds.limit = 0xfff
+        self.assertEqual(state.read_virt(0xff8, 8), state.memory.read(0xff8, 8))
+        self.assertRaises(AssertionError, state.read_virt, 0xffc, 8)
+        # 64-bit mode ignores the limits, and the base of all but fs and gs
+        state = paged_state(0x64)
+        state.regs.ds.limit = 0
+        state.regs.ds.base = 0x1000
+        state.regs.fs.base = 0x1000
+        self.assertEqual(state.linear(0x10, 8, 'ds'), 0x10)
+        self.assertEqual(state.linear(0x10, 8, 'fs'), 0x1010)
+
+class CompressTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.codecs = ['zlib'] + (['lzma'] if lzma else [])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def states(self):
+        sparse = VMState(0x64, True)
+        sparse.setup_gdt()
+        sparse.memory.allocate_at(0xFEE00000, PGSIZE, 'apic')
+        dense = VMState(0x64)
+        dense.setup_gdt()
+        dense.setup_paging()
+        return [dense, sparse]
+
+    def test_round_trip(self):
+        for codec in self.codecs:
+            for state in self.states():
+                blob = compress_seed(state.raw(), codec, 1)
+                self.assertEqual(blob[:len(COMPRESSED_MAGIC)], COMPRESSED_MAGIC)
+                self.assertEqual(struct.unpack_from('<IQ', blob, len(COMPRESSED_MAGIC)), (CODECS[codec], len(state.raw())))
+                self.assertLess(len(blob), len(state.raw()))
+                self.assertEqual(decompress_seed(blob), state.raw())
+                self.assertEqual(VMState.from_buffer(bytearray(blob)).raw(), state.raw())
+
+    def test_save_load(self):
+        path = os.path.join(self.folder, 'seed.bin')
+        for codec in self.codecs:
+            for state in self.states():
+                state.save(path, codec)
+                self.assertEqual(VMState.load(path).raw(), state.raw())
+
+    def test_pack(self):
+        path = os.path.join(self.folder, 'seeds.pack')
+        states = self.states()
+        states.insert(1, states[0].fork())
+        states[1].regs.rip.value = 0x1000
+        with SeedPackWriter(path, True, 'zlib') as writer:
+            for (i, state) in enumerate(states):
+                writer.add('%d.bin' % i, state.raw())
+        seeds = SeedPack.open(path)
+        for (i, state) in enumerate(states):
+            self.assertEqual(seeds.raw(i), state.raw())
+            self.assertEqual(seeds[i].regs.rip.value, state.regs.rip.value)
+
+    def test_errors(self):
+        blob = compress_seed(self.states()[0].raw())
+        self.assertRaises(AssertionError, decompress_seed, blob[:12] + struct.pack('<Q', 1) + blob[20:])
+        self.assertRaises(AssertionError, decompress_seed, blob[:8] + struct.pack('<I', 7) + blob[12:])
+        self.assertRaises(AssertionError, compress_seed, blob, 'bz2')
+
+class ProfilerTest(unittest.TestCase):
+    def test_serialization(self):
+        state = VMState(0x64)
+        state.setup_gdt()
+        profiler = Profiler()
+        profiler.enable()
+        try:
+            with profiler.stage('test'):
+                chunks = list(state.iter_chunks())
+                state.write_to(StringIO.StringIO())
+        finally:
+            profiler.disable()
+        self.assertEqual(''.join(chunk.tobytes() for chunk in chunks), state.raw())
+        # write_to() goes through iter_chunks() once more
+        calls = dict((label, calls) for (stage, label, calls, seconds) in profiler.rows())
+        self.assertEqual(calls, {'VMState.iter_chunks': 2, 'VMState.write_to': 1})
+
+class DescriptorTableTest(unittest.TestCase):
+    def test_append(self):
+        for sparse in (False, True):
+            state = VMState(0x64, sparse)
+            state.setup_gdt()
+            limit = state.regs.gdtr.limit
+            selector = state.gdt.append(CallGateDesc64(0x1234, 0x8, 0, 3, 1))
+            self.assertEqual(selector, limit + 1)
+            self.assertEqual(state.regs.gdtr.limit, limit + 16)
+            self.assertIsInstance(state.gdt[selector], CallGateDesc64)
+            self.assertEqual(state.gdt[selector].offset(), 0x1234)
+
+    def test_append_not_at_end(self):
+        for sparse in (False, True):
+            state = VMState(0x86, sparse)
+            state.setup_gdt()
+            state.memory.allocate(0x10, 1, 'code')
+            (size, regions, limit) = (len(state.memory), list(state.memory.regions), state.regs.gdtr.limit)
+            self.assertRaises(AssertionError, state.gdt.append, SegDesc32())
+            # nothing is allocated when the table cannot grow
+            self.assertEqual((len(state.memory), list(state.memory.regions), state.regs.gdtr.limit), (size, regions, limit))
+            self.assertEqual(state.memory.allocate(1), size)
+
+if __name__ == '__main__':
+    unittest.main()
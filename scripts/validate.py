@@ -0,0 +1,197 @@
+import os
+import sys
+import struct
+import argparse
+import multiprocessing
+from vmstate import *
+from vmdiff import read_span, page_tables
+
+SEGMENTS = ('cs', 'ss', 'ds', 'es', 'fs', 'gs', 'tr')
+
+# cached attributes that must agree with the descriptor
+CACHE_FIELDS = ('base', 'limit', 'type', 's', 'dpl', 'p', 'avl', 'l', 'db', 'g')
+
+def check_segments(state):
+    '''
+    Reload every segment register from the GDT and compare the result with
+    its hidden cache.
+    '''
+    regs = state.regs
+    ans = []
+    for name in SEGMENTS:
+        reg = getattr(regs, name)
+        if reg.selector & ~0b11 == 0:
+            # null selectors are allowed for data segments
+            if name in ('cs', 'tr'):
+                ans.append('%s: null selector' % name)
+            continue
+        if reg.selector & 0b100:
+            ans.append('%s: selector 0x%x refers to the LDT' % (name, reg.selector))
+            continue
+        if (reg.selector | 0b111) > regs.gdtr.limit:
+            ans.append('%s: selector 0x%x is beyond the GDT limit 0x%x' % (name, reg.selector, regs.gdtr.limit))
+            continue
+        expected = RegSeg64()
+        try:
+            state.load_seg(expected, reg.selector)
+        except (AssertionError, NotImplementedError, ValueError):
+            ans.append('%s: selector 0x%x refers to an unsupported descriptor' % (name, reg.selector))
+            continue
+        for field in CACHE_FIELDS:
+            (a, b) = (getattr(reg, field), getattr(expected, field))
+            if a != b:
+                ans.append('%s.%s: cache 0x%x, descriptor 0x%x' % (name, field, a, b))
+    return ans
+
+def check_tables(state):
+    '''
+    Check that the descriptor tables, the TSSs referred to by the GDT and
+    the current TSS lie inside memory.
+    '''
+    regs = state.regs
+    size = len(state.memory)
+    long_mode = regs.efer.LMA
+    tss = TSS64 if long_mode else TSS32
+    ans = []
+    for name in ('gdtr', 'idtr'):
+        table = getattr(regs, name)
+        if table.base + table.limit + 1 > size:
+            ans.append('%s: [0x%x, 0x%x] is outside memory' % (name, table.base, table.base + table.limit))
+    gdt = read_span(state.memory, regs.gdtr.base, regs.gdtr.base + regs.gdtr.limit + 1)
+    off = 0
+    while off + sizeof(SegDesc32) <= len(gdt):
+        cls = desc_class(gdt[off:], long_mode)
+        if issubclass(cls, TssDesc32) and off + sizeof(cls) <= len(gdt):
+            desc = cls.from_buffer_copy(str(gdt[off:off + sizeof(cls)]))
+            if desc.p:
+                if desc.limit() + 1 < sizeof(tss):
+                    ans.append('gdt[0x%x]: TSS limit 0x%x is below 0x%x' % (off, desc.limit(), sizeof(tss) - 1))
+                if desc.base() + max(desc.limit() + 1, sizeof(tss)) > size:
+                    ans.append('gdt[0x%x]: TSS at 0x%x is outside memory' % (off, desc.base()))
+        off += sizeof(cls)
+    if regs.cr0.PE and regs.tr.p and regs.tr.base + max(regs.tr.limit + 1, sizeof(tss)) > size:
+        ans.append('tr: TSS at 0x%x is outside memory' % regs.tr.base)
+    return ans
+
+def check_paging(state):
+    '''
+    Check that every paging structure reachable from cr3 lies inside memory.
+    '''
+    size = len(state.memory)
+    ans = []
+    for (addr, cls, label) in page_tables(state):
+        end = addr + (4 * sizeof(PDPTE) if label == 'pdpt' and not state.regs.efer.LMA else PGSIZE)
+        if end > size:
+            ans.append('%s: table at 0x%x is outside memory' % (label, addr))
+    return ans
+
+def validate(state):
+    '''
+    Check the internal consistency of a VM state. Returns a list of
+    violations (empty if the state is consistent).
+    '''
+    if not state.regs.cr0.PE:
+        # real mode: segment caches and tables are not checked
+        return []
+    return check_segments(state) + check_tables(state) + check_paging(state)
+
+def validate_raw(raw):
+    return validate(VMState.from_buffer(bytearray(raw)))
+
+class ValidatingWriter(object):
+    '''
+    Wrap a writer to drop the seeds that fail validation, so that broken
+    seeds never reach the corpus. add() returns False for dropped seeds.
+    '''
+    def __init__(self, writer, verbose = True):
+        self.writer = writer
+        self.verbose = verbose
+        self.rejected = 0
+
+    def add(self, name, raw):
+        violations = validate_raw(raw)
+        if violations:
+            self.rejected += 1
+            if self.verbose:
+                print >> sys.stderr, '%s: %s' % (name, '; '.join(violations))
+            return False
+        return self.writer.add(name, raw)
+
+    def link(self, name, target):
+        return self.writer.link(name, target)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# seed pack opened once per worker process
+_pack = None
+
+def open_pack(path):
+    global _pack
+    _pack = SeedPack.open(path)
+
+def unreadable(error, size):
+    '''
+    Describe a seed that cannot be loaded (e.g., a truncated file).
+    '''
+    if size < sizeof(RegFile):
+        return ['truncated: %d bytes < sizeof(REG_FILE)' % size]
+    return ['unreadable: %s' % error]
+
+def validate_file(path):
+    name = os.path.basename(path)
+    try:
+        state = VMState.load(path)
+    except (ValueError, struct.error) as e:
+        return (name, unreadable(e, os.path.getsize(path)))
+    return (name, validate(state))
+
+def validate_entry(index):
+    (name, offset, size) = _pack.entries[index]
+    try:
+        state = _pack[index]
+    except (ValueError, struct.error) as e:
+        return (name, unreadable(e, size))
+    return (name, validate(state))
+
+def validate_corpus(path, workers = multiprocessing.cpu_count()):
+    '''
+    Validate a seed folder or seed pack across a pool of processes, yielding
+    (name, violations) for every seed in order.
+    '''
+    if os.path.isdir(path):
+        (func, tasks, init) = (validate_file, seed_files(path), None)
+    else:
+        (func, tasks, init) = (validate_entry, range(len(SeedPack.open(path))), open_pack)
+    if workers <= 1:
+        if init:
+            init(path)
+        for task in tasks:
+            yield func(task)
+        return
+    pool = multiprocessing.Pool(workers, init, (path,) if init else ())
+    try:
+        for result in pool.imap(func, tasks, chunksize = 64):
+            yield result
+    finally:
+        pool.terminate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', metavar = '/path/to/seeds', help = 'seed folder or seed pack')
+    parser.add_argument('-j', type = int, dest = 'jobs', default = multiprocessing.cpu_count(), help = 'number of worker processes')
+    args = parser.parse_args()
+    (total, invalid) = (0, 0)
+    for (name, violations) in validate_corpus(args.path, args.jobs):
+        total += 1
+        if violations:
+            invalid += 1
+            print '%s: %s' % (name, '; '.join(violations))
+    print '%d of %d seeds valid' % (total - invalid, total)
+    sys.exit(1 if invalid else 0)
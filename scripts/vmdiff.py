@@ -0,0 +1,215 @@
+import sys
+import bisect
+import argparse
+from vmstate import *
+
+def diff_struct(old, new, prefix = ''):
+    '''
+    Compare two structures field by field (bit fields included) and return
+    the (name, old value, new value) tuples that differ.
+    '''
+    ans = []
+    for field_info in new._fields_:
+        (a, b) = (getattr(old, field_info[0]), getattr(new, field_info[0]))
+        name = prefix + field_info[0]
+        if isinstance(b, (Reg32, Reg64)):
+            # plain registers are reported without the '.value' suffix
+            (a, b) = (a.value, b.value)
+        if isinstance(b, Structure):
+            ans += diff_struct(a, b, name + '.')
+        elif a != b:
+            ans.append((name, a, b))
+    return ans
+
+def read_span(memory, start, end):
+    '''
+    Read [start, end) from any memory backend, with zeros for the parts
+    that are not populated.
+    '''
+    ans = bytearray(end - start)
+    for (addr, buf) in memory.extents():
+        lo = max(start, addr)
+        hi = min(end, addr + len(buf))
+        if lo < hi:
+            ans[lo - start:hi - start] = bytearray(buf[lo - addr:hi - addr])
+    return ans
+
+def block_addresses(memory, block):
+    '''
+    Return the addresses of the blocks overlapping the populated extents.
+    '''
+    ans = set()
+    for (addr, buf) in memory.extents():
+        ans.update(xrange(addr & ~(block - 1), addr + len(buf), block))
+    return ans
+
+def block_reader(memory, block):
+    '''
+    Return a function reading the block at an address, as a view of the
+    extent backing it (or as a copy padded with zeros if the block is not
+    entirely backed by one extent).
+    '''
+    extents = sorted(memory.extents(), key = lambda extent: extent[0])
+    starts = [addr for (addr, buf) in extents]
+    def read(addr):
+        i = bisect.bisect_right(starts, addr) - 1
+        if i >= 0 and addr + block <= starts[i] + len(extents[i][1]):
+            return buffer(extents[i][1], addr - starts[i], block)
+        return buffer(read_span(memory, addr, addr + block))
+    return read
+
+def changed_memory(old, new, block = PGSIZE, gap = 8):
+    '''
+    Return the [start, end) ranges where the memory of new differs from
+    the memory of old, unpopulated memory reading as zeros. Only the
+    blocks populated in either state are compared, without copying them,
+    and only the blocks that differ are copied and scanned byte by byte.
+    Ranges separated by less than gap equal bytes are merged.
+    '''
+    (read_old, read_new) = (block_reader(old, block), block_reader(new, block))
+    ranges = []
+    for addr in sorted(block_addresses(old, block) | block_addresses(new, block)):
+        (a, b) = (read_old(addr), read_new(addr))
+        if a == b:
+            continue
+        for (start, end) in changed_ranges(a, b, gap):
+            if ranges and ranges[-1][1] + gap >= addr + start:
+                ranges[-1][1] = addr + end
+            else:
+                ranges.append([addr + start, addr + end])
+    return ranges
+
+def page_tables(state):
+    '''
+    Enumerate the paging structures reachable from cr3 as (address, entry
+    class, label) tuples, one per table page. Tables outside of memory are
+    included but read as zeros (so nothing below them is walked).
+    '''
+    regs = state.regs
+    if not regs.cr0.PG:
+        return []
+    tables = []
+    def walk(addr, levels, label):
+        # levels lists the (entry class, name, large page allowed) from this level down
+        (cls, name, large) = levels[0]
+        tables.append((addr, cls, label + name))
+        if len(levels) == 1:
+            return
+        raw = read_span(state.memory, addr, addr + PGSIZE)
+        for i in range(PGSIZE / sizeof(cls)):
+            entry = cls.from_buffer(raw, i * sizeof(cls))
+            if entry.p and not (large and entry.ps):
+                walk(entry.pfn << 12, levels[1:], '%s%s[%d].' % (label, name, i))
+    if regs.efer.LMA:
+        walk(regs.cr3.value & ~0xfff, [(PML4E, 'pml4', False), (PDPTE, 'pdpt', True), (PDE64, 'pd', True), (PTE64, 'pt', False)], '')
+    elif regs.cr4.PAE:
+        pdpt = regs.cr3.value & ~0x1f
+        tables.append((pdpt, PDPTE, 'pdpt'))
+        raw = read_span(state.memory, pdpt, pdpt + 4 * sizeof(PDPTE))
+        for i in range(4):
+            entry = PDPTE.from_buffer(raw, i * sizeof(PDPTE))
+            if entry.p:
+                walk(entry.pfn << 12, [(PDE64, 'pd', True), (PTE64, 'pt', False)], 'pdpt[%d].' % i)
+    else:
+        walk(regs.cr3.value & ~0xfff, [(PDE32, 'pd', regs.cr4.PSE), (PTE32, 'pt', False)], '')
+    return tables
+
+def structures(state):
+    '''
+    Enumerate the known structures in memory as (start, end, label, class)
+    tuples, where class decodes the bytes (None if unknown).
+    '''
+    regs = state.regs
+    long_mode = regs.efer.LMA
+    ans = []
+    # GDT entries (system descriptors take two slots in long mode)
+    gdt = read_span(state.memory, regs.gdtr.base, regs.gdtr.base + regs.gdtr.limit + 1)
+    off = 0
+    while off + sizeof(SegDesc32) <= len(gdt):
+        cls = desc_class(gdt[off:], long_mode)
+        ans.append((regs.gdtr.base + off, regs.gdtr.base + off + sizeof(cls), 'gdt[0x%x]' % off, cls))
+        if issubclass(cls, TssDesc32) and off + sizeof(cls) <= len(gdt):
+            # the TSS referred to by this descriptor
+            desc = cls.from_buffer_copy(str(gdt[off:off + sizeof(cls)]))
+            tss = TSS64 if long_mode else TSS32
+            ans.append((desc.base(), desc.base() + max(desc.limit() + 1, sizeof(tss)), 'tss[0x%x]' % off, tss))
+        off += sizeof(cls)
+    # IDT entries
+    if regs.cr0.PE:
+        size = 16 if long_mode else 8
+        idt = read_span(state.memory, regs.idtr.base, regs.idtr.base + regs.idtr.limit + 1)
+        for off in range(0, len(idt) - size + 1, size):
+            ans.append((regs.idtr.base + off, regs.idtr.base + off + size, 'idt[%d]' % (off / size), desc_class(idt[off:], long_mode)))
+    # current TSS
+    if regs.tr.p:
+        ans.append((regs.tr.base, regs.tr.base + regs.tr.limit + 1, 'tss', TSS64 if long_mode else TSS32))
+    # page tables
+    for (addr, cls, label) in page_tables(state):
+        count = 4 if cls == PDPTE and not long_mode else PGSIZE / sizeof(cls)
+        for i in range(count):
+            start = addr + i * sizeof(cls)
+            ans.append((start, start + sizeof(cls), '%s[%d]' % (label, i), cls))
+    # code at rip
+    ans.append((regs.cs.base + regs.rip.value, regs.cs.base + regs.rip.value + 16, 'code', None))
+    # named allocations (see RegionMap)
+    for (start, end, name, cls) in state.memory.regions:
+        ans.append((start, end, '%s@%x' % (name, start), None))
+    return sorted(ans)
+
+def diff(old, new):
+    '''
+    Compare two VM states. Returns (register changes, memory changes),
+    where memory changes are (start, end, [(label, field changes)]) tuples.
+    '''
+    regs = diff_struct(old.regs, new.regs)
+    ranges = changed_memory(old.memory, new.memory)
+    (before, after) = (structures(old), structures(new))
+    memory = []
+    for (start, end) in ranges:
+        owners = []
+        seen = set()
+        # use the layout of both states, as the change itself may move tables
+        for (lo, hi, label, cls) in before + after:
+            if lo >= end or hi <= start or label in seen:
+                continue
+            seen.add(label)
+            changes = []
+            if cls is not None and hi - lo >= sizeof(cls):
+                a = cls.from_buffer_copy(str(read_span(old.memory, lo, lo + sizeof(cls))))
+                b = cls.from_buffer_copy(str(read_span(new.memory, lo, lo + sizeof(cls))))
+                changes = diff_struct(a, b)
+            owners.append((label, changes))
+        memory.append((start, end, owners))
+    return (regs, memory)
+
+# changed memory ranges up to this size are also shown as bytes
+SHOW_BYTES = 32
+
+def format_diff(old, new):
+    (regs, memory) = diff(old, new)
+    lines = []
+    for (name, a, b) in regs:
+        lines.append('%s: %s -> %s' % (name, hex(a), hex(b)))
+    if len(old.memory) != len(new.memory):
+        lines.append('memory size: %s -> %s' % (hex(len(old.memory)), hex(len(new.memory))))
+    for (start, end, owners) in memory:
+        lines.append('memory [%08x, %08x):' % (start, end))
+        if end - start <= SHOW_BYTES:
+            lines.append('    old: %s' % str(read_span(old.memory, start, end)).encode('hex'))
+            lines.append('    new: %s' % str(read_span(new.memory, start, end)).encode('hex'))
+        if not owners:
+            lines.append('    (unknown)')
+        for (label, changes) in owners:
+            lines.append('    %s' % label)
+            for (name, a, b) in changes:
+                lines.append('        %s: %s -> %s' % (name, hex(a), hex(b)))
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old', metavar = 'a.bin', help = 'the original (e.g., parent) state')
+    parser.add_argument('new', metavar = 'b.bin', help = 'the modified (e.g., mutated) state')
+    args = parser.parse_args()
+    lines = format_diff(VMState.load(args.old), VMState.load(args.new))
+    if lines:
+        print '\n'.join(lines)
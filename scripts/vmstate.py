@@ -1,10 +1,49 @@
 import os
 import sys
+import csv
+import json
+import time
+import mmap
+import inspect
+import argparse
 import struct
+import bisect
+import zlib
+import functools
+import contextlib
 from ctypes import *
 
+try:
+    import lzma
+except ImportError:
+    # Python 2 only has lzma through the backports.lzma package
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 PGSIZE = 0x1000
 
+SPARSE_MAGIC = 'HFSPARSE'
+PACK_MAGIC = 'HFSDPACK'
+PACK_VERSION = 1
+DELTA_MAGIC = 'HFSDELTA'
+COMPRESSED_MAGIC = 'HFSZSEED'
+
+# codec ids stored in compressed seeds
+CODECS = {'zlib': 1, 'lzma': 2}
+# compression level: 1 is the fastest, 9 the smallest
+COMPRESS_LEVEL = 6
+
+def byteview(buf):
+    '''
+    Return a flat memoryview of the bytes of buf (e.g., a ctypes structure).
+    '''
+    if hasattr(memoryview, 'cast'):
+        return memoryview(buf).cast('B')
+    # Python 2 views ctypes objects as a single item, so go through buffer()
+    return memoryview(buffer(buf))
+
 def dumps(struct):
     assert isinstance(struct, Structure)
     ans = ['{']
@@ -18,6 +57,52 @@ def dumps(struct):
     ans.append('}')
     return ' '.join(ans)
 
+def todict(struct):
+    '''
+    Convert a structure into nested dicts of integers (e.g., for JSON).
+    '''
+    assert isinstance(struct, Structure)
+    ans = {}
+    for field_info in struct._fields_:
+        field = getattr(struct, field_info[0])
+        ans[field_info[0]] = todict(field) if isinstance(field, Structure) else field
+    return ans
+
+HEXLINE = ' '.join(['%02x'] * 16)
+
+def hexdump(buf, start = 0, collapse = True):
+    '''
+    Format a buffer as hex lines of 16 bytes. With collapse, a run of lines
+    identical to the previous one (e.g., zeros) is shown as a single '*',
+    followed by the last line of the run.
+    '''
+    buf = bytearray(buf)
+    lines = []
+    prev = None
+    off = 0
+    while off < len(buf):
+        line = buf[off:off + 16]
+        if collapse and line == prev:
+            # off is on a line of the run: skip 1KB at a time first, as long
+            # as the whole next block is still part of the run
+            block = prev * 64
+            while buf[off + 16:off + 16 + len(block)] == block:
+                off += len(block)
+            while off + 16 < len(buf) and buf[off + 16:off + 32] == prev:
+                off += 16
+            lines.append('*')
+            if off + 16 >= len(buf):
+                lines.append('%08x: %s' % (start + off, ' '.join(['%02x'] * len(prev)) % tuple(prev)))
+            off += 16
+            continue
+        prev = line
+        if len(line) == 16:
+            lines.append('%08x: %s' % (start + off, HEXLINE % tuple(line)))
+        else:
+            lines.append('%08x: %s' % (start + off, ' '.join(['%02x'] * len(line)) % tuple(line)))
+        off += 16
+    return lines
+
 class TSS32(Structure):
     _pack_ = 1
     _fields_ = [('prev_task_link', c_uint16),
@@ -569,13 +654,150 @@ class RegFile(Structure):
                 ('sfmask', Reg32)]
 
     def __init__(self):
-        for field_info in self._fields_:
-            setattr(self, field_info[0], field_info[1]())
+        # ctypes zero-fills the structure, so only the registers whose class
+        # sets a default (e.g., RegEflags.one) need to be constructed
+        for (name, cls) in self._initialized_:
+            setattr(self, name, cls())
+
+RegFile._initialized_ = [field_info for field_info in RegFile._fields_ if '__init__' in vars(field_info[1])]
+
+# zero-filled block used to grow memory without building temporary strings
+ZEROS = memoryview(bytearray(16 * PGSIZE))
+
+def grow(buf, size):
+    '''
+    Append size zero bytes to a bytearray.
+    '''
+    while size > len(ZEROS):
+        buf += ZEROS
+        size -= len(ZEROS)
+    if size > 0:
+        buf += ZEROS[:size]
+
+# file name suffix of the region map saved next to a seed
+REGIONS_SUFFIX = '.regions.json'
+
+def seed_files(folder):
+    '''
+    Return the paths of the seed files in a folder in name order, leaving
+    out the region maps saved next to them.
+    '''
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if not name.endswith(REGIONS_SUFFIX)]
+
+class RegionMap(object):
+    '''
+    Interval index of the named memory regions (e.g., 'gdt', 'tss', 'pml4',
+    'code', 'stack'), each optionally typed with the name of the ctypes
+    class laid out in it. Regions are (start, end, name, type) tuples kept
+    sorted by start address, and are not expected to overlap.
+    '''
+    __slots__ = ('regions', 'starts', 'shared')
+
+    def __init__(self, regions = ()):
+        self.regions = sorted(regions)
+        self.starts = [region[0] for region in self.regions]
+        self.shared = False # the lists are shared with a copy
+
+    def __nonzero__(self):
+        return bool(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def add(self, start, size, name, cls = None):
+        if cls is not None and not isinstance(cls, str):
+            cls = cls.__name__
+        if self.shared:
+            (self.regions, self.starts, self.shared) = (self.regions[:], self.starts[:], False)
+        if self.starts and start < self.starts[-1]:
+            i = bisect.bisect_right(self.starts, start)
+            self.starts.insert(i, start)
+            self.regions.insert(i, (start, start + size, name, cls))
+        else:
+            # allocations are mostly appended at the top
+            self.starts.append(start)
+            self.regions.append((start, start + size, name, cls))
+
+    def find(self, addr):
+        '''
+        Return the region containing addr, or None.
+        '''
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.regions[i][1]:
+            return self.regions[i]
+        return None
+
+    def overlapping(self, start, end):
+        '''
+        Return the regions overlapping [start, end).
+        '''
+        i = bisect.bisect_left(self.starts, start)
+        if i > 0 and self.regions[i - 1][1] > start:
+            i -= 1
+        ans = []
+        while i < len(self.regions) and self.regions[i][0] < end:
+            if self.regions[i][1] > start:
+                ans.append(self.regions[i])
+            i += 1
+        return ans
+
+    def named(self, *names):
+        return [region for region in self.regions if region[2] in names]
+
+    def copy(self):
+        # copy-on-write: both maps share the lists until one of them changes
+        ans = RegionMap.__new__(RegionMap)
+        (ans.regions, ans.starts) = (self.regions, self.starts)
+        ans.shared = self.shared = True
+        return ans
+
+    def todict(self):
+        return [{'start': start, 'end': end, 'name': name, 'type': cls} for (start, end, name, cls) in self.regions]
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.todict(), f, indent = 2)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return RegionMap([(region['start'], region['end'], str(region['name']), region['type'] and str(region['type']))
+                              for region in json.load(f)])
 
 class Memory(bytearray):
-    def allocate(self, size, alignment = 1):
-        addr = (len(self) + alignment - 1) / alignment * alignment
-        self.extend('\x00' * (addr + size - len(self)))
+    _regions = None
+
+    @property
+    def regions(self):
+        # created on demand, so plain buffers stay as cheap as a bytearray
+        if self._regions is None:
+            self._regions = RegionMap()
+        return self._regions
+
+    @regions.setter
+    def regions(self, regions):
+        self._regions = regions
+
+    def next_address(self, size, alignment = 1):
+        '''
+        Return the address allocate() would return, without allocating.
+        '''
+        return (len(self) + alignment - 1) / alignment * alignment
+
+    def allocate(self, size, alignment = 1, name = None, cls = None):
+        '''
+        Allocate size bytes at the top of memory, and record them in the
+        region map if a name (and optionally a ctypes class) is given.
+        '''
+        addr = self.next_address(size, alignment)
+        grow(self, addr + size - len(self))
+        if name:
+            if self._regions is None:
+                self._regions = RegionMap()
+            self._regions.add(addr, size, name, cls)
         return addr
 
     def write(self, addr, content):
@@ -586,10 +808,468 @@ class Memory(bytearray):
         assert addr + size <= len(self)
         return self[addr:addr + size]
 
+    def view(self, cls, addr):
+        return cls.from_buffer(self, addr)
+
+    def copy(self):
+        memory = Memory(self)
+        if self._regions is not None:
+            memory._regions = self._regions.copy()
+        return memory
+
+    def extents(self):
+        '''
+        Enumerate the populated (address, buffer) ranges.
+        '''
+        yield (0, self)
+
+class MappedMemory(object):
+    '''
+    Memory overlaid on an existing buffer (e.g., an mmap of a seed file)
+    without copying. With a private (ACCESS_COPY) mapping, pages are only
+    read when touched and only copied when first written, so opening a
+    multi-gigabyte seed costs no more than its register file. Memory
+    allocated past the end of the buffer lives in a tail of one buffer per
+    allocation. These are never resized (ctypes does not lock a bytearray
+    that is viewed with from_buffer), so views stay valid as memory grows.
+    '''
+    _types = {}
+
+    def __init__(self, buf, offset = 0, size = None):
+        if size is None:
+            size = len(buf) - offset
+        cls = MappedMemory._types.get(size)
+        if cls is None:
+            # ctypes arrays carry their length in the type, so build one per size
+            cls = type('MappedBuffer', (Array,), {'_type_': c_char, '_length_': size})
+            MappedMemory._types[size] = cls
+        self.base = cls.from_buffer(buf, offset)
+        self.starts = [] # addresses of the tail buffers
+        self.chunks = [] # tail buffers, parallel to starts
+        self.size = size
+        self.regions = RegionMap()
+
+    def __len__(self):
+        return self.size
+
+    def find(self, addr):
+        '''
+        Return the buffer holding addr and the offset of addr in it.
+        '''
+        if addr < len(self.base):
+            return (self.base, addr)
+        i = bisect.bisect_right(self.starts, addr) - 1
+        return (self.chunks[i], addr - self.starts[i])
+
+    def locate(self, addr, size):
+        '''
+        Find the buffer holding [addr, addr + size). Returns (buffer, offset).
+        '''
+        assert addr + size <= len(self)
+        (buf, off) = self.find(addr)
+        assert off + size <= len(buf), 'Range %x+%x crosses the end of a buffer' % (addr, size)
+        return (buf, off)
+
+    def next_address(self, size, alignment = 1):
+        return (len(self) + alignment - 1) / alignment * alignment
+
+    def allocate(self, size, alignment = 1, name = None, cls = None):
+        addr = self.next_address(size, alignment)
+        if addr + size > self.size:
+            self.starts.append(self.size)
+            self.chunks.append(bytearray(addr + size - self.size))
+            self.size = addr + size
+        if name:
+            self.regions.add(addr, size, name, cls)
+        return addr
+
+    def write(self, addr, content):
+        assert addr + len(content) <= len(self)
+        pos = 0
+        while pos < len(content):
+            (buf, off) = self.find(addr + pos)
+            part = content[pos:pos + len(buf) - off]
+            buf[off:off + len(part)] = str(part) if buf is self.base else part
+            pos += len(part)
+
+    def read(self, addr, size):
+        assert addr + size <= len(self)
+        ans = bytearray()
+        while len(ans) < size:
+            (buf, off) = self.find(addr + len(ans))
+            ans += buf[off:off + size - len(ans)]
+        return ans
+
+    def view(self, cls, addr):
+        (buf, off) = self.locate(addr, sizeof(cls))
+        return cls.from_buffer(buf, off)
+
+    def copy(self):
+        memory = Memory(self.base)
+        for buf in self.chunks:
+            memory += buf
+        memory.regions = self.regions.copy()
+        return memory
+
+    def extents(self):
+        yield (0, self.base)
+        for extent in zip(self.starts, self.chunks):
+            yield extent
+
+class SparseMemory(object):
+    '''
+    Memory that only stores populated pages, so contents can be placed at
+    arbitrary (e.g., MMIO-adjacent or above 4GB) guest-physical addresses.
+    Adjacent populated pages are merged into a single extent, which allows
+    ctypes overlays (see view()) to span page boundaries.
+    '''
+    def __init__(self):
+        self.starts = [] # sorted page-aligned extent addresses
+        self.buffers = [] # extent contents, parallel to starts
+        self.top = 0 # bump pointer used by allocate()
+        self.size = 0 # end of the highest allocated region
+        self.placed = [] # sorted [start, end) ranges placed with allocate_at()
+        self.regions = RegionMap()
+
+    def __len__(self):
+        return self.size
+
+    def populate(self, addr, size):
+        '''
+        Ensure the pages covering [addr, addr + size) are backed.
+        '''
+        self.size = max(self.size, addr + size)
+        if size == 0:
+            return
+        lo = addr & ~(PGSIZE - 1)
+        hi = (addr + size + PGSIZE - 1) & ~(PGSIZE - 1)
+        # find the extents overlapping or adjacent to [lo, hi)
+        first = bisect.bisect_left(self.starts, lo)
+        if first > 0 and self.starts[first - 1] + len(self.buffers[first - 1]) >= lo:
+            first -= 1
+        last = first
+        while last < len(self.starts) and self.starts[last] <= hi:
+            last += 1
+        if last - first == 1 and self.starts[first] <= lo and self.starts[first] + len(self.buffers[first]) >= hi:
+            return # already backed
+        if last - first == 1 and self.starts[first] <= lo:
+            # only the end of one extent moves: grow it in place
+            buf = self.buffers[first]
+            grow(buf, hi - self.starts[first] - len(buf))
+            return
+        if last > first:
+            lo = min(lo, self.starts[first])
+            hi = max(hi, self.starts[last - 1] + len(self.buffers[last - 1]))
+        # merge everything into one extent
+        merged = bytearray(hi - lo)
+        for i in range(first, last):
+            off = self.starts[i] - lo
+            merged[off:off + len(self.buffers[i])] = self.buffers[i]
+        self.starts[first:last] = [lo]
+        self.buffers[first:last] = [merged]
+
+    def locate(self, addr, size):
+        '''
+        Return the extent buffer and offset backing [addr, addr + size).
+        '''
+        i = bisect.bisect_right(self.starts, addr) - 1
+        assert i >= 0 and addr + size <= self.starts[i] + len(self.buffers[i]), 'Unpopulated address %x' % addr
+        return (self.buffers[i], addr - self.starts[i])
+
+    def next_address(self, size, alignment = 1):
+        '''
+        Return the address allocate() would return: the bump pointer,
+        moved past the ranges placed with allocate_at() that would overlap.
+        '''
+        addr = (self.top + alignment - 1) / alignment * alignment
+        for (start, end) in self.placed:
+            if start < addr + size and addr < end:
+                addr = (end + alignment - 1) / alignment * alignment
+        return addr
+
+    def allocate(self, size, alignment = 1, name = None, cls = None):
+        addr = self.next_address(size, alignment)
+        self.populate(addr, size)
+        self.top = addr + size
+        if name:
+            self.regions.add(addr, size, name, cls)
+        return addr
+
+    def allocate_at(self, addr, size, name = None, cls = None):
+        '''
+        Place a region at an explicit address without moving the bump pointer.
+        '''
+        self.populate(addr, size)
+        bisect.insort(self.placed, (addr, addr + size))
+        if name:
+            self.regions.add(addr, size, name, cls)
+        return addr
+
+    def write(self, addr, content):
+        (buf, off) = self.locate(addr, len(content))
+        buf[off:off + len(content)] = content
+
+    def read(self, addr, size):
+        (buf, off) = self.locate(addr, size)
+        return buf[off:off + size]
+
+    def view(self, cls, addr):
+        (buf, off) = self.locate(addr, sizeof(cls))
+        return cls.from_buffer(buf, off)
+
+    def copy(self):
+        memory = SparseMemory()
+        memory.starts = list(self.starts)
+        memory.buffers = [bytearray(buf) for buf in self.buffers]
+        memory.top = self.top
+        memory.size = self.size
+        memory.placed = list(self.placed)
+        memory.regions = self.regions.copy()
+        return memory
+
+    def extents(self):
+        return zip(self.starts, self.buffers)
+
+    def flatten(self):
+        '''
+        Convert to a dense Memory starting at address 0.
+        '''
+        memory = Memory(len(self))
+        for (addr, buf) in self.extents():
+            memory[addr:addr + len(buf)] = buf[:len(self) - addr]
+        memory.regions = self.regions.copy()
+        return memory
+
+    def raw(self):
+        '''
+        Serialize as UINT64 top, UINT64 size, UINT32 count, UINT32 placed,
+        count * (UINT64 addr, UINT64 size) for the extents, placed * (UINT64
+        addr, UINT64 size) for the allocate_at() ranges, followed by the
+        extent contents in the same order.
+        '''
+        return bytearray(self.header()) + bytearray().join(self.buffers)
+
+    def header(self):
+        '''
+        Serialize the part of raw() that precedes the extent contents.
+        '''
+        index = struct.pack('<QQII', self.top, self.size, len(self.starts), len(self.placed))
+        for (addr, buf) in self.extents():
+            index += struct.pack('<QQ', addr, len(buf))
+        for (start, end) in self.placed:
+            index += struct.pack('<QQ', start, end - start)
+        return index
+
+    @staticmethod
+    def from_raw(raw, offset = 0):
+        memory = SparseMemory()
+        (memory.top, memory.size, count, placed) = struct.unpack_from('<QQII', raw, offset)
+        offset += 24
+        data = offset + (count + placed) * 16
+        for i in range(count):
+            (addr, size) = struct.unpack_from('<QQ', raw, offset + i * 16)
+            memory.starts.append(addr)
+            memory.buffers.append(bytearray(raw[data:data + size]))
+            data += size
+        for i in range(count, count + placed):
+            (addr, size) = struct.unpack_from('<QQ', raw, offset + i * 16)
+            memory.placed.append((addr, addr + size))
+        return memory
+
+# system descriptor types and their (legacy, long mode) classes
+SYSTEM_DESCS = {0b0101: (TaskGateDesc32, None),
+                0b1001: (TssDesc32, TssDesc64),
+                0b1011: (TssDesc32, TssDesc64),
+                0b1100: (CallGateDesc32, CallGateDesc64),
+                0b1110: (IntGateDesc32, IntGateDesc64),
+                0b1111: (TrapGateDesc32, TrapGateDesc64)}
+
+def desc_class(raw, long_mode):
+    '''
+    Pick the descriptor class matching the raw 8-byte descriptor.
+    '''
+    desc = SegDesc32.from_buffer_copy(str(raw[:sizeof(SegDesc32)]))
+    if desc.s == 0 and desc.type in SYSTEM_DESCS:
+        return SYSTEM_DESCS[desc.type][1 if long_mode else 0] or SegDesc32
+    return SegDesc32
+
+class DescriptorTable(object):
+    '''
+    Typed view of the GDT (indexed by selector) or the IDT (indexed by
+    vector). Entries are decoded into the descriptor class matching their
+    type and the current mode, and the decoded views are cached until the
+    table is written through this object, moved, or memory grows. Changing
+    the type of an entry in place requires invalidate().
+    '''
+    def __init__(self, state, reg):
+        self.state = state
+        self.reg = reg
+        self.cache = {}
+        self.key = None
+
+    def table(self):
+        '''
+        Return the register describing the table, dropping the cache if the
+        table or the memory layout has changed.
+        '''
+        regs = self.state.regs
+        table = getattr(regs, self.reg)
+        key = (table.base, table.limit, regs.efer.LMA, len(self.state.memory))
+        if key != self.key:
+            self.cache = {}
+            self.key = key
+        return table
+
+    def invalidate(self):
+        self.cache = {}
+
+    def offset(self, index):
+        if self.reg == 'idtr':
+            return index * (16 if self.state.regs.efer.LMA else 8)
+        assert (index & 0b100) == 0, 'LDT is not supported yet'
+        return index & ~0b111
+
+    def entry(self, offset):
+        table = self.table()
+        desc = self.cache.get(offset)
+        if desc is None:
+            memory = self.state.memory
+            assert offset + sizeof(SegDesc32) - 1 <= table.limit, 'Offset 0x%x is beyond the %s limit' % (offset, self.reg)
+            cls = desc_class(memory.read(table.base + offset, sizeof(SegDesc32)), self.state.regs.efer.LMA)
+            desc = memory.view(cls, table.base + offset)
+            self.cache[offset] = desc
+        return desc
+
+    def __getitem__(self, index):
+        return self.entry(self.offset(index))
+
+    def __setitem__(self, index, desc):
+        table = self.table()
+        offset = self.offset(index)
+        assert offset + sizeof(desc) - 1 <= table.limit, 'Offset 0x%x is beyond the %s limit' % (offset, self.reg)
+        self.state.memory.write(table.base + offset, bytearray(desc))
+        self.invalidate()
+
+    def __iter__(self):
+        '''
+        Enumerate the (selector or vector, descriptor) pairs of the table.
+        '''
+        table = self.table()
+        size = self.offset(1) if self.reg == 'idtr' else sizeof(SegDesc32)
+        (offset, index) = (0, 0)
+        while offset + size - 1 <= table.limit:
+            desc = self.entry(offset)
+            yield (index if self.reg == 'idtr' else offset, desc)
+            offset += sizeof(desc) if self.reg == 'gdtr' else self.offset(1)
+            index += 1
+
+    def append(self, desc):
+        '''
+        Append a descriptor to a table that ends at the top of memory, and
+        return its selector or vector.
+        '''
+        table = self.table()
+        offset = table.limit + 1
+        memory = self.state.memory
+        # check before allocating, so nothing is left behind on failure
+        assert memory.next_address(sizeof(desc)) == table.base + offset, 'The %s table is not at the end of memory' % self.reg
+        addr = memory.allocate(sizeof(desc), 1, self.reg[:3], type(desc))
+        memory.write(addr, bytearray(desc))
+        table.limit += sizeof(desc)
+        return offset if self.reg == 'gdtr' else offset / self.offset(1)
+
+def cached_state(builder):
+    '''
+    Decorator for state builders that take no arguments: the state is built
+    only once, and every call returns a fork of it.
+    '''
+    cache = []
+    @functools.wraps(builder)
+    def wrapper():
+        if not cache:
+            cache.append(builder())
+        return cache[0].fork()
+    return wrapper
+
+PAGING_32 = '32bit'
+PAGING_PAE = 'pae'
+PAGING_4L_1G = '4level-1g'
+PAGING_4L_2M = '4level-2m'
+
+# the (name, entry class) of each table page used by a paging template
+PAGING_LAYOUT = {PAGING_32: [('pd', PDE32)],
+                 PAGING_PAE: [('pdpt', PDPTE)] + [('pd', PDE64)] * 4,
+                 PAGING_4L_1G: [('pml4', PML4E), ('pdpt', PDPTE)],
+                 PAGING_4L_2M: [('pml4', PML4E), ('pdpt', PDPTE)] + [('pd', PDE64)] * 4}
+
+_paging_templates = {}
+
+def paging_template(mode, base):
+    '''
+    Return the raw identity-mapping page tables for the given paging mode,
+    laid out as consecutive pages starting at base (the cr3 value). The
+    templates are built once per (mode, base) and cached.
+    '''
+    key = (mode, base)
+    if key in _paging_templates:
+        return _paging_templates[key]
+    raw = bytearray(len(PAGING_LAYOUT[mode]) * PGSIZE)
+    if mode == PAGING_32:
+        # one page directory of 4MB pages mapping [0, 4GB)
+        for i in range(PGSIZE / sizeof(PDE32)):
+            pde = PDE32.from_buffer(raw, i * sizeof(PDE32))
+            pde.p = 1
+            pde.w = 1
+            pde.u = 1
+            pde.ps = 1 # mark as a 4MB large page
+            pde.pfn = (i << 10)
+    elif mode == PAGING_4L_1G:
+        # make the first PML4 entry point to the PDPT in the next page
+        pml4e = PML4E.from_buffer(raw, 0)
+        pml4e.p = 1
+        pml4e.w = 1
+        pml4e.u = 1
+        pml4e.pfn = (base >> 12) + 1
+        # setup identity mapping for [0, 512GB)
+        for i in range(PGSIZE / sizeof(PDPTE)):
+            pdpte = PDPTE.from_buffer(raw, PGSIZE + i * sizeof(PDPTE))
+            pdpte.p = 1
+            pdpte.w = 1
+            pdpte.u = 1
+            pdpte.ps = 1 # mark as a 1GB large page (requires hardware support)
+            pdpte.pfn = (i << 18)
+    else:
+        # the PDPT is followed by 4 page directories of 2MB pages mapping [0, 4GB)
+        pdpt = 0
+        if mode == PAGING_4L_2M:
+            pml4e = PML4E.from_buffer(raw, 0)
+            pml4e.p = 1
+            pml4e.w = 1
+            pml4e.u = 1
+            pml4e.pfn = (base >> 12) + 1
+            pdpt = PGSIZE
+        for i in range(4):
+            pdpte = PDPTE.from_buffer(raw, pdpt + i * sizeof(PDPTE))
+            pdpte.p = 1
+            if mode == PAGING_4L_2M:
+                # PAE PDPTEs reserve the access right bits
+                pdpte.w = 1
+                pdpte.u = 1
+            pdpte.pfn = ((base + pdpt) >> 12) + 1 + i
+            for j in range(PGSIZE / sizeof(PDE64)):
+                pde = PDE64.from_buffer(raw, pdpt + (1 + i) * PGSIZE + j * sizeof(PDE64))
+                pde.p = 1
+                pde.w = 1
+                pde.u = 1
+                pde.ps = 1 # mark as a 2MB large page
+                pde.pfn = ((i << 9) + j) << 9
+    _paging_templates[key] = str(raw)
+    return _paging_templates[key]
+
 class VMState(object):
-    def __init__(self, arch = 0x86):
+    def __init__(self, arch = 0x86, sparse = False):
         assert arch in (0x86, 0x64), 'Unsupported architecture: %x' % arch
-        self.memory = Memory()
+        self.memory = SparseMemory() if sparse else Memory()
         self.regs = RegFile()
         self.regs.cr0.PE = 1
         if arch == 0x64:
@@ -597,6 +1277,60 @@ class VMState(object):
             self.regs.efer.LME = 1
             self.regs.efer.LMA = 1
             self.regs.efer.NXE = 1
+        self.reset_views()
+
+    @classmethod
+    def from_buffer(cls, buf, offset = 0, size = None):
+        '''
+        Construct a VM state whose registers and memory are views over the
+        given writable buffer (no copies are made). Sparse and compressed
+        states are recognized by their magic: the memory extents of sparse
+        states are copied, and compressed states are decompressed first.
+        '''
+        if size is None:
+            size = len(buf) - offset
+        if buf[offset:offset + len(COMPRESSED_MAGIC)] == COMPRESSED_MAGIC:
+            return cls.from_buffer(decompress_seed(buf[offset:offset + size]))
+        state = cls.__new__(cls)
+        if buf[offset:offset + len(SPARSE_MAGIC)] == SPARSE_MAGIC:
+            state.regs = RegFile.from_buffer(buf, offset + len(SPARSE_MAGIC))
+            state.memory = SparseMemory.from_raw(buf, offset + len(SPARSE_MAGIC) + sizeof(RegFile))
+        else:
+            state.regs = RegFile.from_buffer(buf, offset)
+            state.memory = MappedMemory(buf, offset + sizeof(RegFile), size - sizeof(RegFile))
+        state.reset_views()
+        return state
+
+    @classmethod
+    def load(cls, path, key = None):
+        '''
+        Load a VM state by mapping the file privately (copy-on-write), so
+        modifications are never written back to the file. For seed packs,
+        key selects the entry by index or name. A region map saved next to
+        a seed file (see save()) is loaded along with it.
+        '''
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+        if buf[:len(PACK_MAGIC)] == PACK_MAGIC:
+            assert key is not None, 'An index or name is required to load from a seed pack'
+            return SeedPack(buf)[key]
+        state = cls.from_buffer(buf)
+        if os.path.exists(path + REGIONS_SUFFIX):
+            state.memory.regions = RegionMap.load(path + REGIONS_SUFFIX)
+        return state
+
+    def save(self, path, codec = None, level = COMPRESS_LEVEL):
+        '''
+        Write the state to path (compressed with codec, if given), and its
+        region map (if any) next to it.
+        '''
+        with open(path, 'wb') as f:
+            if codec:
+                f.write(compress_seed(self.raw(), codec, level))
+            else:
+                self.write_to(f)
+        if self.memory.regions:
+            self.memory.regions.save(path + REGIONS_SUFFIX)
 
     def setup_real(self):
         '''
@@ -621,66 +1355,182 @@ class VMState(object):
         # disable protected mode
         self.regs.cr0.PE = 0
 
-    def setup_paging(self):
+    def setup_paging(self, pae = False, huge = True):
         '''
-        Setup an identity mapping (VA == PA) with full accesses.
+        Setup an identity mapping (VA == PA) with full accesses. Without long
+        mode, 4MB pages map [0, 4GB), or 2MB PAE pages if pae is set. In long
+        mode, 1GB pages map [0, 512GB), or 2MB pages map [0, 4GB) if huge is
+        cleared. The tables are blitted from a cached template.
         '''
         assert self.regs.cr0.PG == 0
         if self.regs.efer.LMA == 0:
-            # allocate a page table directory
-            pgdiraddr = self.memory.allocate(PGSIZE, PGSIZE)
-            # setup identity mapping for [0, 4GB)
-            for i in range(PGSIZE / sizeof(PDE32)):
-                pde = PDE32.from_buffer(self.memory, pgdiraddr + i * sizeof(PDE32))
-                pde.p = 1
-                pde.w = 1
-                pde.u = 1
-                pde.ps = 1 # mark as a 4MB large page
-                pde.pfn = (i << 10)
-            # setup cr3
-            self.regs.cr3.value = pgdiraddr
+            mode = PAGING_PAE if pae else PAGING_32
         else:
-            # allocate a PML4 and a PDPT
-            pml4addr = self.memory.allocate(PGSIZE, PGSIZE)
-            pdptaddr = self.memory.allocate(PGSIZE, PGSIZE)
-            # make the first PML4 entry point to the PDPT
-            pml4e = PML4E.from_buffer(self.memory, pml4addr)
-            pml4e.p = 1
-            pml4e.w = 1
-            pml4e.u = 1
-            pml4e.pfn = (pdptaddr >> 12)
-            # setup identity mapping for [0, 512GB)
-            for i in range(PGSIZE / sizeof(PDPTE)):
-                pdpte = PDPTE.from_buffer(self.memory, pdptaddr + i * sizeof(PDPTE))
-                pdpte.p = 1
-                pdpte.w = 1
-                pdpte.u = 1
-                pdpte.ps = 1 # mark as a 1GB large page (requires hardware support)
-                pdpte.pfn = (i << 18)
-            # PAE is required for 4-level paging
+            mode = PAGING_4L_1G if huge else PAGING_4L_2M
+        # allocate and fill all the paging structures at once
+        base = self.memory.allocate(len(PAGING_LAYOUT[mode]) * PGSIZE, PGSIZE)
+        self.memory.write(base, paging_template(mode, base))
+        for (i, (name, cls)) in enumerate(PAGING_LAYOUT[mode]):
+            self.memory.regions.add(base + i * PGSIZE, PGSIZE, name, cls)
+        # PAE is required for both PAE and 4-level paging
+        if mode != PAGING_32:
             self.regs.cr4.PAE = 1
-            # setup cr3
-            self.regs.cr3.value = pml4addr
+        # setup cr3
+        self.regs.cr3.value = base
         # enable large page support
         self.regs.cr4.PSE = 1
         # turn on paging
         self.regs.cr0.PG = 1
 
+    def reset_views(self):
+        '''
+        Create the cached views of the state: the TLB and the typed GDT/IDT
+        (see DescriptorTable) and TSS views.
+        '''
+        self.flush_tlb()
+        self.gdt = DescriptorTable(self, 'gdtr')
+        self.idt = DescriptorTable(self, 'idtr')
+        self.tss_cache = (None, None)
+
+    @property
+    def tss(self):
+        '''
+        The current TSS (referred to by tr) as a TSS32 or TSS64 view.
+        '''
+        regs = self.regs
+        key = (regs.tr.base, regs.efer.LMA, len(self.memory))
+        if self.tss_cache[0] != key:
+            self.tss_cache = (key, self.memory.view(TSS64 if regs.efer.LMA else TSS32, regs.tr.base))
+        return self.tss_cache[1]
+
+    # number of translations cached before the TLB is flushed
+    TLB_ENTRIES = 256
+
+    def flush_tlb(self):
+        '''
+        Drop all cached translations. This is needed after modifying page
+        tables through self.memory directly; write_virt() and changes to the
+        paging registers flush the TLB automatically.
+        '''
+        self.tlb = {}
+        self.tlb_tables = set()
+        self.tlb_key = None
+
+    def walk(self, addr):
+        '''
+        Walk the page tables for a linear address. Returns the physical base
+        and the size of the page, plus the table pages visited.
+        '''
+        regs = self.regs
+        tables = []
+        def entry(cls, table, index):
+            tables.append(table & ~(PGSIZE - 1))
+            desc = self.memory.view(cls, table + index * sizeof(cls))
+            assert desc.p, 'Page fault: 0x%x is not mapped' % addr
+            return desc
+        if regs.efer.LMA:
+            desc = entry(PML4E, regs.cr3.value & ~0xfff, (addr >> 39) & 0x1ff)
+            desc = entry(PDPTE, desc.pfn << 12, (addr >> 30) & 0x1ff)
+            if desc.ps:
+                return ((desc.pfn << 12) & ~0x3fffffff, 1 << 30, tables)
+        elif regs.cr4.PAE:
+            desc = entry(PDPTE, regs.cr3.value & ~0x1f, (addr >> 30) & 0b11)
+        else:
+            desc = entry(PDE32, regs.cr3.value & ~0xfff, (addr >> 22) & 0x3ff)
+            if desc.ps and regs.cr4.PSE:
+                return ((desc.pfn << 12) & ~0x3fffff, 1 << 22, tables)
+            desc = entry(PTE32, desc.pfn << 12, (addr >> 12) & 0x3ff)
+            return (desc.pfn << 12, PGSIZE, tables)
+        desc = entry(PDE64, desc.pfn << 12, (addr >> 21) & 0x1ff)
+        if desc.ps:
+            return ((desc.pfn << 12) & ~0x1fffff, 1 << 21, tables)
+        desc = entry(PTE64, desc.pfn << 12, (addr >> 12) & 0x1ff)
+        return (desc.pfn << 12, PGSIZE, tables)
+
+    def translate(self, addr):
+        '''
+        Translate a linear address to a physical address. Translations are
+        cached per page until the paging registers or tables change.
+        '''
+        regs = self.regs
+        if not regs.cr0.PG:
+            return addr
+        key = (regs.cr3.value, regs.cr4.PSE, regs.cr4.PAE, regs.efer.LMA)
+        if key != self.tlb_key or len(self.tlb) >= self.TLB_ENTRIES:
+            self.flush_tlb()
+            self.tlb_key = key
+        page = addr >> 12
+        base = self.tlb.get(page)
+        if base is None:
+            (base, size, tables) = self.walk(addr)
+            base += addr & (size - 1) & ~(PGSIZE - 1)
+            self.tlb[page] = base
+            self.tlb_tables.update(tables)
+        return base | (addr & (PGSIZE - 1))
+
+    def linear(self, offset, size, seg = 'ds'):
+        '''
+        Apply segmentation to an offset, checking it against the segment
+        limit (except in 64-bit mode, where only fs/gs have a base).
+        '''
+        regs = self.regs
+        reg = getattr(regs, seg)
+        if regs.efer.LMA and regs.cs.l:
+            base = reg.base if seg in ('fs', 'gs') else 0
+            return (base + offset) & 0xffffffffffffffff
+        if reg.s and (reg.type & 0b1100) == 0b0100:
+            # expand-down data segment
+            top = 0xffffffff if reg.db else 0xffff
+            assert reg.limit < offset and offset + size - 1 <= top, 'Offset 0x%x is outside %s' % (offset, seg)
+        else:
+            assert offset + size - 1 <= reg.limit, 'Offset 0x%x is beyond the %s limit' % (offset, seg)
+        return (reg.base + offset) & 0xffffffff
+
+    def pages(self, offset, size, seg):
+        '''
+        Split a virtual range into (physical address, size) chunks that do
+        not cross page boundaries.
+        '''
+        addr = self.linear(offset, size, seg)
+        ans = []
+        while size > 0:
+            count = min(size, PGSIZE - (addr & (PGSIZE - 1)))
+            ans.append((self.translate(addr), count))
+            (addr, size) = (addr + count, size - count)
+        return ans
+
+    def read_virt(self, addr, size, seg = 'ds'):
+        '''
+        Read memory at a virtual address (seg:addr).
+        '''
+        ans = bytearray()
+        for (phys, count) in self.pages(addr, size, seg):
+            ans += self.memory.read(phys, count)
+        return ans
+
+    def write_virt(self, addr, content, seg = 'ds'):
+        '''
+        Write memory at a virtual address (seg:addr). Nothing is written if
+        any part of the range does not translate.
+        '''
+        pos = 0
+        for (phys, count) in self.pages(addr, len(content), seg):
+            self.memory.write(phys, content[pos:pos + count])
+            if (phys & ~(PGSIZE - 1)) in self.tlb_tables:
+                # the page tables have changed
+                self.flush_tlb()
+            pos += count
+
     def load_seg(self, reg, selector):
         '''
         Load the segment register and update its cache accordingly.
         '''
         assert (selector & 0b100) == 0, 'LDT is not supported yet'
         assert selector + sizeof(SegDesc32) - 1 <= self.regs.gdtr.limit
-        desc_addr = self.regs.gdtr.base + (selector & ~0b111)
-        desc = SegDesc32.from_buffer(self.memory, desc_addr)
-        if desc.s == 0:
-            if desc.type == 0b1100:
-                desc = (CallGateDesc64 if self.regs.efer.LMA else CallGateDesc32).from_buffer(self.memory, desc_addr)
-            elif desc.type == 0b1011 or desc.type == 0b1001:
-                desc = (TssDesc64 if self.regs.efer.LMA else TssDesc32).from_buffer(self.memory, desc_addr)
-            else:
-                raise NotImplementedError
+        desc = self.gdt[selector]
+        if not isinstance(desc, SegDesc32):
+            # gates cannot be loaded into segment registers
+            raise NotImplementedError
         reg.base = desc.base()
         reg.limit = desc.limit() if not desc.g else (desc.limit() * PGSIZE + PGSIZE - 1)
         reg.selector = selector
@@ -705,7 +1555,7 @@ class VMState(object):
         # create a task state segment
         long_mode = self.regs.efer.LMA
         tss_size = sizeof(TSS32) if long_mode else sizeof(TSS64)
-        tss_addr = self.memory.allocate(tss_size)
+        tss_addr = self.memory.allocate(tss_size, 1, 'tss', TSS64 if long_mode else TSS32)
         # GDT always starts with a NULL descriptor
         gdt = [SegDesc32(), # NULL
                SegDesc32(0, 0xfffff, 0b1011, 1, 0, 1, 0, long_mode, 1 - long_mode, 1), # KT
@@ -719,7 +1569,7 @@ class VMState(object):
             gdt.append(TssDesc32(tss_addr, tss_size - 1, 1, 0, 1, 0, 0))
         # allocate GDT from the memory
         gdt_size = sum([sizeof(desc) for desc in gdt])
-        gdt_addr = self.memory.allocate(gdt_size)
+        gdt_addr = self.memory.allocate(gdt_size, 1, 'gdt')
         # initialize the GDT layout accordingly
         self.memory.write(gdt_addr, ''.join([str(bytearray(desc)) for desc in gdt]))
         # update gdtr to point to the GDT in memory
@@ -740,43 +1590,520 @@ class VMState(object):
         raw = ''.join([str(bytearray(desc)) for desc in descs])
         # allocate IDT and set it up accordingly
         idt_size = len(raw)
-        idt_addr = self.memory.allocate(idt_size, 8)
+        idt_addr = self.memory.allocate(idt_size, 8, 'idt')
         self.memory.write(idt_addr, raw)
         # update idtr to point to the IDT
         self.regs.idtr.base = idt_addr
         self.regs.idtr.limit = idt_size - 1
 
+    def fork(self):
+        '''
+        Clone the current VM state. The register file and memory are copied
+        with a single memcpy each, which is much cheaper than rebuilding a
+        state with setup_gdt()/setup_paging(). This is a full copy rather than
+        copy-on-write (ctypes views write straight into the memory buffers),
+        so changes to the clone never reach the original; only the region
+        map is shared until either side adds a region.
+        '''
+        state = type(self).__new__(type(self))
+        state.regs = RegFile.from_buffer_copy(self.regs)
+        state.memory = self.memory.copy()
+        state.reset_views()
+        return state
+
     def raw(self):
         '''
-        Convert the current VM state to raw bytes.
+        Convert the current VM state to raw bytes. Sparse states are
+        prefixed with SPARSE_MAGIC and followed by their extent index.
         '''
-        return bytearray(self.regs) + bytearray(self.memory)
+        if isinstance(self.memory, SparseMemory):
+            return bytearray(SPARSE_MAGIC) + bytearray(self.regs) + self.memory.raw()
+        ans = bytearray(self.regs)
+        for (addr, buf) in self.memory.extents():
+            ans += buf
+        return ans
+
+    def iter_chunks(self):
+        '''
+        Yield the bytes of raw() as a sequence of memoryviews over the
+        register file and the memory buffers, without copying them.
+        '''
+        if isinstance(self.memory, SparseMemory):
+            yield byteview(SPARSE_MAGIC)
+            yield byteview(self.regs)
+            yield byteview(self.memory.header())
+            for buf in self.memory.buffers:
+                yield byteview(buf)
+        else:
+            yield byteview(self.regs)
+            for (addr, buf) in self.memory.extents():
+                yield byteview(buf)
 
-    def dump(self, showreg = True, showmem = False):
+    # maximum number of buffers passed to one writev() call
+    IOV_MAX = 1024
+
+    def write_to(self, fileobj):
+        '''
+        Write raw() to a file object without building it in memory first.
+        Where os.writev() is available, the chunks are written with as few
+        system calls as possible.
         '''
-        Dump the current register/memory state.
+        chunks = [chunk for chunk in self.iter_chunks() if len(chunk)]
+        if not hasattr(os, 'writev') or not hasattr(fileobj, 'fileno'):
+            for chunk in chunks:
+                fileobj.write(chunk)
+            return
+        fileobj.flush()
+        fd = fileobj.fileno()
+        while chunks:
+            written = os.writev(fd, chunks[:self.IOV_MAX])
+            # drop the chunks written in full and retry after a partial write
+            while chunks and written >= len(chunks[0]):
+                written -= len(chunks.pop(0))
+            if written:
+                chunks[0] = chunks[0][written:]
+
+    def memory_ranges(self, ranges = None):
         '''
+        Enumerate the populated (address, bytes) pieces of memory, limited
+        to the given (address, size) ranges if any.
+        '''
+        for (start, buf) in self.memory.extents():
+            if ranges is None:
+                yield (start, buf)
+                continue
+            for (addr, size) in ranges:
+                lo = max(addr, start)
+                hi = min(addr + size, start + len(buf))
+                if lo < hi:
+                    yield (lo, buf[lo - start:hi - start])
+
+    def dump(self, showreg = True, showmem = False, regs = None, ranges = None, collapse = True):
+        '''
+        Dump the current register/memory state, optionally limited to the
+        named registers and the (address, size) memory ranges.
+        '''
+        lines = []
         if showreg:
-            print '==================== REGISTER STATE ====================='
-            print
+            lines += ['==================== REGISTER STATE =====================', '']
             for field_info in self.regs._fields_:
-                print '%s: %s' % (field_info[0], dumps(getattr(self.regs, field_info[0])))
-            print
+                if regs is None or field_info[0] in regs:
+                    lines.append('%s: %s' % (field_info[0], dumps(getattr(self.regs, field_info[0]))))
+            lines.append('')
+        if showmem:
+            lines += ['===================== MEMORY STATE ======================', '']
+            for (start, buf) in self.memory_ranges(ranges):
+                lines += hexdump(buf, start, collapse)
+            lines.append('')
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
+
+    def todict(self, showreg = True, showmem = False, regs = None, ranges = None):
+        '''
+        Convert the register/memory state into a JSON-serializable dict.
+        '''
+        ans = {}
+        if showreg:
+            ans['regs'] = dict((field_info[0], todict(getattr(self.regs, field_info[0])))
+                               for field_info in self.regs._fields_ if regs is None or field_info[0] in regs)
         if showmem:
-            print '===================== MEMORY STATE ======================'
-            print
-            for addr in range(0, len(self.memory), 16):
-                remaining = len(self.memory) - addr
-                content = self.memory.read(addr, 16 if remaining > 16 else remaining)
-                print '%08x: %s' % (addr, ' '.join(map(lambda b: '%02x' % b, content)))
-            print
+            ans['memory'] = [{'addr': start, 'data': str(bytearray(buf)).encode('hex')}
+                             for (start, buf) in self.memory_ranges(ranges)]
+        return ans
+
+def changed_ranges(old, new, gap = 8, blocks = (4096, 64)):
+    '''
+    Return the [start, end) ranges where new differs from old, with the
+    shorter buffer padded with zeros. Blocks of decreasing sizes are
+    compared with slices first, so only the differing 64-byte blocks are
+    scanned byte by byte. Ranges separated by less than gap equal bytes
+    are merged.
+    '''
+    (old, new) = (bytearray(old), bytearray(new))
+    size = max(len(old), len(new))
+    old.extend('\x00' * (size - len(old)))
+    new.extend('\x00' * (size - len(new)))
+    ranges = []
+    def scan(start, end, level):
+        block = blocks[level] if level < len(blocks) else 1
+        for off in range(start, end, block):
+            stop = min(off + block, end)
+            if old[off:stop] == new[off:stop]:
+                continue
+            if block > 1:
+                scan(off, stop, level + 1)
+            elif ranges and ranges[-1][1] + gap >= off:
+                ranges[-1][1] = off + 1
+            else:
+                ranges.append([off, off + 1])
+    scan(0, size, 0)
+    return ranges
+
+def delta_encode(base, raw, index = 0):
+    '''
+    Encode raw as the byte ranges that differ from base (an earlier seed,
+    referred to by its pack index).
+    '''
+    ranges = changed_ranges(base[:len(raw)], raw)
+    delta = bytearray(DELTA_MAGIC + struct.pack('<IQI', index, len(raw), len(ranges)))
+    for (start, end) in ranges:
+        delta += struct.pack('<QI', start, end - start)
+    for (start, end) in ranges:
+        delta += raw[start:end]
+    return delta
+
+def delta_decode(base, delta):
+    '''
+    Reconstruct the raw state from its base and a delta_encode() result.
+    '''
+    (index, size, count) = struct.unpack_from('<IQI', delta, len(DELTA_MAGIC))
+    raw = bytearray(base[:size])
+    raw.extend('\x00' * (size - len(raw)))
+    ranges = len(DELTA_MAGIC) + 16
+    data = ranges + count * 12
+    for i in range(count):
+        (start, length) = struct.unpack_from('<QI', delta, ranges + i * 12)
+        raw[start:start + length] = delta[data:data + length]
+        data += length
+    return raw
+
+def compress_seed(raw, codec = 'zlib', level = COMPRESS_LEVEL):
+    '''
+    Compress a raw state (dense, sparse or delta) into a self-describing
+    blob: COMPRESSED_MAGIC, UINT32 codec, UINT64 raw size, then the stream.
+    '''
+    if codec == 'lzma':
+        assert lzma is not None, 'lzma is not available'
+        data = lzma.compress(str(raw), preset = level)
+    else:
+        assert codec == 'zlib', 'Unsupported codec: %s' % codec
+        data = zlib.compress(str(raw), level)
+    return COMPRESSED_MAGIC + struct.pack('<IQ', CODECS[codec], len(raw)) + data
+
+def decompress_seed(blob):
+    '''
+    Reconstruct the raw state from a compress_seed() result.
+    '''
+    (codec, size) = struct.unpack_from('<IQ', blob, len(COMPRESSED_MAGIC))
+    data = str(blob[len(COMPRESSED_MAGIC) + 12:])
+    if codec == CODECS['lzma']:
+        assert lzma is not None, 'lzma is not available'
+        raw = lzma.decompress(data)
+    else:
+        assert codec == CODECS['zlib'], 'Unsupported codec: %d' % codec
+        raw = zlib.decompress(data)
+    assert len(raw) == size, 'Truncated compressed seed'
+    return bytearray(raw)
+
+class SeedPack(object):
+    '''
+    Random access to a seed pack: many VM_STATE blobs in one file, laid out
+    as a header (magic, UINT32 version, UINT32 count, UINT64 index offset),
+    the blobs, and an index of (UINT64 offset, UINT64 size, UINT16 name
+    length, name) entries.
+    '''
+    def __init__(self, buf):
+        assert buf[:len(PACK_MAGIC)] == PACK_MAGIC, 'Not a seed pack'
+        (version, count, index) = struct.unpack_from('<IIQ', buf, len(PACK_MAGIC))
+        assert version == PACK_VERSION, 'Unsupported seed pack version: %d' % version
+        self.buf = buf
+        self.entries = []
+        self.names = {}
+        for i in range(count):
+            (offset, size, namelen) = struct.unpack_from('<QQH', buf, index)
+            name = str(buf[index + 18:index + 18 + namelen])
+            index += 18 + namelen
+            self.names[name] = i
+            self.entries.append((name, offset, size))
+
+    @staticmethod
+    def open(path):
+        with open(path, 'rb') as f:
+            return SeedPack(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, key):
+        (name, offset, size) = self.entries[self.names[key] if isinstance(key, basestring) else key]
+        if self.buf[offset:offset + len(DELTA_MAGIC)] in (DELTA_MAGIC, COMPRESSED_MAGIC):
+            return VMState.from_buffer(self.raw(key))
+        return VMState.from_buffer(self.buf, offset, size)
+
+    def raw(self, key):
+        (name, offset, size) = self.entries[self.names[key] if isinstance(key, basestring) else key]
+        blob = self.buf[offset:offset + size]
+        if blob[:len(COMPRESSED_MAGIC)] == COMPRESSED_MAGIC:
+            blob = decompress_seed(blob)
+        if blob[:len(DELTA_MAGIC)] == DELTA_MAGIC:
+            (index,) = struct.unpack_from('<I', blob, len(DELTA_MAGIC))
+            return delta_decode(self.raw(index), blob)
+        return blob
+
+class SeedPackWriter(object):
+    '''
+    Append VM states to a new seed pack. The index is written on close().
+    With delta enabled, a seed is stored as a delta against the most recent
+    full seed whenever that saves enough space; otherwise it becomes the
+    new base. With a codec, every blob is then compressed on its own, so
+    seeds can still be loaded individually.
+    '''
+    HEADER = len(PACK_MAGIC) + 16
+    # a delta is only kept if it is smaller than this fraction of the seed
+    DELTA_RATIO = 0.5
+
+    def __init__(self, path, delta = False, codec = None, level = COMPRESS_LEVEL):
+        self.file = open(path, 'wb')
+        self.file.write('\x00' * self.HEADER)
+        self.entries = []
+        self.names = {}
+        self.delta = delta
+        self.base = None
+        self.codec = codec
+        self.level = level
+
+    def add(self, name, raw):
+        if self.delta:
+            if self.base is not None:
+                blob = delta_encode(self.base[1], raw, self.base[0])
+                if len(blob) < len(raw) * self.DELTA_RATIO:
+                    raw = blob
+                else:
+                    self.base = None
+            if self.base is None:
+                self.base = (len(self.entries), str(raw))
+        if self.codec:
+            raw = compress_seed(raw, self.codec, self.level)
+        self.names[name] = len(self.entries)
+        self.entries.append((name, self.file.tell(), len(raw)))
+        self.file.write(raw)
+        return True
+
+    def add_batch(self, names, block, size):
+        '''
+        Append len(names) full seeds of the same size stored back to back in
+        block with a single write (or one by one if they are compressed).
+        '''
+        if self.codec:
+            for (i, name) in enumerate(names):
+                self.add(name, block[i * size:(i + 1) * size])
+            return
+        offset = self.file.tell()
+        for (i, name) in enumerate(names):
+            self.names[name] = len(self.entries)
+            self.entries.append((name, offset + i * size, size))
+        self.file.write(block)
+
+    def link(self, name, target):
+        '''
+        Add name as an alias sharing the blob of an earlier entry.
+        '''
+        if target not in self.names:
+            return False
+        self.names[name] = len(self.entries)
+        self.entries.append((name,) + self.entries[self.names[target]][1:])
+        return True
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def close(self):
+        index = self.file.tell()
+        for (name, offset, size) in self.entries:
+            self.file.write(struct.pack('<QQH', offset, size, len(name)) + name)
+        self.file.seek(0)
+        self.file.write(PACK_MAGIC + struct.pack('<IIQ', PACK_VERSION, len(self.entries), index))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Profiler(object):
+    '''
+    Opt-in instrumentation that counts and times the VMState setup methods,
+    memory operations and serialization, aggregated per stage (e.g., the
+    generator function that is running). Nothing is wrapped until enable()
+    is called, so a disabled profiler costs nothing. Times are inclusive:
+    setup_gdt() also accounts for the allocate/write calls it makes.
+    '''
+    TARGETS = [('VMState', ('setup_real', 'setup_paging', 'setup_gdt', 'setup_idt', 'load_seg',
+                            'fork', 'raw', 'iter_chunks', 'write_to', 'from_buffer', 'load')),
+               ('Memory', ('allocate', 'write', 'read', 'view', 'copy')),
+               ('MappedMemory', ('allocate', 'write', 'read', 'view', 'copy')),
+               ('SparseMemory', ('allocate', 'allocate_at', 'write', 'read', 'view', 'copy', 'raw', 'from_raw')),
+               ('SeedPackWriter', ('add', 'add_batch'))]
+
+    def __init__(self):
+        self.enabled = False
+        self.current = None # the stage calls are attributed to
+        self.stats = {} # (stage, operation) -> [calls, seconds]
+        self.originals = []
+
+    def record(self, label, seconds, calls = 1):
+        entry = self.stats.get((self.current, label))
+        if entry is None:
+            entry = self.stats[(self.current, label)] = [0, 0.0]
+        entry[0] += calls
+        entry[1] += seconds
+
+    def wrap(self, cls, name):
+        attr = cls.__dict__[name]
+        kind = type(attr) if isinstance(attr, (classmethod, staticmethod)) else None
+        func = attr.__func__ if kind else attr
+        label = '%s.%s' % (cls.__name__, name)
+        if inspect.isgeneratorfunction(func):
+            # time the steps of a generator (e.g., iter_chunks()) rather than
+            # its creation, and count one call once it is done
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                (items, seconds) = (func(*args, **kwargs), 0.0)
+                try:
+                    while True:
+                        start = time.time()
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                        finally:
+                            seconds += time.time() - start
+                        yield item
+                finally:
+                    self.record(label, seconds)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(label, time.time() - start)
+        setattr(cls, name, kind(wrapper) if kind else wrapper)
+        self.originals.append((cls, name, attr))
+
+    def enable(self):
+        if self.enabled:
+            return
+        for (cls, names) in self.TARGETS:
+            for name in names:
+                self.wrap(globals()[cls], name)
+        self.enabled = True
+
+    def disable(self):
+        for (cls, name, attr) in reversed(self.originals):
+            setattr(cls, name, attr)
+        self.originals = []
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        (previous, self.current) = (self.current, name)
+        try:
+            yield
+        finally:
+            self.current = previous
+
+    @contextlib.contextmanager
+    def measure(self, label):
+        '''
+        Time a block of code (e.g., file I/O) under the current stage.
+        '''
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(label, time.time() - start)
+
+    def iterate(self, name, iterable):
+        '''
+        Iterate, attributing the work of producing each item to stage name.
+        The stage is only active inside next(), not while the consumer runs.
+        '''
+        if not self.enabled:
+            return iter(iterable)
+        return self.iterate_staged(name, iter(iterable))
+
+    def iterate_staged(self, name, items):
+        while True:
+            with self.stage(name):
+                start = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    self.record('generate', time.time() - start, 0)
+                    return
+                self.record('generate', time.time() - start)
+            yield item
+
+    def collect(self):
+        '''
+        Return the stats gathered so far and start over (e.g., per worker job).
+        '''
+        (stats, self.stats) = (self.stats, {})
+        return stats
+
+    def merge(self, stats):
+        for ((stage, label), (calls, seconds)) in stats.items():
+            entry = self.stats.setdefault((stage, label), [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def rows(self):
+        '''
+        Return (stage, operation, calls, seconds) rows sorted by stage and
+        decreasing time.
+        '''
+        return sorted([(stage or '', label, calls, seconds) for ((stage, label), (calls, seconds)) in self.stats.items()],
+                      key = lambda row: (row[0], -row[3]))
+
+    def export(self, path):
+        '''
+        Save the profile as JSON, or as CSV if path ends with '.csv'.
+        '''
+        rows = self.rows()
+        with open(path, 'wb') as f:
+            if path.endswith('.csv'):
+                writer = csv.writer(f)
+                writer.writerow(('stage', 'operation', 'calls', 'seconds'))
+                writer.writerows(rows)
+            else:
+                json.dump([{'stage': stage, 'operation': label, 'calls': calls, 'seconds': seconds}
+                           for (stage, label, calls, seconds) in rows], f, indent = 2)
+
+# the process-wide profiler (disabled by default)
+profiler = Profiler()
+
+def parse_range(text):
+    (addr, size) = text.split(':')
+    return (int(addr, 0), int(size, 0))
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print 'usage: %s state.bin' % sys.argv[0]
-        sys.exit(0)
-    raw = bytearray(open(sys.argv[1], 'rb').read())
-    state = VMState()
-    state.regs = type(state.regs).from_buffer(raw)
-    state.memory = Memory(raw[sizeof(state.regs):])
-    state.dump(True, True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', metavar = 'state.bin', help = 'seed file or seed pack')
+    parser.add_argument('key', nargs = '?', help = 'index or name of the seed in a seed pack')
+    parser.add_argument('-r', nargs = '+', dest = 'regs', choices = [field_info[0] for field_info in RegFile._fields_], metavar = 'reg', help = 'only show these registers')
+    parser.add_argument('-m', nargs = '+', dest = 'ranges', type = parse_range, metavar = 'addr:size', help = 'only show these memory ranges')
+    parser.add_argument('-n', nargs = '+', dest = 'regions', metavar = 'name', help = 'only show the memory regions with these names (e.g., code stack)')
+    parser.add_argument('-R', action = 'store_false', dest = 'showreg', default = True, help = 'do not show registers')
+    parser.add_argument('-M', action = 'store_false', dest = 'showmem', default = True, help = 'do not show memory')
+    parser.add_argument('-a', action = 'store_false', dest = 'collapse', default = True, help = 'show all lines without collapsing repeated ones')
+    parser.add_argument('-j', action = 'store_true', default = False, help = 'output JSON')
+    args = parser.parse_args()
+    key = args.key
+    if key is not None and key.isdigit():
+        key = int(key)
+    state = VMState.load(args.path, key)
+    if args.regions:
+        args.ranges = (args.ranges or []) + [(start, end - start) for (start, end, name, cls) in state.memory.regions.named(*args.regions)]
+    if args.j:
+        print json.dumps(state.todict(args.showreg, args.showmem, args.regs, args.ranges), sort_keys = True)
+    else:
+        state.dump(args.showreg, args.showmem, args.regs, args.ranges, args.collapse)